@@ -0,0 +1,15 @@
+import os
+
+from celery import Celery
+
+
+# set the default Django settings module for the 'celery' program
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chris_django_project.settings')
+
+app = Celery('chris_django_project')
+
+# read the celery configuration from the CELERY_* Django settings
+app.config_from_object('django.conf:settings', namespace='CELERY')
+
+# load the tasks modules of all the registered Django apps
+app.autodiscover_tasks()
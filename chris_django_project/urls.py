@@ -15,7 +15,9 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from uploadedfiles import views as uploadedfile_views
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', uploadedfile_views.StorageMetricsView.as_view(), name='metrics'),
     path('', include('uploadedfiles.api'))
 ]
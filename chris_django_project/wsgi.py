@@ -12,5 +12,7 @@ import os
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chris_django_project.settings')
+# verify (or create) the storage bucket when the server process starts
+os.environ.setdefault('AWS_S3_ENSURE_BUCKET_ON_STARTUP', 'true')
 
 application = get_wsgi_application()
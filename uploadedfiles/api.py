@@ -12,9 +12,27 @@ urlpatterns = format_suffix_patterns([
     path('api/v1/uploadedfiles/',
          uploadedfile_views.UploadedFileList.as_view(),
          name='uploadedfile-list'),
+    path('api/v1/uploadedfiles/upload/',
+         uploadedfile_views.UploadedFileUploadRequest.as_view(),
+         name='uploadedfile-upload'),
+    path('api/v1/uploadedfiles/upload/complete/',
+         uploadedfile_views.UploadedFileUploadComplete.as_view(),
+         name='uploadedfile-upload-complete'),
+    path('api/v1/uploadedfiles/archive/',
+         uploadedfile_views.UploadedFileArchive.as_view(),
+         name='uploadedfile-archive'),
     path('api/v1/uploadedfiles/<int:pk>/',
          uploadedfile_views.UploadedFileDetail.as_view(),
          name='uploadedfile-detail'),
+    path('api/v1/uploadedfiles/<int:pk>/<str:filename>',
+         uploadedfile_views.UploadedFileResource.as_view(),
+         name='uploadedfile-resource'),
+    path('api/v1/ingestjobs/',
+         uploadedfile_views.IngestJobList.as_view(),
+         name='ingestjob-list'),
+    path('api/v1/ingestjobs/<int:pk>/',
+         uploadedfile_views.IngestJobDetail.as_view(),
+         name='ingestjob-detail'),
 ]
 )
 
@@ -1,5 +1,26 @@
+import logging
+
 from django.apps import AppConfig
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
 
 
 class UploadedfilesConfig(AppConfig):
     name = 'uploadedfiles'
+
+    def ready(self):
+        """
+        Overriden to verify (or create) the storage bucket once per process at startup
+        rather than on the first request.
+        """
+        if not getattr(settings, 'AWS_S3_ENSURE_BUCKET_ON_STARTUP', False):
+            return
+        from .s3_storage import ensure_bucket
+        try:
+            ensure_bucket()
+        except Exception as e:
+            # don't prevent the process from starting, storage calls will fail loudly
+            logger.error('Could not verify storage bucket %s: %s',
+                         settings.AWS_STORAGE_BUCKET_NAME, str(e))
@@ -0,0 +1,118 @@
+import shutil
+import tarfile
+import tempfile
+import zipfile
+
+
+ARCHIVE_CONTENT_TYPES = {'zip': 'application/zip', 'tar': 'application/x-tar'}
+
+
+class ArchiveBuffer(object):
+    """
+    Write-only file-like object that collects what an archive writer writes to it
+    until the bytes are drained into the response. It has no tell or seek, so
+    zipfile writes the entries in streaming mode (sizes and CRC after the data).
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """
+        Return the bytes written since the last call.
+        """
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_archive(archive_format, entries):
+    """
+    Return a generator over the bytes of a zip or tar archive of the provided
+    (name, S3ObjectStream) entries. The archive is produced as the object streams are
+    consumed, so neither the archive nor a whole object is ever held in memory.
+
+    Streams of unknown size (gzip encoded objects stored without their uncompressed
+    size) are written as zip64 entries whose sizes follow the data, and are spooled
+    to a temporary file to be measured before their tar header is written.
+    """
+    if archive_format == 'zip':
+        return iter_zip(entries)
+    if archive_format == 'tar':
+        return iter_tar(entries)
+    raise ValueError("Unknown archive format '%s'" % archive_format)
+
+
+def iter_zip(entries):
+    """
+    Return a generator over the bytes of a zip archive (files are stored
+    uncompressed, zip64 extensions are used as needed) of the provided entries.
+    """
+    buf = ArchiveBuffer()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as zf:
+        for name, stream in entries:
+            zinfo = zipfile.ZipInfo(name, date_time=stream.last_modified.timetuple()[:6])
+            if stream.content_length is None:
+                # the data descriptor after the data carries the size
+                force_zip64 = True
+            else:
+                zinfo.file_size = stream.content_length
+                force_zip64 = stream.content_length >= zipfile.ZIP64_LIMIT
+            with zf.open(zinfo, 'w', force_zip64=force_zip64) as f:
+                for chunk in stream:
+                    f.write(chunk)
+                    yield buf.drain()
+            yield buf.drain()
+    # the central directory
+    yield buf.drain()
+
+
+def iter_tar(entries):
+    """
+    Return a generator over the bytes of a POSIX (pax) tar archive of the provided
+    entries.
+    """
+    for name, stream in entries:
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.mtime = stream.last_modified.timestamp()
+        tarinfo.mode = 0o644
+        if stream.content_length is None:
+            with spool_stream(stream) as f:
+                tarinfo.size = f.tell()
+                f.seek(0)
+                yield tarinfo.tobuf(tarfile.PAX_FORMAT)
+                for chunk in iter(lambda: f.read(stream.chunk_size), b''):
+                    yield chunk
+        else:
+            tarinfo.size = stream.content_length
+            yield tarinfo.tobuf(tarfile.PAX_FORMAT)
+            for chunk in stream:
+                yield chunk
+        remainder = tarinfo.size % tarfile.BLOCKSIZE
+        if remainder:
+            yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+    # end of archive marker
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
+def spool_stream(stream):
+    """
+    Write the contents of a stream to a temporary file (kept in memory while it is
+    smaller than a chunk) and return the file, positioned at its end.
+    """
+    f = tempfile.SpooledTemporaryFile(max_size=stream.chunk_size)
+    try:
+        shutil.copyfileobj(stream, f, stream.chunk_size)
+    except BaseException:
+        f.close()
+        raise
+    finally:
+        stream.close()
+    return f
@@ -0,0 +1,189 @@
+import datetime
+import os
+import platform
+import statistics
+import tempfile
+import time
+
+from .s3_cache import get_listing_cache
+from .s3_fake import FakeS3Client
+from .s3_storage import PublicMediaStorage
+
+
+# default sizes of the benchmark workloads
+BENCHMARK_SIZES = {
+    'ls_objects': 20000,
+    'small_files': 1000,
+    'small_file_size': 4 * 1024,
+    'large_files': 2,
+    'large_file_size': 64 * 1024 * 1024,
+    'download_size': 64 * 1024 * 1024,
+    'copies': 200,
+    'deletes': 5000,
+    'exists_checks': 500,
+}
+
+
+class StorageBenchmark(object):
+    """
+    Micro-benchmarks of the PublicMediaStorage operations against a FakeS3Client
+    with injected per-request <latency> (seconds) and optional <bandwidth> (bytes per
+    second), so that runs are reproducible and comparable over time.
+
+    Every benchmark runs <repeat> times, each time against a new fake S3 populated
+    by an untimed setup step. Only the storage operation itself is timed.
+    """
+    benchmarks = ('ls', 'upload_files_small', 'upload_files_large', 'download_obj',
+                  'copy_obj', 'delete_many', 'obj_exists', 'exists_many', 'path_exists')
+
+    def __init__(self, latency=0.005, bandwidth=None, repeat=3, **sizes):
+        unknown = set(sizes) - set(BENCHMARK_SIZES)
+        if unknown:
+            raise ValueError('Unknown benchmark sizes: %s' % ', '.join(sorted(unknown)))
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.repeat = repeat
+        self.sizes = dict(BENCHMARK_SIZES, **sizes)
+
+    def run(self, names=None):
+        """
+        Run the benchmarks with the provided names (all of them by default) and
+        return the results as a JSON-serializable dictionary.
+        """
+        names = names or self.benchmarks
+        for name in names:
+            if name not in self.benchmarks:
+                raise ValueError("Unknown benchmark '%s'" % name)
+        return {
+            'version': 1,
+            'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'environment': {'python': platform.python_version(),
+                            'platform': platform.platform(),
+                            'cpu_count': os.cpu_count()},
+            'config': {'latency': self.latency, 'bandwidth': self.bandwidth,
+                       'repeat': self.repeat, 'sizes': self.sizes},
+            'results': [self.run_benchmark(name) for name in names],
+        }
+
+    def run_benchmark(self, name):
+        """
+        Run a single benchmark <repeat> times and return its result dictionary.
+        """
+        setup = getattr(self, 'setup_%s' % name)
+        durations = []
+        requests = {}
+        for _ in range(self.repeat):
+            client = FakeS3Client(latency=self.latency, bandwidth=self.bandwidth)
+            storage = self.get_storage(client)
+            with tempfile.TemporaryDirectory() as work_dir:
+                func, operations, nbytes = setup(client, storage, work_dir)
+                cache = get_listing_cache()
+                if cache is not None:
+                    cache.clear()
+                requests_before = dict(client.requests)
+                start = time.perf_counter()
+                func()
+                durations.append(time.perf_counter() - start)
+            requests = {op: count - requests_before.get(op, 0)
+                        for op, count in sorted(client.requests.items())
+                        if count > requests_before.get(op, 0)}
+        median = statistics.median(durations)
+        return {
+            'name': name,
+            'runs': len(durations),
+            'seconds': {'min': min(durations), 'median': median,
+                        'mean': statistics.mean(durations), 'max': max(durations)},
+            'operations': operations,
+            'operations_per_second': operations / median if median else None,
+            'bytes': nbytes,
+            'megabytes_per_second': nbytes / median / 1e6 if nbytes and median else None,
+            'requests': requests,
+        }
+
+    @staticmethod
+    def get_storage(client):
+        """
+        Return a storage instance that sends its requests to <client>.
+        """
+        storage = PublicMediaStorage()
+        storage.container_name = 'benchmark'
+        storage.get_connection = lambda: client
+        return storage
+
+    @staticmethod
+    def _write_files(local_dir, count, size):
+        os.makedirs(local_dir)
+        for i in range(count):
+            with open(os.path.join(local_dir, 'file%06d' % i), 'wb') as f:
+                f.write(os.urandom(size))
+
+    @staticmethod
+    def _check_report(report):
+        if report.get('failed'):
+            raise RuntimeError('Benchmark operation failed: %s' % (report['failed'][:5],))
+
+    def setup_ls(self, client, storage, work_dir):
+        count = self.sizes['ls_objects']
+        for i in range(count):
+            client.put('bench/ls/dir%03d/file%06d' % (i % 100, i), b'x')
+        return lambda: storage.ls('bench/ls/'), count, 0
+
+    def setup_upload_files_small(self, client, storage, work_dir):
+        count, size = self.sizes['small_files'], self.sizes['small_file_size']
+        local_dir = os.path.join(work_dir, 'small')
+        self._write_files(local_dir, count, size)
+        return (lambda: self._check_report(storage.upload_files(local_dir, 'bench/small')),
+                count, count * size)
+
+    def setup_upload_files_large(self, client, storage, work_dir):
+        count, size = self.sizes['large_files'], self.sizes['large_file_size']
+        local_dir = os.path.join(work_dir, 'large')
+        self._write_files(local_dir, count, size)
+        return (lambda: self._check_report(storage.upload_files(local_dir, 'bench/large')),
+                count, count * size)
+
+    def setup_download_obj(self, client, storage, work_dir):
+        size = self.sizes['download_size']
+        client.put('bench/download/file', os.urandom(size))
+        return lambda: storage.download_obj('bench/download/file'), 1, size
+
+    def setup_copy_obj(self, client, storage, work_dir):
+        count = self.sizes['copies']
+        for i in range(count):
+            client.put('bench/copy/src/file%06d' % i, os.urandom(1024))
+
+        def copy():
+            for i in range(count):
+                storage.copy_obj('bench/copy/src/file%06d' % i,
+                                 'bench/copy/dest/file%06d' % i)
+        return copy, count, 0
+
+    def setup_delete_many(self, client, storage, work_dir):
+        count = self.sizes['deletes']
+        keys = ['bench/delete/file%06d' % i for i in range(count)]
+        for key in keys:
+            client.put(key, b'x')
+        return lambda: self._check_report(storage.delete_many(keys)), count, 0
+
+    def _setup_exists(self, client, check):
+        count = self.sizes['exists_checks']
+        # every other key exists
+        keys = ['bench/exists/file%06d' % i for i in range(count)]
+        for key in keys[::2]:
+            client.put(key, b'x')
+
+        def exists():
+            for key in keys:
+                check(key)
+        return exists, count, 0
+
+    def setup_obj_exists(self, client, storage, work_dir):
+        return self._setup_exists(client, storage.obj_exists)
+
+    def setup_exists_many(self, client, storage, work_dir):
+        exists, count, nbytes = self._setup_exists(client, storage.obj_exists)
+        keys = ['bench/exists/file%06d' % i for i in range(count)]
+        return lambda: storage.exists_many(keys), count, nbytes
+
+    def setup_path_exists(self, client, storage, work_dir):
+        return self._setup_exists(client, storage.path_exists)
@@ -0,0 +1,56 @@
+from django.db import transaction
+
+from .models import ContentDigest, iter_batches
+
+
+class ContentDigestIndex(object):
+    """
+    Digest-to-object index of the storage dedup mode, kept in the ContentDigest table.
+
+    Every object stored in dedup mode has a row with the SHA-256 digest of its
+    contents, so the rows that share a digest are the references to that content and
+    their number is its reference count. Any of them can be the source of the
+    server-side copy that stores a repeated upload, and deleting an object only drops
+    its own row, so the index never points to a deleted object while the content is
+    still referenced by others.
+    """
+
+    def lookup(self, digest, size):
+        """
+        Return the key of an object with the provided contents or None if there is none.
+        """
+        return ContentDigest.objects.filter(digest=digest, size=size).values_list(
+            'key', flat=True).first()
+
+    def add(self, key, digest, size):
+        """
+        Record that the object <key> holds contents with the provided digest and size.
+        """
+        ContentDigest.objects.update_or_create(key=key,
+                                               defaults={'digest': digest, 'size': size})
+
+    def add_copies(self, copies):
+        """
+        Record the destinations of the (source key, destination key) copies of indexed
+        objects, with two queries.
+        """
+        copies = dict(copies)
+        sources = ContentDigest.objects.filter(key__in=list(copies))
+        rows = [ContentDigest(key=copies[source.key], digest=source.digest,
+                              size=source.size) for source in sources]
+        with transaction.atomic():
+            ContentDigest.objects.filter(key__in=list(copies.values())).delete()
+            ContentDigest.objects.bulk_create(rows)
+
+    def discard(self, keys):
+        """
+        Drop the rows of the provided object keys, with one query per batch of keys.
+        """
+        for batch in iter_batches(keys):
+            ContentDigest.objects.filter(key__in=batch).delete()
+
+    def ref_count(self, digest):
+        """
+        Return the number of objects that hold the contents with the provided digest.
+        """
+        return ContentDigest.objects.filter(digest=digest).count()
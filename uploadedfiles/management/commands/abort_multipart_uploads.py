@@ -0,0 +1,23 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from uploadedfiles.s3_storage import PublicMediaStorage
+
+
+class Command(BaseCommand):
+    help = 'Abort abandoned multipart uploads and free the storage used by their parts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prefix', default='',
+                            help='only abort uploads of objects with this prefix')
+        parser.add_argument('--older-than-hours', type=float, default=24,
+                            help='only abort uploads initiated at least this long ago')
+
+    def handle(self, *args, **options):
+        s3_manager = PublicMediaStorage()
+        older_than = datetime.timedelta(hours=options['older_than_hours'])
+        aborted = s3_manager.abort_multipart_uploads(options['prefix'], older_than)
+        for key, upload_id in aborted:
+            self.stdout.write('Aborted upload %s of %s' % (upload_id, key))
+        self.stdout.write(self.style.SUCCESS('Aborted %s uploads' % len(aborted)))
@@ -0,0 +1,63 @@
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from uploadedfiles.models import UploadedFile
+
+
+class Command(BaseCommand):
+    help = ('Fill in the size, ETag, content type and stored-at time of the uploaded '
+            'files from a single streamed listing of the bucket (and HEAD requests for '
+            'the files that may be stored compressed)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prefix', default='',
+                            help='only backfill files with this prefix')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='number of listed objects matched and updated per query')
+        parser.add_argument('--all', action='store_true',
+                            help='also refresh the rows that already have metadata')
+
+    def handle(self, *args, **options):
+        storage = UploadedFile._meta.get_field('fname').storage
+        batch_size = options['batch_size']
+        updated = 0
+        batch = {}
+        for obj in storage.ls_iter(options['prefix']):
+            batch[obj.key] = obj
+            if len(batch) >= batch_size:
+                updated += self.update_batch(batch, options['all'])
+                batch = {}
+        if batch:
+            updated += self.update_batch(batch, options['all'])
+        self.stdout.write(self.style.SUCCESS('Updated %s files' % updated))
+
+    def update_batch(self, batch, update_all):
+        """
+        Update the rows of the listed objects in <batch> with two queries. Listings
+        don't include the content type, so rows without one get the type guessed from
+        the file name, the same way the storage picks it for uploads without one.
+
+        Listings don't include the encoding either, and the listed size of a gzip
+        compressed object is its stored size, so the objects whose type may be stored
+        compressed get their metadata (and uncompressed size) from HEAD requests.
+        """
+        storage = UploadedFile._meta.get_field('fname').storage
+        rows = UploadedFile.objects.filter(fname__in=list(batch))
+        if not update_all:
+            rows = rows.filter(fsize__isnull=True)
+        rows = list(rows)
+        compressible = [row.fname.name for row in rows
+                        if storage.has_compressible_type(row.fname.name)]
+        if compressible:
+            with ThreadPoolExecutor(max_workers=storage.download_max_workers) as executor:
+                for metadata in executor.map(storage.get_obj_metadata, compressible):
+                    batch[metadata.key] = metadata
+        for row in rows:
+            row.set_storage_metadata(batch[row.fname.name])
+            if not row.content_type:
+                row.content_type = mimetypes.guess_type(row.fname.name)[0] or ''
+        UploadedFile.objects.bulk_update(rows, ['fsize', 'etag', 'content_type',
+                                                'stored_at'])
+        return len(rows)
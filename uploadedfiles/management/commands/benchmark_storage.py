@@ -0,0 +1,48 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from uploadedfiles.benchmarks import BENCHMARK_SIZES, StorageBenchmark
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the storage operations against an in-process fake S3 with '
+            'injected latency and write the results as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--benchmark', action='append', dest='benchmarks',
+                            choices=StorageBenchmark.benchmarks,
+                            help='benchmark to run (can be repeated, all by default)')
+        parser.add_argument('--latency-ms', type=float, default=5,
+                            help='latency injected in every S3 request')
+        parser.add_argument('--bandwidth-mbps', type=float, default=None,
+                            help='simulated transfer rate in MB/s (unlimited by default)')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='number of runs of each benchmark')
+        parser.add_argument('--output', help='JSON file to write the results to '
+                                             '(standard output by default)')
+        for name, default in BENCHMARK_SIZES.items():
+            parser.add_argument('--%s' % name.replace('_', '-'), type=int, default=default,
+                                dest=name)
+
+    def handle(self, *args, **options):
+        bandwidth = options['bandwidth_mbps']
+        benchmark = StorageBenchmark(
+            latency=options['latency_ms'] / 1000,
+            bandwidth=bandwidth * 1e6 if bandwidth else None,
+            repeat=options['repeat'],
+            **{name: options[name] for name in BENCHMARK_SIZES})
+        try:
+            results = benchmark.run(options['benchmarks'])
+        except (ValueError, RuntimeError) as e:
+            raise CommandError(str(e))
+        if not options['output']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        with open(options['output'], 'w') as f:
+            json.dump(results, f, indent=2)
+        for result in results['results']:
+            self.stdout.write('%-20s %10.4fs %12.1f ops/s' % (
+                result['name'], result['seconds']['median'],
+                result['operations_per_second'] or 0))
+        self.stdout.write(self.style.SUCCESS('Wrote results to %s' % options['output']))
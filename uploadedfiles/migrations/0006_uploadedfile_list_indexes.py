@@ -0,0 +1,29 @@
+# Generated by Django 3.2 on 2026-10-18 06:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uploadedfiles', '0005_uploadedfile_storage_metadata'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='uploadedfile',
+            options={'ordering': ('-creation_date', '-id')},
+        ),
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['creation_date', 'id'], name='uploadedfile_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['owner', 'creation_date', 'id'], name='uploadedfile_owner_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['owner', 'fname'], name='uploadedfile_owner_fname_idx'),
+        ),
+    ]
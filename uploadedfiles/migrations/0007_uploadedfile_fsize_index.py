@@ -0,0 +1,17 @@
+# Generated by Django 3.2 on 2026-10-18 06:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uploadedfiles', '0006_uploadedfile_list_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['fsize'], name='uploadedfile_fsize_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.2 on 2026-10-18 06:50
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('uploadedfiles', '0007_uploadedfile_fsize_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('creation_date', models.DateTimeField(auto_now_add=True)),
+                ('start_date', models.DateTimeField(blank=True, null=True)),
+                ('end_date', models.DateTimeField(blank=True, null=True)),
+                ('local_dir', models.CharField(max_length=1024)),
+                ('upload_path', models.CharField(max_length=512)),
+                ('status', models.CharField(choices=[('created', 'Created'), ('running', 'Running'), ('finished', 'Finished'), ('failed', 'Failed')], default='created', max_length=10)),
+                ('total_files', models.IntegerField(default=0)),
+                ('total_bytes', models.BigIntegerField(default=0)),
+                ('total_batches', models.IntegerField(default=0)),
+                ('done_files', models.IntegerField(default=0)),
+                ('done_bytes', models.BigIntegerField(default=0)),
+                ('done_batches', models.IntegerField(default=0)),
+                ('failed_files', models.IntegerField(default=0)),
+                ('error_message', models.TextField(blank=True)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ('-creation_date', '-id'),
+            },
+        ),
+    ]
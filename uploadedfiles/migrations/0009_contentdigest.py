@@ -0,0 +1,26 @@
+# Generated by Django 3.2 on 2026-10-18 06:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uploadedfiles', '0008_ingestjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContentDigest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=1024, unique=True)),
+                ('digest', models.CharField(max_length=64)),
+                ('size', models.BigIntegerField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='contentdigest',
+            index=models.Index(fields=['digest', 'size'], name='contentdigest_digest_idx'),
+        ),
+    ]
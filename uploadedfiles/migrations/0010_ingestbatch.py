@@ -0,0 +1,37 @@
+# Generated by Django 3.2 on 2026-10-18 07:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uploadedfiles', '0009_contentdigest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestBatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.IntegerField()),
+                ('files', models.JSONField()),
+                ('queued', models.BooleanField(default=False)),
+                ('done', models.BooleanField(default=False)),
+                ('end_date', models.DateTimeField(blank=True, null=True)),
+                ('done_files', models.IntegerField(default=0)),
+                ('done_bytes', models.BigIntegerField(default=0)),
+                ('failed_files', models.IntegerField(default=0)),
+                ('error_message', models.TextField(blank=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='batches', to='uploadedfiles.ingestjob')),
+            ],
+            options={
+                'ordering': ('job', 'number'),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='ingestbatch',
+            constraint=models.UniqueConstraint(fields=('job', 'number'), name='ingestbatch_job_number_unique'),
+        ),
+    ]
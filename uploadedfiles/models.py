@@ -1,7 +1,9 @@
 from django.db import models
+from django.db.models import Value
+from django.db.models.functions import Concat, Substr
 import django_filters
 from django_filters.rest_framework import FilterSet
-from .s3_storage import PublicMediaStorage
+from .s3_storage import DELETE_BATCH_SIZE, PublicMediaStorage
 from django.conf import settings
 
 
@@ -14,13 +16,205 @@ def uploaded_file_path(instance, filename):
     return result
 
 
+def iter_batches(items):
+    """
+    Return a generator over lists of up to DELETE_BATCH_SIZE of the provided items, so
+    that the IN lists of the queries built from them stay bounded.
+    """
+    items = list(items)
+    for i in range(0, len(items), DELETE_BATCH_SIZE):
+        yield items[i:i + DELETE_BATCH_SIZE]
+
+
+class UploadedFileManager(models.Manager):
+
+    def delete_files(self, fnames):
+        """
+        Delete the provided files from storage in batches and remove the rows of the
+        deleted ones with one query per batch. Return the storage delete report.
+        """
+        storage = self.model._meta.get_field('fname').storage
+        report = storage.delete_many(fnames)
+        for batch in iter_batches(report['deleted']):
+            self.filter(fname__in=batch).delete()
+        return report
+
+    def delete_prefix(self, prefix):
+        """
+        Delete all the files under the provided storage prefix and remove their rows
+        with a single query, or one query per batch of rows if some files could not be
+        deleted, in which case their rows are kept. Return the storage delete report.
+        """
+        storage = self.model._meta.get_field('fname').storage
+        report = storage.delete_prefix(prefix)
+        rows = self.filter(fname__startswith=prefix)
+        if not report['failed']:
+            rows.delete()
+            return report
+        failed = set(key for key, msg in report['failed'])
+        ids = [pk for pk, fname in rows.values_list('pk', 'fname') if fname not in failed]
+        for batch in iter_batches(ids):
+            self.filter(pk__in=batch).delete()
+        return report
+
+    def move_prefix(self, src_prefix, dest_prefix):
+        """
+        Move all the files under the source storage prefix to the destination prefix
+        and rename the rows of the moved files with one query per batch. Raise
+        ValueError, before anything is moved, if a renamed row would collide with an
+        existing row at the destination. Return the storage move report.
+        """
+        src_names = self.filter(fname__startswith=src_prefix).values_list('fname',
+                                                                          flat=True)
+        dest_names = [dest_prefix + name[len(src_prefix):] for name in src_names]
+        for batch in iter_batches(dest_names):
+            existing = list(self.filter(fname__in=batch).values_list('fname', flat=True))
+            if existing:
+                raise ValueError("Files already exist under '%s': %s" %
+                                 (dest_prefix, ', '.join(sorted(existing)[:10])))
+        storage = self.model._meta.get_field('fname').storage
+        report = storage.move_prefix(src_prefix, dest_prefix)
+        for batch in iter_batches(src for src, dest in report['moved']):
+            self.filter(fname__in=batch).update(
+                fname=Concat(Value(dest_prefix), Substr('fname', len(src_prefix) + 1),
+                             output_field=models.CharField()))
+        return report
+
+
 class UploadedFile(models.Model):
     creation_date = models.DateTimeField(auto_now_add=True)
     fname = models.FileField(max_length=512, upload_to=uploaded_file_path, unique=True)
     owner = models.ForeignKey('auth.User', on_delete=models.CASCADE)
+    fsize = models.BigIntegerField(null=True, blank=True)
+    etag = models.CharField(max_length=64, blank=True)
+    content_type = models.CharField(max_length=255, blank=True)
+    stored_at = models.DateTimeField(null=True, blank=True)
+
+    objects = UploadedFileManager()
 
     class Meta:
-        ordering = ('-fname',)
+        ordering = ('-creation_date', '-id')
+        indexes = [
+            models.Index(fields=['creation_date', 'id'],
+                         name='uploadedfile_created_idx'),
+            models.Index(fields=['owner', 'creation_date', 'id'],
+                         name='uploadedfile_owner_created_idx'),
+            models.Index(fields=['owner', 'fname'], name='uploadedfile_owner_fname_idx'),
+            models.Index(fields=['fsize'], name='uploadedfile_fsize_idx'),
+        ]
 
     def __str__(self):
         return self.fname.name
+
+    def save(self, *args, **kwargs):
+        """
+        Overriden to upload a new file before the row is written, so that the stored
+        object's metadata is saved with the same query.
+        """
+        if self.fname and not self.fname._committed:
+            self.fname.save(self.fname.name, self.fname.file, save=False)
+            self.set_storage_metadata(self.fname.storage.get_obj_metadata(self.fname.name))
+        super(UploadedFile, self).save(*args, **kwargs)
+
+    def set_storage_metadata(self, metadata):
+        """
+        Set the size, ETag, content type and stored-at time of the file from a storage
+        S3ObjectInfo or S3ObjectMetadata record.
+        """
+        self.fsize = metadata.size
+        self.etag = metadata.etag
+        self.stored_at = metadata.mtime
+        content_type = getattr(metadata, 'content_type', None)
+        if content_type is not None:
+            self.content_type = content_type
+
+
+class UploadedFileFilter(FilterSet):
+    """
+    Filters for the uploaded files. Every filter is served by an index: the fname
+    prefix by the varchar_pattern_ops index Postgres builds for the unique fname
+    column (so "everything under <prefix>" is an index range scan, not a bucket
+    listing), the creation date and size ranges by the creation_date and fsize
+    indexes and the owner by the indexes that start with the owner column.
+    """
+    fname = django_filters.CharFilter(field_name='fname', lookup_expr='startswith')
+    fname_exact = django_filters.CharFilter(field_name='fname', lookup_expr='exact')
+    owner_username = django_filters.CharFilter(field_name='owner__username',
+                                               lookup_expr='exact')
+    min_creation_date = django_filters.IsoDateTimeFilter(field_name='creation_date',
+                                                         lookup_expr='gte')
+    max_creation_date = django_filters.IsoDateTimeFilter(field_name='creation_date',
+                                                         lookup_expr='lte')
+    min_fsize = django_filters.NumberFilter(field_name='fsize', lookup_expr='gte')
+    max_fsize = django_filters.NumberFilter(field_name='fsize', lookup_expr='lte')
+
+    class Meta:
+        model = UploadedFile
+        fields = ['id', 'owner_username', 'fname', 'fname_exact',
+                  'min_creation_date', 'max_creation_date', 'min_fsize', 'max_fsize']
+
+
+class IngestJob(models.Model):
+    STATUS_CHOICES = [('created', 'Created'), ('running', 'Running'),
+                      ('finished', 'Finished'), ('failed', 'Failed')]
+
+    creation_date = models.DateTimeField(auto_now_add=True)
+    start_date = models.DateTimeField(null=True, blank=True)
+    end_date = models.DateTimeField(null=True, blank=True)
+    local_dir = models.CharField(max_length=1024)
+    upload_path = models.CharField(max_length=512)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='created')
+    total_files = models.IntegerField(default=0)
+    total_bytes = models.BigIntegerField(default=0)
+    total_batches = models.IntegerField(default=0)
+    done_files = models.IntegerField(default=0)
+    done_bytes = models.BigIntegerField(default=0)
+    done_batches = models.IntegerField(default=0)
+    failed_files = models.IntegerField(default=0)
+    error_message = models.TextField(blank=True)
+    owner = models.ForeignKey('auth.User', on_delete=models.CASCADE)
+
+    class Meta:
+        ordering = ('-creation_date', '-id')
+
+    def __str__(self):
+        return '%s -> %s' % (self.local_dir, self.upload_path)
+
+
+class IngestBatch(models.Model):
+    job = models.ForeignKey(IngestJob, on_delete=models.CASCADE, related_name='batches')
+    number = models.IntegerField()
+    # the [storage path, local path, size] of the files of the batch
+    files = models.JSONField()
+    queued = models.BooleanField(default=False)
+    done = models.BooleanField(default=False)
+    end_date = models.DateTimeField(null=True, blank=True)
+    done_files = models.IntegerField(default=0)
+    done_bytes = models.BigIntegerField(default=0)
+    failed_files = models.IntegerField(default=0)
+    error_message = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ('job', 'number')
+        constraints = [
+            models.UniqueConstraint(fields=['job', 'number'],
+                                    name='ingestbatch_job_number_unique'),
+        ]
+
+    def __str__(self):
+        return '%s #%s' % (self.job, self.number)
+
+
+class ContentDigest(models.Model):
+    key = models.CharField(max_length=1024, unique=True)
+    digest = models.CharField(max_length=64)
+    size = models.BigIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['digest', 'size'], name='contentdigest_digest_idx'),
+        ]
+
+    def __str__(self):
+        return '%s %s' % (self.digest, self.key)
+
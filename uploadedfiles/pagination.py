@@ -0,0 +1,23 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class ListCursorPagination(CursorPagination):
+    """
+    Keyset pagination for the collection views. Pages are requested with an opaque
+    cursor that holds the position of the last row sent, so every page is fetched
+    with an indexed range query and deep pages cost the same as the first one. The
+    page size defaults to REST_FRAMEWORK['PAGE_SIZE'] and clients can ask for up to
+    API_MAX_PAGE_SIZE rows with the limit query parameter.
+    """
+    ordering = ('-id',)
+    page_size_query_param = 'limit'
+    max_page_size = getattr(settings, 'API_MAX_PAGE_SIZE', 1000)
+
+
+class UploadedFileCursorPagination(ListCursorPagination):
+    """
+    Keyset pagination of the uploaded files, newest first. The id breaks ties
+    between files created at the same time so that the order is stable.
+    """
+    ordering = ('-creation_date', '-id')
@@ -0,0 +1,177 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class ListingCache(object):
+    """
+    Base class for the caches of storage listings and existence checks.
+
+    Entries are keyed by (kind, path) tuples, where path is the storage prefix the
+    cached value was computed for. Backends must implement get, set, invalidate and
+    clear, and count hits and misses so that the saved S3 requests can be reported.
+    """
+
+    def __init__(self, **options):
+        self.options = options
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        Return the cached value for <key> or None if there is none.
+        """
+        raise NotImplementedError
+
+    def set(self, key, value, generation=None):
+        """
+        Cache <value> for <key>. If a <generation> is passed and any invalidation
+        happened since it was read, the value may be stale and is not cached.
+        """
+        raise NotImplementedError
+
+    def invalidate(self, path):
+        """
+        Drop every entry whose path overlaps <path>, that is, every entry that might
+        change when an object whose key starts with <path> is written or deleted.
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """
+        Drop every entry.
+        """
+        raise NotImplementedError
+
+    @property
+    def generation(self):
+        """
+        A value that changes on every invalidation.
+        """
+        return self.invalidations
+
+    def stats(self):
+        """
+        Return a dictionary with the cache counters.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'invalidations': self.invalidations}
+
+
+class LocMemListingCache(ListingCache):
+    """
+    In-process listing cache bounded by number of entries (evicted LRU) and by
+    entry age (TTL in seconds).
+    """
+
+    def __init__(self, **options):
+        super(LocMemListingCache, self).__init__(**options)
+        self.max_entries = options.get('MAX_ENTRIES', 1024)
+        self.ttl = options.get('TTL', 30)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != self.invalidations:
+                return
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, path):
+        with self._lock:
+            self.invalidations += 1
+            stale = [key for key in self._entries
+                     if key[1].startswith(path) or path.startswith(key[1])]
+            for key in stale:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += 1
+            self._entries.clear()
+
+    def stats(self):
+        stats = super(LocMemListingCache, self).stats()
+        stats['entries'] = len(self._entries)
+        return stats
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(setting_name, default_backend='uploadedfiles.s3_cache.LocMemListingCache'):
+    """
+    Return the process-wide cache configured by the <setting_name> setting (a
+    dictionary with the BACKEND class path and its options), or None if the setting
+    is not set or empty.
+    """
+    config = getattr(settings, setting_name, None)
+    if not config:
+        return None
+    if setting_name not in _caches:
+        with _caches_lock:
+            if setting_name not in _caches:
+                options = dict(config)
+                backend = import_string(options.pop('BACKEND', default_backend))
+                _caches[setting_name] = backend(**options)
+    return _caches[setting_name]
+
+
+def get_listing_cache():
+    """
+    Return the process-wide listing cache configured by the AWS_S3_LISTING_CACHE
+    setting, or None if caching is disabled.
+    """
+    return get_cache('AWS_S3_LISTING_CACHE')
+
+
+def get_negative_exists_cache():
+    """
+    Return the process-wide cache of the negative results of the existence checks
+    that is used when the listing cache is disabled. Its entries expire after
+    AWS_S3_EXISTS_NEGATIVE_TTL seconds.
+    """
+    if 'negative_exists' not in _caches:
+        with _caches_lock:
+            if 'negative_exists' not in _caches:
+                _caches['negative_exists'] = LocMemListingCache(
+                    MAX_ENTRIES=getattr(settings, 'AWS_S3_EXISTS_NEGATIVE_MAX_ENTRIES',
+                                        1024),
+                    TTL=getattr(settings, 'AWS_S3_EXISTS_NEGATIVE_TTL', 5))
+    return _caches['negative_exists']
+
+
+def get_presigned_url_cache():
+    """
+    Return the process-wide cache of presigned download URLs configured by the
+    AWS_S3_PRESIGNED_URL_CACHE setting, or None if caching is disabled.
+    """
+    return get_cache('AWS_S3_PRESIGNED_URL_CACHE')
+
+
+def get_disk_cache():
+    """
+    Return the process-wide local disk cache of downloaded objects configured by the
+    AWS_S3_DISK_CACHE setting, or None if it is disabled.
+    """
+    return get_cache('AWS_S3_DISK_CACHE', 'uploadedfiles.s3_disk_cache.DiskObjectCache')
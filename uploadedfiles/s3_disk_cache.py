@@ -0,0 +1,269 @@
+import datetime
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+
+# a cached object: its name, the headers of the GET response it was stored from, the
+# time it was last validated against S3 and the path of the file with its contents
+CachedObject = namedtuple('CachedObject', ['name', 'etag', 'size', 'content_type',
+                                           'content_encoding', 'last_modified',
+                                           'metadata', 'validated_at', 'path'])
+
+
+class DiskObjectCache(object):
+    """
+    Read-through cache of downloaded objects in a local directory that can be shared
+    by all the worker processes of a node.
+
+    Each entry is a data file with the object contents and a JSON file with the
+    headers it was downloaded with, both replaced atomically, so readers never see a
+    partial entry. Entries are guarded by a small fixed set of lock files (flock), so
+    that concurrent readers of an object in any process wait for a single download
+    instead of all fetching it. The cache is bounded by <MAX_BYTES>: when it grows
+    over it the least recently used entries (by the mtime of their data files, which
+    is refreshed on every hit) are evicted down to 90% of the budget.
+
+    Entries are served without contacting S3 for <REVALIDATE_AFTER> seconds after
+    they were last validated, and revalidated with a conditional GET (If-None-Match)
+    after that. Objects larger than <MAX_OBJECT_SIZE> are not cached.
+
+    Callers must hold lock(name) while they get, put, validate or open an entry.
+    """
+    lock_stripes = 256
+    low_watermark = 0.9
+
+    def __init__(self, **options):
+        self.directory = options['DIRECTORY']
+        self.max_bytes = options.get('MAX_BYTES', 10 * 1024 * 1024 * 1024)
+        self.max_object_size = options.get('MAX_OBJECT_SIZE', self.max_bytes // 4)
+        self.revalidate_after = options.get('REVALIDATE_AFTER', 0)
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(self.directory, 'locks'), exist_ok=True)
+
+    @staticmethod
+    def _hash(name):
+        return hashlib.sha256(name.encode('utf-8')).hexdigest()
+
+    def _paths(self, name_hash):
+        base = os.path.join(self.directory, name_hash[:2], name_hash)
+        return base + '.data', base + '.json'
+
+    @contextmanager
+    def _file_lock(self, lock_name, blocking=True):
+        lock_path = os.path.join(self.directory, 'locks', lock_name + '.lock')
+        with open(lock_path, 'a+b') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _hash_lock(self, name_hash, blocking=True):
+        return self._file_lock('%03d' % (int(name_hash[:2], 16) % self.lock_stripes),
+                               blocking)
+
+    @contextmanager
+    def lock(self, name):
+        """
+        Hold the lock of the entry of <name> (and of the other names in its stripe)
+        across threads and processes. The cache is trimmed to its budget, if needed,
+        once the lock is released.
+        """
+        with self._hash_lock(self._hash(name)):
+            yield
+        if self._size is None or self._size > self.max_bytes:
+            self.evict()
+
+    def get(self, name):
+        """
+        Return the CachedObject of <name> or None if it isn't cached.
+        """
+        data_path, meta_path = self._paths(self._hash(name))
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if os.path.getsize(data_path) != meta['size']:
+                return None
+        except (OSError, ValueError, KeyError):
+            return None
+        if meta.get('name') != name:
+            return None
+        return self._make_entry(meta, data_path)
+
+    @staticmethod
+    def _make_entry(meta, data_path):
+        last_modified = meta.get('last_modified')
+        if last_modified:
+            last_modified = datetime.datetime.fromisoformat(last_modified)
+        return CachedObject(meta['name'], meta['etag'], meta['size'],
+                            meta.get('content_type'), meta.get('content_encoding'),
+                            last_modified, meta.get('metadata', {}),
+                            meta['validated_at'], data_path)
+
+    def is_fresh(self, entry):
+        """
+        Return True if <entry> can be served without revalidating it.
+        """
+        return time.time() - entry.validated_at < self.revalidate_after
+
+    def put(self, name, response_object, chunk_size=1024 * 1024):
+        """
+        Store the body of a GET <response_object> for <name>, streaming it to disk.
+        Return the new CachedObject, or None (and leave the body unread) if the
+        object is too large to be cached.
+        """
+        size = response_object['ContentLength']
+        if size > self.max_object_size:
+            return None
+        name_hash = self._hash(name)
+        data_path, meta_path = self._paths(name_hash)
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        tmp_path = '%s.%s.%s.tmp' % (data_path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in response_object['Body'].iter_chunks(chunk_size):
+                    f.write(chunk)
+            try:
+                replaced = os.path.getsize(data_path)
+            except OSError:
+                replaced = 0
+            # an entry whose data was replaced but not its headers must not be served
+            self._remove(meta_path)
+            os.replace(tmp_path, data_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        last_modified = response_object.get('LastModified')
+        meta = {'name': name, 'etag': response_object['ETag'], 'size': size,
+                'content_type': response_object.get('ContentType'),
+                'content_encoding': response_object.get('ContentEncoding'),
+                'last_modified': last_modified.isoformat() if last_modified else None,
+                'metadata': response_object.get('Metadata', {}),
+                'validated_at': time.time()}
+        self._write_meta(meta_path, meta)
+        with self._lock:
+            self.misses += 1
+            if self._size is not None:
+                self._size += size - replaced
+        return self._make_entry(meta, data_path)
+
+    def mark_validated(self, entry):
+        """
+        Record that <entry> was found unchanged in S3 and return the updated entry.
+        """
+        data_path, meta_path = self._paths(self._hash(entry.name))
+        entry = entry._replace(validated_at=time.time())
+        meta = entry._asdict()
+        del meta['path']
+        if entry.last_modified:
+            meta['last_modified'] = entry.last_modified.isoformat()
+        self._write_meta(meta_path, meta)
+        with self._lock:
+            self.revalidations += 1
+        return entry
+
+    @staticmethod
+    def _write_meta(meta_path, meta):
+        tmp_path = '%s.%s.%s.tmp' % (meta_path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+    def open(self, entry, decompress=False, hit=True):
+        """
+        Open the data file of <entry> for reading, decompressing it as it is read if
+        <decompress> is True and it is gzip encoded, and mark it as recently used.
+        The file can be memory-mapped by the caller (when not decompressed). Pass
+        hit=False if the entry was just downloaded or revalidated.
+        """
+        os.utime(entry.path)
+        if hit:
+            with self._lock:
+                self.hits += 1
+        if decompress and entry.content_encoding == 'gzip':
+            return gzip.GzipFile(entry.path, 'rb')
+        return open(entry.path, 'rb')
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is under its low
+        watermark. Only one process evicts at a time and entries whose lock is held
+        are skipped. Temporary files abandoned by dead writers are removed as well.
+        """
+        with self._file_lock('evict', blocking=False) as locked:
+            if not locked:
+                return
+            entries = []
+            total = 0
+            now = time.time()
+            for subdir in os.scandir(self.directory):
+                if not subdir.is_dir() or subdir.name == 'locks':
+                    continue
+                for dir_entry in os.scandir(subdir.path):
+                    try:
+                        stat = dir_entry.stat()
+                    except OSError:
+                        continue
+                    if dir_entry.name.endswith('.tmp'):
+                        if now - stat.st_mtime > 24 * 3600:
+                            self._remove(dir_entry.path)
+                    elif dir_entry.name.endswith('.data'):
+                        entries.append((stat.st_mtime, stat.st_size,
+                                        dir_entry.name[:-len('.data')]))
+                        total += stat.st_size
+            if total > self.max_bytes:
+                entries.sort()
+                target = self.max_bytes * self.low_watermark
+                for mtime, size, name_hash in entries:
+                    if total <= target:
+                        break
+                    with self._hash_lock(name_hash, blocking=False) as entry_locked:
+                        if not entry_locked:
+                            continue
+                        for path in self._paths(name_hash):
+                            self._remove(path)
+                    total -= size
+                    with self._lock:
+                        self.evictions += 1
+            self._size = total
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """
+        Remove every entry.
+        """
+        max_bytes, self.max_bytes = self.max_bytes, -1
+        try:
+            self.evict()
+        finally:
+            self.max_bytes = max_bytes
+
+    def stats(self):
+        """
+        Return a dictionary with the cache counters.
+        """
+        return {'hits': self.hits, 'revalidations': self.revalidations,
+                'misses': self.misses, 'evictions': self.evictions}
@@ -0,0 +1,325 @@
+import datetime
+import hashlib
+import io
+import itertools
+import threading
+import time
+from bisect import bisect_left, insort
+
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+
+
+class FakeS3Client(object):
+    """
+    In-process, in-memory stand-in for the boto3 S3 client that implements the calls
+    made by PublicMediaStorage, for benchmarks and tests that must not depend on a
+    live S3 service.
+
+    Every request sleeps for <latency> seconds plus, if a <bandwidth> (bytes per
+    second) is set, the time it takes to transfer its object data. Sleeping releases
+    the GIL, so concurrent requests overlap as they would over the network. The
+    number of requests per API call is kept in <requests>.
+    """
+
+    def __init__(self, latency=0, bandwidth=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.requests = {}
+        self._objects = {}
+        self._keys = []
+        self._uploads = {}
+        self._upload_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _request(self, operation, nbytes=0):
+        with self._lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+        delay = self.latency
+        if self.bandwidth and nbytes:
+            delay += nbytes / self.bandwidth
+        if delay:
+            time.sleep(delay)
+
+    @staticmethod
+    def _error(code, status, operation, message=''):
+        return ClientError({'Error': {'Code': code, 'Message': message or code},
+                            'ResponseMetadata': {'HTTPStatusCode': status}}, operation)
+
+    @staticmethod
+    def _read_body(body):
+        if isinstance(body, (bytes, bytearray)):
+            return bytes(body)
+        if isinstance(body, str):
+            return body.encode('utf-8')
+        return body.read()
+
+    def put(self, key, data, **params):
+        """
+        Store an object without a request (no latency), eg. to set up a benchmark.
+        """
+        self._store(key, data, hashlib.md5(data).hexdigest(), params)
+
+    def _store(self, key, data, etag, params):
+        with self._lock:
+            if key not in self._objects:
+                insort(self._keys, key)
+            self._objects[key] = {
+                'Body': data, 'ETag': '"%s"' % etag,
+                'LastModified': datetime.datetime.now(datetime.timezone.utc),
+                'ContentType': params.get('ContentType', 'binary/octet-stream'),
+                'ContentEncoding': params.get('ContentEncoding'),
+                'Metadata': dict(params.get('Metadata', {}))}
+
+    def _remove(self, key):
+        with self._lock:
+            if self._objects.pop(key, None) is not None:
+                del self._keys[bisect_left(self._keys, key)]
+
+    def _get(self, key, operation, code='NoSuchKey'):
+        obj = self._objects.get(key)
+        if obj is None:
+            raise self._error(code, 404, operation)
+        return obj
+
+    @staticmethod
+    def _source_key(copy_source):
+        # the copy source is a {'Bucket': ..., 'Key': ...} dictionary or a
+        # 'bucket/key' string
+        if isinstance(copy_source, dict):
+            return copy_source['Key']
+        return copy_source.split('/', 1)[1]
+
+    def _object_headers(self, obj):
+        headers = {'ETag': obj['ETag'], 'LastModified': obj['LastModified'],
+                   'ContentType': obj['ContentType'], 'Metadata': dict(obj['Metadata'])}
+        if obj['ContentEncoding']:
+            headers['ContentEncoding'] = obj['ContentEncoding']
+        return headers
+
+    # bucket calls
+
+    def head_bucket(self, Bucket):
+        self._request('head_bucket')
+        return {}
+
+    def create_bucket(self, Bucket, **params):
+        self._request('create_bucket')
+        return {}
+
+    # object calls
+
+    def put_object(self, Bucket, Key, Body=b'', **params):
+        data = self._read_body(Body)
+        self._request('put_object', len(data))
+        self._store(Key, data, hashlib.md5(data).hexdigest(), params)
+        return {'ETag': self._objects[Key]['ETag']}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, **kwargs):
+        with open(Filename, 'rb') as f:
+            data = f.read()
+        self._request('upload_file', len(data))
+        self._store(Key, data, hashlib.md5(data).hexdigest(), ExtraArgs or {})
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, **kwargs):
+        data = self._read_body(Fileobj)
+        self._request('upload_fileobj', len(data))
+        self._store(Key, data, hashlib.md5(data).hexdigest(), ExtraArgs or {})
+
+    def head_object(self, Bucket, Key, **params):
+        self._request('head_object')
+        obj = self._get(Key, 'HeadObject', code='404')
+        return dict(self._object_headers(obj), ContentLength=len(obj['Body']))
+
+    def get_object(self, Bucket, Key, Range=None, IfNoneMatch=None, **params):
+        obj = self._get(Key, 'GetObject')
+        if IfNoneMatch is not None and IfNoneMatch == obj['ETag']:
+            self._request('get_object')
+            raise self._error('304', 304, 'GetObject', 'Not Modified')
+        data = obj['Body']
+        response = self._object_headers(obj)
+        if Range:
+            first, last = Range[len('bytes='):].split('-')
+            size = len(data)
+            if first == '':
+                first, last = max(size - int(last), 0), size - 1
+            else:
+                first = int(first)
+                last = min(int(last), size - 1) if last else size - 1
+            if first >= size:
+                self._request('get_object')
+                raise self._error('InvalidRange', 416, 'GetObject')
+            response['ContentRange'] = 'bytes %s-%s/%s' % (first, last, size)
+            data = data[first:last + 1]
+        self._request('get_object', len(data))
+        response.update({'Body': StreamingBody(io.BytesIO(data), len(data)),
+                         'ContentLength': len(data)})
+        return response
+
+    def copy_object(self, Bucket, Key, CopySource, MetadataDirective='COPY', **params):
+        self._request('copy_object')
+        source = self._get(self._source_key(CopySource), 'CopyObject')
+        if MetadataDirective != 'REPLACE':
+            params = {'ContentType': source['ContentType'],
+                      'ContentEncoding': source['ContentEncoding'],
+                      'Metadata': source['Metadata']}
+        self._store(Key, source['Body'], source['ETag'].strip('"'), params)
+        return {'CopyObjectResult': {'ETag': source['ETag']}}
+
+    def delete_object(self, Bucket, Key):
+        self._request('delete_object')
+        self._remove(Key)
+        return {}
+
+    def delete_objects(self, Bucket, Delete):
+        self._request('delete_objects')
+        deleted = []
+        for obj in Delete['Objects']:
+            self._remove(obj['Key'])
+            deleted.append({'Key': obj['Key']})
+        return {} if Delete.get('Quiet') else {'Deleted': deleted}
+
+    # listings
+
+    def _list(self, prefix, start, max_keys, delimiter=None):
+        """
+        Return the (entries, next start key) of a listing page, where entries are
+        the keys and common prefixes with <prefix> from the <start> key on.
+        """
+        entries = []
+        with self._lock:
+            i = bisect_left(self._keys, max(start, prefix))
+            while i < len(self._keys) and len(entries) < max_keys:
+                key = self._keys[i]
+                if not key.startswith(prefix):
+                    break
+                cut = key.find(delimiter, len(prefix)) if delimiter else -1
+                if cut != -1:
+                    common_prefix = key[:cut + len(delimiter)]
+                    entries.append((common_prefix, None))
+                    # skip the rest of the keys under the common prefix
+                    i = bisect_left(self._keys, common_prefix + '\U0010ffff')
+                    continue
+                entries.append((key, self._objects[key]))
+                i += 1
+            truncated = i < len(self._keys) and self._keys[i].startswith(prefix)
+            next_start = self._keys[i] if truncated else None
+        return entries, next_start
+
+    @staticmethod
+    def _list_response(entries, next_start, max_keys):
+        response = {'IsTruncated': next_start is not None, 'MaxKeys': max_keys}
+        contents = [{'Key': key, 'Size': len(obj['Body']), 'ETag': obj['ETag'],
+                     'LastModified': obj['LastModified']}
+                    for key, obj in entries if obj is not None]
+        common_prefixes = [{'Prefix': key} for key, obj in entries if obj is None]
+        if contents:
+            response['Contents'] = contents
+        if common_prefixes:
+            response['CommonPrefixes'] = common_prefixes
+        return response
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, MaxKeys=1000,
+                        ContinuationToken=None, StartAfter='', **params):
+        self._request('list_objects_v2')
+        start = ContinuationToken or (StartAfter + '\x00' if StartAfter else '')
+        entries, next_start = self._list(Prefix, start, MaxKeys, Delimiter)
+        response = self._list_response(entries, next_start, MaxKeys)
+        response['KeyCount'] = len(entries)
+        if next_start is not None:
+            response['NextContinuationToken'] = next_start
+        return response
+
+    def list_objects(self, Bucket, Prefix='', Delimiter=None, MaxKeys=1000, Marker='',
+                     **params):
+        self._request('list_objects')
+        start = Marker + '\x00' if Marker else ''
+        entries, next_start = self._list(Prefix, start, MaxKeys, Delimiter)
+        return self._list_response(entries, next_start, MaxKeys)
+
+    # multipart uploads
+
+    def create_multipart_upload(self, Bucket, Key, **params):
+        self._request('create_multipart_upload')
+        upload_id = 'upload-%s' % next(self._upload_ids)
+        with self._lock:
+            self._uploads[upload_id] = {
+                'Key': Key, 'Parts': {}, 'params': params,
+                'Initiated': datetime.datetime.now(datetime.timezone.utc)}
+        return {'UploadId': upload_id}
+
+    def _get_upload(self, upload_id, operation):
+        upload = self._uploads.get(upload_id)
+        if upload is None:
+            raise self._error('NoSuchUpload', 404, operation)
+        return upload
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **params):
+        data = self._read_body(Body)
+        self._request('upload_part', len(data))
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        self._get_upload(UploadId, 'UploadPart')['Parts'][PartNumber] = (data, etag)
+        return {'ETag': etag}
+
+    def upload_part_copy(self, Bucket, Key, UploadId, PartNumber, CopySource,
+                         CopySourceRange=None, **params):
+        self._request('upload_part_copy')
+        data = self._get(self._source_key(CopySource), 'UploadPartCopy')['Body']
+        if CopySourceRange:
+            first, last = (int(offset) for offset in
+                           CopySourceRange[len('bytes='):].split('-'))
+            # unlike GetObject ranges, copy ranges must be within the source object
+            if first > last or last >= len(data):
+                raise self._error('InvalidRange', 416, 'UploadPartCopy')
+            data = data[first:last + 1]
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        self._get_upload(UploadId, 'UploadPartCopy')['Parts'][PartNumber] = (data, etag)
+        return {'CopyPartResult': {'ETag': etag}}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._request('complete_multipart_upload')
+        upload = self._get_upload(UploadId, 'CompleteMultipartUpload')
+        parts = []
+        for part in MultipartUpload['Parts']:
+            stored = upload['Parts'].get(part['PartNumber'])
+            if stored is None or stored[1] != part['ETag']:
+                raise self._error('InvalidPart', 400, 'CompleteMultipartUpload')
+            parts.append(stored)
+        digests = b''.join(bytes.fromhex(etag.strip('"')) for data, etag in parts)
+        etag = '%s-%s' % (hashlib.md5(digests).hexdigest(), len(parts))
+        self._store(Key, b''.join(data for data, etag in parts), etag, upload['params'])
+        with self._lock:
+            del self._uploads[UploadId]
+        return {'ETag': '"%s"' % etag}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._request('abort_multipart_upload')
+        with self._lock:
+            self._uploads.pop(UploadId, None)
+        return {}
+
+    def list_parts(self, Bucket, Key, UploadId, **params):
+        self._request('list_parts')
+        upload = self._get_upload(UploadId, 'ListParts')
+        return {'IsTruncated': False,
+                'Parts': [{'PartNumber': number, 'ETag': etag, 'Size': len(data)}
+                          for number, (data, etag) in sorted(upload['Parts'].items())]}
+
+    def list_multipart_uploads(self, Bucket, Prefix='', **params):
+        self._request('list_multipart_uploads')
+        with self._lock:
+            uploads = [{'Key': upload['Key'], 'UploadId': upload_id,
+                        'Initiated': upload['Initiated']}
+                       for upload_id, upload in self._uploads.items()
+                       if upload['Key'].startswith(Prefix)]
+        return {'IsTruncated': False, 'Uploads': uploads}
+
+    # presigned requests are signed locally by the real client, so they don't count
+
+    def generate_presigned_url(self, ClientMethod, Params=None, ExpiresIn=3600, **kwargs):
+        return 'http://fake-s3/%s/%s?method=%s&expires=%s' % (
+            Params['Bucket'], Params['Key'], ClientMethod, ExpiresIn)
+
+    def generate_presigned_post(self, Bucket, Key, Fields=None, Conditions=None,
+                                ExpiresIn=3600):
+        return {'url': 'http://fake-s3/%s' % Bucket, 'fields': dict(Fields or {}, key=Key)}
@@ -0,0 +1,249 @@
+import functools
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+
+from .s3_cache import get_disk_cache, get_listing_cache, get_presigned_url_cache
+from .s3_retry import get_retry_policy
+
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def format_labels(labelnames, labelvalues):
+    """
+    Return the Prometheus text format of a set of labels ('' if there are none).
+    """
+    if not labelnames:
+        return ''
+    pairs = []
+    for name, value in zip(labelnames, labelvalues):
+        value = str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+        pairs.append('%s="%s"' % (name, value))
+    return '{%s}' % ','.join(pairs)
+
+
+def format_value(value):
+    """
+    Return the Prometheus text format of a sample value.
+    """
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """
+    Base class for the metrics of the storage layer. Values are kept per tuple of
+    label values, in the order of <labelnames>, and are updated under a lock so
+    that the storage threads can record them concurrently.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """
+        Return a list of (sample name, label values, value) tuples.
+        """
+        raise NotImplementedError
+
+    def render(self):
+        """
+        Return the Prometheus text format of the metric.
+        """
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for name, labelnames, labelvalues, value in self.samples():
+            lines.append('%s%s %s' % (name, format_labels(labelnames, labelvalues),
+                                      format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """
+    A monotonically increasing count.
+    """
+    type = 'counter'
+
+    def inc(self, amount=1, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def get(self, *labelvalues):
+        return self._values.get(labelvalues, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(self.name, self.labelnames, labelvalues, value)
+                for labelvalues, value in values]
+
+
+class Histogram(Metric):
+    """
+    A distribution of observed values (eg. latencies) counted in buckets of
+    increasing upper bounds, plus the sum and count of the observations.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labelvalues)
+            if entry is None:
+                # per-bucket counts (the last one is +Inf), sum, count
+                entry = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def get_count(self, *labelvalues):
+        entry = self._values.get(labelvalues)
+        return entry[2] if entry is not None else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labelvalues, (list(entry[0]), entry[1], entry[2]))
+                            for labelvalues, entry in self._values.items())
+        bucket_labelnames = self.labelnames + ('le',)
+        samples = []
+        for labelvalues, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                samples.append(('%s_bucket' % self.name, bucket_labelnames,
+                                labelvalues + (format_value(float(bound)),), cumulative))
+            samples.append(('%s_sum' % self.name, self.labelnames, labelvalues, total))
+            samples.append(('%s_count' % self.name, self.labelnames, labelvalues, count))
+        return samples
+
+
+class StorageMetrics(object):
+    """
+    The metrics recorded by PublicMediaStorage: the latency and errors of its
+    operations, the latency, count and errors of the S3 API requests they send and
+    the bytes sent to and received from S3. The counters of the retry policy and of
+    the storage caches are reported along with them.
+    """
+
+    def __init__(self, prefix='chris_storage'):
+        self.operation_duration = Histogram(
+            '%s_operation_duration_seconds' % prefix,
+            'Duration of the storage operations.', ('operation',))
+        self.operation_errors = Counter(
+            '%s_operation_errors_total' % prefix,
+            'Storage operations that raised an exception.', ('operation',))
+        self.request_duration = Histogram(
+            '%s_s3_request_duration_seconds' % prefix,
+            'Duration of the S3 API requests, one per attempt.', ('api_call',))
+        self.request_errors = Counter(
+            '%s_s3_request_errors_total' % prefix,
+            'S3 API requests that failed, by error code.', ('api_call', 'code'))
+        self.transferred_bytes = Counter(
+            '%s_transferred_bytes_total' % prefix,
+            'Bytes of object data sent to or received from S3.', ('direction',))
+        self.prefix = prefix
+
+    def record_operation(self, operation, duration, failed=False):
+        self.operation_duration.observe(duration, operation)
+        if failed:
+            self.operation_errors.inc(1, operation)
+
+    def record_request(self, api_call, duration, error=None):
+        self.request_duration.observe(duration, api_call)
+        if error is not None:
+            code = getattr(error, 'response', {}).get('Error', {}).get('Code')
+            self.request_errors.inc(1, api_call, code or type(error).__name__)
+
+    def record_bytes(self, direction, nbytes):
+        if nbytes:
+            self.transferred_bytes.inc(nbytes, direction)
+
+    def render(self):
+        """
+        Return all the metrics in the Prometheus text exposition format.
+        """
+        blocks = [metric.render() for metric in (
+            self.operation_duration, self.operation_errors, self.request_duration,
+            self.request_errors, self.transferred_bytes)]
+        retry_events = Counter('%s_retry_events_total' % self.prefix,
+                               'Calls, retries and failures of the S3 retry policy.',
+                               ('event',))
+        stats = get_retry_policy().stats()
+        quota_tokens = stats.pop('quota_tokens')
+        for event, value in sorted(stats.items()):
+            retry_events.inc(value, event)
+        blocks.append(retry_events.render())
+        blocks.append('# HELP %s_retry_quota_tokens Tokens left in the retry quota.\n'
+                      '# TYPE %s_retry_quota_tokens gauge\n'
+                      '%s_retry_quota_tokens %s' % (self.prefix, self.prefix, self.prefix,
+                                                    format_value(quota_tokens)))
+        cache_events = Counter('%s_cache_events_total' % self.prefix,
+                               'Hits, misses, invalidations and evictions of the storage caches.',
+                               ('cache', 'event'))
+        for cache_name, cache in (('listing', get_listing_cache()),
+                                  ('presigned_url', get_presigned_url_cache()),
+                                  ('disk', get_disk_cache())):
+            if cache is not None:
+                for event, value in sorted(cache.stats().items()):
+                    if event != 'entries':
+                        cache_events.inc(value, cache_name, event)
+        blocks.append(cache_events.render())
+        return '\n'.join(blocks) + '\n'
+
+
+_storage_metrics = None
+_storage_metrics_lock = threading.Lock()
+
+
+def get_storage_metrics():
+    """
+    Return the process-wide storage metrics, or None if they are disabled by the
+    AWS_S3_METRICS setting.
+    """
+    global _storage_metrics
+    if not getattr(settings, 'AWS_S3_METRICS', True):
+        return None
+    if _storage_metrics is None:
+        with _storage_metrics_lock:
+            if _storage_metrics is None:
+                _storage_metrics = StorageMetrics()
+    return _storage_metrics
+
+
+def instrumented(operation):
+    """
+    Decorator that records the duration and failures of a storage method in the
+    storage metrics under the <operation> name.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            metrics = get_storage_metrics()
+            if metrics is None:
+                return method(*args, **kwargs)
+            start = time.monotonic()
+            failed = True
+            try:
+                result = method(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                metrics.record_operation(operation, time.monotonic() - start, failed)
+        return wrapper
+    return decorator
@@ -0,0 +1,182 @@
+import logging
+import random
+import threading
+import time
+
+from botocore.exceptions import (ClientError, ConnectionError, HTTPClientError,
+                                 ReadTimeoutError)
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+# error codes S3 answers with when the request rate on a prefix or bucket is too high
+THROTTLING_ERROR_CODES = frozenset([
+    'SlowDown', 'Throttling', 'ThrottlingException', 'RequestThrottled',
+    'RequestLimitExceeded', 'TooManyRequestsException', 'BandwidthLimitExceeded',
+    '429', '503',
+])
+
+# error codes of failures that are likely to succeed when the request is sent again
+TRANSIENT_ERROR_CODES = frozenset([
+    'RequestTimeout', 'RequestTimeoutException', 'PriorRequestNotComplete',
+    'InternalError', 'ServiceUnavailable', '500', '502', '504',
+])
+
+THROTTLE = 'throttle'
+TRANSIENT = 'transient'
+
+
+def classify_error(error):
+    """
+    Return THROTTLE or TRANSIENT if the exception raised by a boto3 call is worth
+    retrying, or None otherwise. Wrapping exceptions (eg. boto3's S3UploadFailedError)
+    are classified by the error they were raised from.
+    """
+    while error is not None:
+        if isinstance(error, ClientError):
+            code = error.response.get('Error', {}).get('Code')
+            if code is None or code.isdigit():
+                status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+                code = str(status) if status else code
+            if code in THROTTLING_ERROR_CODES:
+                return THROTTLE
+            if code in TRANSIENT_ERROR_CODES:
+                return TRANSIENT
+            return None
+        if isinstance(error, (ConnectionError, HTTPClientError, ReadTimeoutError)):
+            return TRANSIENT
+        error = error.__cause__ or error.__context__
+    return None
+
+
+class RetryQuota(object):
+    """
+    Client-side token bucket shared by all the storage operations of a process. Every
+    retry spends tokens and every successful call gives a token back, so when the
+    bucket is throttled or unavailable the quota runs out and further failures are
+    raised at once instead of adding retry traffic.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.tokens = capacity
+        self._lock = threading.Lock()
+
+    def acquire(self, cost):
+        """
+        Spend <cost> tokens and return True, or return False if there aren't enough.
+        """
+        with self._lock:
+            if cost > self.tokens:
+                return False
+            self.tokens -= cost
+            return True
+
+    def release(self, amount):
+        """
+        Give <amount> tokens back, up to the bucket capacity.
+        """
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RetryPolicy(object):
+    """
+    Retry boto3 calls that fail with throttling or transient errors, with capped
+    exponential backoff and full jitter, within an overall deadline per call and the
+    budget of a shared RetryQuota.
+    """
+    retry_cost = 5
+    throttle_cost = 10
+    success_refund = 1
+
+    def __init__(self, max_attempts=5, base_delay=0.1, max_delay=20, deadline=60,
+                 quota=500):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.quota = RetryQuota(quota)
+        self.counters = {'calls': 0, 'retries': 0, 'throttles': 0, 'failures': 0,
+                         'quota_exhausted': 0}
+        self._lock = threading.Lock()
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call <func> with the provided arguments, retrying it as needed.
+        """
+        self._count('calls')
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                kind = classify_error(e)
+                if kind == THROTTLE:
+                    self._count('throttles')
+                delay = self.get_delay(attempt)
+                if kind is None or not self._can_retry(kind, attempt,
+                                                       time.monotonic() + delay <= deadline):
+                    self._count('failures')
+                    raise
+                self._count('retries')
+                logger.warning('Retrying %s in %.2fs after attempt %s failed: %s',
+                               getattr(func, '__name__', func), delay, attempt, str(e))
+                time.sleep(delay)
+            else:
+                self.quota.release(self.success_refund)
+                return result
+
+    def get_delay(self, attempt):
+        """
+        Return a random backoff delay between 0 and the capped exponential delay for
+        the failed <attempt> ("full jitter"), which keeps retries from many clients
+        from arriving in synchronized waves.
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def stats(self):
+        """
+        Return a dictionary with the retry counters and the tokens left in the quota.
+        """
+        with self._lock:
+            stats = dict(self.counters)
+        stats['quota_tokens'] = self.quota.tokens
+        return stats
+
+    def _can_retry(self, kind, attempt, within_deadline):
+        if attempt >= self.max_attempts or not within_deadline:
+            return False
+        cost = self.throttle_cost if kind == THROTTLE else self.retry_cost
+        if not self.quota.acquire(cost):
+            self._count('quota_exhausted')
+            return False
+        return True
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+
+_retry_policy = None
+_retry_policy_lock = threading.Lock()
+
+
+def get_retry_policy():
+    """
+    Return the process-wide retry policy configured by the AWS_S3_RETRY_* settings.
+    """
+    global _retry_policy
+    if _retry_policy is None:
+        with _retry_policy_lock:
+            if _retry_policy is None:
+                _retry_policy = RetryPolicy(
+                    max_attempts=getattr(settings, 'AWS_S3_RETRY_MAX_ATTEMPTS', 5),
+                    base_delay=getattr(settings, 'AWS_S3_RETRY_BASE_DELAY', 0.1),
+                    max_delay=getattr(settings, 'AWS_S3_RETRY_MAX_DELAY', 20),
+                    deadline=getattr(settings, 'AWS_S3_RETRY_DEADLINE', 60),
+                    quota=getattr(settings, 'AWS_S3_RETRY_QUOTA', 500))
+    return _retry_policy
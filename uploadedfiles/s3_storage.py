@@ -1,15 +1,286 @@
 import boto3
 import botocore
+from boto3.exceptions import S3UploadFailedError
 from botocore.client import BaseClient
+from botocore.exceptions import BotoCoreError, ClientError
 from storages.backends.s3boto3 import S3Boto3Storage
 from django.conf import settings
+from django.core.files.base import File
+from django.utils.module_loading import import_string
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import datetime
+import gzip
+import hashlib
+import itertools
+import json
 import logging
+import mimetypes
 import os
+import tempfile
+import threading
 import time
-from swiftclient.exceptions import ClientException
+import zlib
+
+from .s3_cache import (get_disk_cache, get_listing_cache, get_negative_exists_cache,
+                       get_presigned_url_cache)
+from .s3_metrics import get_storage_metrics, instrumented
+from .s3_retry import get_retry_policy
 
 logger = logging.getLogger(__name__)
 
+# S3 rejects multipart upload parts smaller than this, except for the last one
+MULTIPART_MIN_PART_SIZE = 5 * 1024 * 1024
+# and multipart uploads with more parts than this
+MULTIPART_MAX_PARTS = 10000
+
+# S3 accepts at most this many keys in a multi-object delete request
+DELETE_BATCH_SIZE = 1000
+
+# object parameters that a server-side copy doesn't carry over from its source
+COPY_OBJECT_PARAMETERS = ('ACL', 'GrantFullControl', 'GrantRead', 'GrantReadACP',
+                          'GrantWriteACP', 'StorageClass', 'ServerSideEncryption',
+                          'SSEKMSKeyId')
+
+# lightweight record for one entry of a storage listing
+S3ObjectInfo = namedtuple('S3ObjectInfo', ['key', 'size', 'etag', 'mtime'])
+
+S3ObjectMetadata = namedtuple('S3ObjectMetadata',
+                              ['key', 'size', 'etag', 'content_type', 'mtime'])
+
+# request parameter -> response field of the pagination tokens of listing operations
+PAGINATION_TOKENS = {
+    'list_objects_v2': {'ContinuationToken': 'NextContinuationToken'},
+    'list_multipart_uploads': {'KeyMarker': 'NextKeyMarker',
+                               'UploadIdMarker': 'NextUploadIdMarker'},
+    'list_parts': {'PartNumberMarker': 'NextPartNumberMarker'},
+}
+
+
+def key_before(key):
+    """
+    Return a key that sorts just before <key> (in the UTF-8 binary order S3 lists keys
+    in, which is the order of Python strings), to list keys from <key> on with
+    StartAfter. Only keys that start with the returned key followed by the highest
+    code point can sort between the two.
+    """
+    if not key:
+        return ''
+    if key[-1] == '\x00':
+        return key[:-1]
+    return key[:-1] + chr(ord(key[-1]) - 1) + '\U0010ffff'
+
+
+class ByteBudget(object):
+    """
+    Bound the number of bytes that are being transferred at the same time.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes):
+        """
+        Block until <nbytes> fit in the budget. A single request larger than the
+        whole budget is let through once nothing else is in flight.
+        """
+        with self._cond:
+            while self.in_flight and self.in_flight + nbytes > self.max_bytes:
+                self._cond.wait()
+            self.in_flight += nbytes
+
+    def release(self, nbytes):
+        """
+        Give <nbytes> back to the budget.
+        """
+        with self._cond:
+            self.in_flight -= nbytes
+            self._cond.notify_all()
+
+
+class S3ObjectStream(object):
+    """
+    File-like, iterable view over the body of an s3 object that is fetched from
+    the network one chunk at a time.
+
+    If <decompress> is True the body of a gzip-encoded object (see the compression
+    settings of PublicMediaStorage) is decompressed as it is read, in which case
+    content_encoding is None, content_length is the uncompressed size recorded in
+    the object's metadata (None if there is none) and decompressed is True.
+    """
+
+    def __init__(self, response_object, chunk_size, decompress=False):
+        self.content_length = response_object['ContentLength']
+        self.content_type = response_object.get('ContentType')
+        self.content_encoding = response_object.get('ContentEncoding')
+        self.content_range = response_object.get('ContentRange')
+        self.etag = response_object.get('ETag')
+        self.last_modified = response_object.get('LastModified')
+        self.metadata = response_object.get('Metadata', {})
+        self.chunk_size = chunk_size
+        self._body = response_object['Body']
+        self._decompressor = None
+        if decompress and self.content_encoding == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            size = self.metadata.get('uncompressed-size')
+            self.content_length = int(size) if size is not None else None
+            self.content_encoding = None
+        self.decompressed = self._decompressor is not None
+        self._buffer = b''
+
+    def __iter__(self):
+        try:
+            for chunk in self._body.iter_chunks(self.chunk_size):
+                if self._decompressor is not None:
+                    chunk = self._decompressor.decompress(chunk)
+                if chunk:
+                    yield chunk
+            if self._decompressor is not None:
+                chunk = self._decompressor.flush()
+                if chunk:
+                    yield chunk
+        finally:
+            self.close()
+
+    def read(self, amt=None):
+        if self._decompressor is None:
+            return self._body.read(amt)
+        while amt is None or len(self._buffer) < amt:
+            chunk = self._body.read(self.chunk_size)
+            if not chunk:
+                self._buffer += self._decompressor.flush()
+                break
+            self._buffer += self._decompressor.decompress(chunk)
+        if amt is None:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    def close(self):
+        self._body.close()
+
+
+class HashedIterator(object):
+    """
+    Iterator over the chunks of an iterator or non-seekable file-like object that
+    feeds them to a hash object and counts their bytes as they are consumed.
+    """
+
+    def __init__(self, contents, hash_obj, chunk_size=1024 * 1024):
+        if hasattr(contents, 'read'):
+            read = contents.read
+            contents = iter(lambda: read(chunk_size), read(0))
+        self._chunks = iter(contents)
+        self.hash_obj = hash_obj
+        self.size = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = next(self._chunks)
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        self.hash_obj.update(chunk)
+        self.size += len(chunk)
+        return chunk
+
+
+_s3_client = None
+_s3_resource = None
+_s3_client_lock = threading.Lock()
+_bucket_ready = False
+_bucket_lock = threading.Lock()
+
+
+def get_s3_client():
+    """
+    Return the S3 client shared by all the threads and storage instances of this
+    process, creating it on first use. boto3 clients are thread-safe and keep a pool
+    of up to AWS_S3_MAX_POOL_CONNECTIONS persistent connections, so sharing one avoids
+    a new session, client and TCP/TLS handshake per storage instance.
+    """
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                config_options = {
+                    # The next option is only required because my provider only offers "version 2"
+                    # authentication protocol. Otherwise this would be 's3v4' (the default, version 4).
+                    'signature_version': 's3',
+                    'max_pool_connections': getattr(settings, 'AWS_S3_MAX_POOL_CONNECTIONS', 64),
+                    # retries are done by the storage's own retry policy (see s3_retry)
+                    'retries': {'total_max_attempts': 1},
+                }
+                if getattr(settings, 'AWS_S3_TCP_KEEPALIVE', False):
+                    if 'tcp_keepalive' in botocore.client.Config.OPTION_DEFAULTS:
+                        config_options['tcp_keepalive'] = True
+                    else:
+                        logger.warning('This botocore version only reads tcp_keepalive '
+                                       'from the shared AWS config file')
+                # boto3 sessions are not thread-safe, hence the lock
+                session = boto3.session.Session()
+                _s3_client = session.client(
+                    service_name='s3',
+                    aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                    endpoint_url=settings.AWS_S3_ENDPOINT_URL,
+                    config=botocore.client.Config(**config_options),
+                )
+    return _s3_client
+
+
+def get_s3_resource():
+    """
+    Return an S3 resource on the shared client (see get_s3_client), for the code of
+    S3Boto3Storage that goes through resources (eg. FileField saves, size and url),
+    so that it doesn't build its own session, client and connection pool per storage
+    instance and thread.
+    """
+    global _s3_resource
+    if _s3_resource is None:
+        client = get_s3_client()
+        with _s3_client_lock:
+            if _s3_resource is None:
+                resource = boto3.session.Session().resource(
+                    's3',
+                    aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                    endpoint_url=settings.AWS_S3_ENDPOINT_URL,
+                )
+                # the client the resource was created with is never used
+                resource.meta.client = client
+                _s3_resource = resource
+    return _s3_resource
+
+
+def ensure_bucket():
+    """
+    Verify that the storage bucket exists and create it otherwise. This only talks to
+    S3 the first time it is called in a process; it runs at startup (see
+    UploadedfilesConfig.ready) so that requests never pay for it.
+    """
+    global _bucket_ready
+    if _bucket_ready:
+        return
+    with _bucket_lock:
+        if _bucket_ready:
+            return
+        conn = get_s3_client()
+        retry_policy = get_retry_policy()
+        bucket = settings.AWS_STORAGE_BUCKET_NAME
+        try:
+            retry_policy.call(conn.head_bucket, Bucket=bucket)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchBucket'):
+                raise
+            retry_policy.call(conn.create_bucket, Bucket=bucket)
+        _bucket_ready = True
+
+
 class PublicMediaStorage(S3Boto3Storage):
 
     location = settings.AWS_PUBLIC_MEDIA_LOCATION
@@ -17,181 +288,1272 @@ class PublicMediaStorage(S3Boto3Storage):
     default_acl = 'public-read-write'
     container_name = None
     conn_params = None
-    _boto_session = None
-    _boto_client = None
+    download_chunk_size = getattr(settings, 'AWS_S3_DOWNLOAD_CHUNK_SIZE', 1024 * 1024)
+    multipart_threshold = getattr(settings, 'AWS_S3_MULTIPART_THRESHOLD', 64 * 1024 * 1024)
+    multipart_chunksize = getattr(settings, 'AWS_S3_MULTIPART_CHUNKSIZE', 16 * 1024 * 1024)
+    multipart_max_workers = getattr(settings, 'AWS_S3_MULTIPART_MAX_WORKERS', 4)
+    copy_max_workers = getattr(settings, 'AWS_S3_COPY_MAX_WORKERS', 8)
+    multipart_copy_threshold = getattr(settings, 'AWS_S3_MULTIPART_COPY_THRESHOLD',
+                                       1024 * 1024 * 1024)
+    multipart_copy_chunksize = getattr(settings, 'AWS_S3_MULTIPART_COPY_CHUNKSIZE',
+                                       256 * 1024 * 1024)
+    delete_max_workers = getattr(settings, 'AWS_S3_DELETE_MAX_WORKERS', 4)
+    listing_cache_max_keys = getattr(settings, 'AWS_S3_LISTING_CACHE_MAX_KEYS', 10000)
+    exists_max_workers = getattr(settings, 'AWS_S3_EXISTS_MAX_WORKERS', 16)
+    exists_list_min_keys = getattr(settings, 'AWS_S3_EXISTS_LIST_MIN_KEYS', 32)
+    exists_negative_ttl = getattr(settings, 'AWS_S3_EXISTS_NEGATIVE_TTL', 5)
+    upload_max_workers = getattr(settings, 'AWS_S3_UPLOAD_MAX_WORKERS', 8)
+    dedup = getattr(settings, 'AWS_S3_DEDUP', False)
+    dedup_index = getattr(settings, 'AWS_S3_DEDUP_INDEX',
+                          'uploadedfiles.dedup.ContentDigestIndex')
+    dedup_min_size = getattr(settings, 'AWS_S3_DEDUP_MIN_SIZE', 1024 * 1024)
+    compress = getattr(settings, 'AWS_S3_COMPRESS', False)
+    compress_content_types = getattr(settings, 'AWS_S3_COMPRESS_CONTENT_TYPES', (
+        'text/plain', 'text/csv', 'text/tab-separated-values', 'application/json',
+        'application/xml', 'text/xml'))
+    compress_extensions = getattr(settings, 'AWS_S3_COMPRESS_EXTENSIONS', (
+        '.csv', '.tsv', '.json', '.txt', '.log', '.xml', '.nii', '.hdr'))
+    compress_min_size = getattr(settings, 'AWS_S3_COMPRESS_MIN_SIZE', 4096)
+    compress_level = getattr(settings, 'AWS_S3_COMPRESS_LEVEL', 6)
+    archive_read_ahead = getattr(settings, 'AWS_S3_ARCHIVE_READ_AHEAD', 4)
+    download_max_workers = getattr(settings, 'AWS_S3_DOWNLOAD_MAX_WORKERS', 8)
+    multipart_download_threshold = getattr(settings, 'AWS_S3_MULTIPART_DOWNLOAD_THRESHOLD',
+                                           64 * 1024 * 1024)
+    multipart_download_chunksize = getattr(settings, 'AWS_S3_MULTIPART_DOWNLOAD_CHUNKSIZE',
+                                           16 * 1024 * 1024)
+    multipart_download_max_workers = getattr(settings,
+                                             'AWS_S3_MULTIPART_DOWNLOAD_MAX_WORKERS', 4)
+    presigned_url_expiry = getattr(settings, 'AWS_S3_PRESIGNED_URL_EXPIRY', 300)
+    presigned_url_min_ttl = getattr(settings, 'AWS_S3_PRESIGNED_URL_MIN_TTL', 60)
+    presigned_upload_expiry = getattr(settings, 'AWS_S3_PRESIGNED_UPLOAD_EXPIRY', 3600)
+    presigned_upload_max_size = getattr(settings, 'AWS_S3_PRESIGNED_UPLOAD_MAX_SIZE',
+                                        5 * 1024 * 1024 * 1024)
+    upload_max_bytes_in_flight = getattr(settings, 'AWS_S3_UPLOAD_MAX_BYTES_IN_FLIGHT',
+                                         256 * 1024 * 1024)
+
+    def __init__(self, **kwargs):
+        super(PublicMediaStorage, self).__init__(**kwargs)
+        # the bucket name is passed to the requests before the client is fetched
+        self.initialize()
 
     def initialize(self):
         if self.container_name is not None:
             return
         self.container_name = settings.AWS_STORAGE_BUCKET_NAME
         self.conn_params = settings.AWS_S3_OBJECT_PARAMETERS
-        # swift storage connection object
-        self.create_container()
 
-    def get_connection(self):
+    @property
+    def connection(self):
         """
-        Connect to s3 storage and return the connection object.
+        Overriden to return the S3 resource on the client shared by all the storage
+        instances of this process.
         """
-        self.initialize();
-        if self._boto_client is not None:
-            return self._boto_client
-        self._boto_session = boto3.session.Session()
-        for i in range(5):  # 5 retries at most
-            try:
+        return get_s3_resource()
 
-                self._boto_client = self._boto_session.client(
-                    service_name='s3',
-                    aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                    aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                    endpoint_url=settings.AWS_S3_ENDPOINT_URL,
-                    # The next option is only required because my provider only offers "version 2"
-                    # authentication protocol. Otherwise this would be 's3v4' (the default, version 4).
-                    config=botocore.client.Config(signature_version='s3'),
-                )
-            except ClientException as e:
-                logger.error(str(e))
-                if i == 4:
-                    raise  # give up
-                time.sleep(0.4)
-            else:
-                return self._boto_client
+    def get_connection(self):
+        """
+        Return the S3 client shared by all the storage instances of this process.
+        """
+        self.initialize()
+        return get_s3_client()
 
     def create_container(self):
         """
-        Create the storage container.
+        Create the storage container if it doesn't exist yet.
         """
-        conn = self.get_connection()
+        ensure_bucket()
+
+    def _call(self, operation, **params):
+        """
+        Call the S3 client method <operation> through the process-wide retry policy.
+        A file-like Body (or Fileobj) is rewound before every attempt.
+        """
+        body = params.get('Body', params.get('Fileobj'))
+        position = None
+        if hasattr(body, 'seek') and hasattr(body, 'tell'):
+            position = body.tell()
+
+        def attempt():
+            if position is not None:
+                body.seek(position)
+            return self._request(operation, **params)
+
+        # the retry log messages name the retried call
+        attempt.__name__ = operation
+        return get_retry_policy().call(attempt)
+
+    def _request(self, operation, **params):
+        """
+        Call the S3 client method <operation> once, recording its duration, errors
+        and the object bytes it transfers in the storage metrics.
+        """
+        method = getattr(self.get_connection(), operation)
+        metrics = get_storage_metrics()
+        if metrics is None:
+            return method(**params)
+        sent = 0
+        if operation in ('put_object', 'upload_part'):
+            sent = self._get_content_size(params['Body']) or 0
+        elif operation == 'upload_fileobj':
+            sent = self._get_content_size(params['Fileobj']) or 0
+        elif operation == 'upload_file':
+            sent = os.path.getsize(params['Filename'])
+        start = time.monotonic()
         try:
-            conn.create_bucket(Bucket=self.container_name)
-        except ClientException as e:
-            logger.error(str(e))
+            response = method(**params)
+        except Exception as e:
+            metrics.record_request(operation, time.monotonic() - start, e)
             raise
+        metrics.record_request(operation, time.monotonic() - start)
+        metrics.record_bytes('sent', sent)
+        if operation == 'get_object':
+            metrics.record_bytes('received', response.get('ContentLength', 0))
+        return response
 
+    def _paginate(self, operation, **params):
+        """
+        Return a generator over the response pages of the S3 listing <operation>.
+        Each page request is retried on its own, so a failure doesn't restart the
+        listing from the beginning.
+        """
+        tokens = PAGINATION_TOKENS[operation]
+        while True:
+            page = self._call(operation, **params)
+            yield page
+            if not page.get('IsTruncated'):
+                return
+            for param, field in tokens.items():
+                if page.get(field) is not None:
+                    params[param] = page[field]
+
+    @instrumented('ls')
     def ls(self, path, **kwargs):
         """
         Return a list of objects in the s3 storage with the provided path
         as a prefix.
         """
-        b_full_listing = kwargs.get('full_listing', True)
-        #if not path.endswith('/'):
-         #   path = path + '/'
-        l_ls = []  # listing of names to return
-        has_run = False
-        if path:
-            conn = self.get_connection()
-            for i in range(5):
-                if has_run:
-                    continue
-                try:
-                    paginator = conn.get_paginator('list_objects_v2')
-                    page_iterator = paginator.paginate(Bucket=self.container_name, Prefix=path)
-
-                    for page in page_iterator:
-                        print('Get s3 bucket page: ')
-                        if page['KeyCount'] == 0:
-                            continue
-                        files = page["Contents"]
-                        if files is None:
-                            print('No file contents.')
-                            continue
-                        for file in files:  # This also contains the file size....
-                            l_ls.append(file['Key'])
-                    has_run = True
-                except ClientException as e:
-                    logger.error(str(e))
-                    if i == 4:
-                        raise
-                    time.sleep(0.4)
-        return l_ls
+        if not path:
+            return []
+        cache = get_listing_cache()
+        if cache is None or kwargs:
+            return [obj.key for obj in self.ls_iter(path, **kwargs)]
+        keys = cache.get(('ls', path))
+        if keys is None:
+            generation = cache.generation
+            keys = tuple(obj.key for obj in self.ls_iter(path))
+            if len(keys) <= self.listing_cache_max_keys:
+                cache.set(('ls', path), keys, generation)
+        return list(keys)
 
+    def ls_iter(self, path, **kwargs):
+        """
+        Return a generator over the objects in the s3 storage with the provided path
+        as a prefix. Objects are yielded as S3ObjectInfo records while the listing
+        pages arrive, so neither the listing nor a metadata request per object is
+        needed to get their sizes.
+
+        If a <delimiter> is passed (usually '/') only the objects directly "under" the
+        path are yielded, followed by one record per "subdirectory" whose key is the
+        common prefix ending with the delimiter and whose other fields are None. If a
+        <start_at> key is passed the listing starts at that key rather than at the
+        first key with the prefix.
+        """
+        params = {'Bucket': self.container_name, 'Prefix': path}
+        delimiter = kwargs.get('delimiter')
+        if delimiter:
+            params['Delimiter'] = delimiter
+        if kwargs.get('start_at'):
+            params['StartAfter'] = key_before(kwargs['start_at'])
+        if 'page_size' in kwargs:
+            params['MaxKeys'] = kwargs['page_size']
+        for page in self._paginate('list_objects_v2', **params):
+            for obj in page.get('Contents', ()):
+                yield S3ObjectInfo(obj['Key'], obj['Size'], obj['ETag'].strip('"'),
+                                   obj['LastModified'])
+            for common_prefix in page.get('CommonPrefixes', ()):
+                yield S3ObjectInfo(common_prefix['Prefix'], None, None, None)
+
+    @instrumented('path_exists')
     def path_exists(self, path):
         """
-        Return True/False if passed path exists in swift storage.
+        Return True/False if passed path exists in swift storage, that is, if there is
+        any object whose key starts with it. A single key is listed to find out.
         """
-        conn = self.get_connection()
-        result = conn.list_objects(Bucket=self.container_name, Prefix=path)
-        exists = False
-        if 'Contents' in result:
-            exists = True
+        cache = get_listing_cache()
+        if cache is not None:
+            exists = self._get_cached_exists(cache, ('exists', path))
+            if exists is not None:
+                return exists
+            generation = cache.generation
+        result = self._call('list_objects_v2', Bucket=self.container_name, Prefix=path,
+                            MaxKeys=1)
+        exists = bool(result.get('Contents'))
+        if cache is not None:
+            cache.set(('exists', path), (exists, time.monotonic()), generation)
         return exists
 
+    @instrumented('get_obj_metadata')
+    def get_obj_metadata(self, obj_path):
+        """
+        Return the S3ObjectMetadata of an object in the s3 storage with a single HEAD
+        request.
+        """
+        resp = self._call('head_object', Bucket=self.container_name, Key=obj_path)
+        size = resp['ContentLength']
+        if resp.get('ContentEncoding') == 'gzip':
+            # report the size of the contents rather than the size they're stored at
+            size = int(resp.get('Metadata', {}).get('uncompressed-size', size))
+        return S3ObjectMetadata(obj_path, size, resp['ETag'].strip('"'),
+                                resp.get('ContentType', ''), resp['LastModified'])
+
+    @instrumented('obj_exists')
     def obj_exists(self, obj_path):
         """
-        Return True/False if passed object exists in swift storage.
+        Return True/False if an object with exactly the passed key exists in swift
+        storage.
+        """
+        return self.exists_many([obj_path])[obj_path]
+
+    @instrumented('exists_many')
+    def exists_many(self, obj_paths, **kwargs):
+        """
+        Return a dictionary that maps each of the passed keys to True/False if an
+        object with exactly that key exists in swift storage.
+
+        Few keys are checked with concurrent HEAD requests (<max_workers> at a time).
+        At least <list_min_keys> keys are checked by listing the range of keys between
+        the smallest and the largest of them instead, as long as that takes fewer pages
+        than rounds of HEAD requests; the keys the listing didn't reach by then are
+        checked with HEAD requests. Results are kept in the listing cache, but missing
+        keys only for AWS_S3_EXISTS_NEGATIVE_TTL seconds. If the listing cache is
+        disabled only the missing keys are cached, for as long.
+        """
+        max_workers = kwargs.get('max_workers', self.exists_max_workers)
+        list_min_keys = kwargs.get('list_min_keys', self.exists_list_min_keys)
+        results = {}
+        pending = []
+        cache = get_listing_cache()
+        negative_only = cache is None
+        if negative_only:
+            cache = get_negative_exists_cache()
+        generation = cache.generation
+        for obj_path in sorted(set(obj_paths)):
+            exists = self._get_cached_exists(cache, ('obj', obj_path))
+            if exists is None:
+                pending.append(obj_path)
+            else:
+                results[obj_path] = exists
+        checked = {}
+        if len(pending) >= list_min_keys:
+            max_pages = max(1, len(pending) // max_workers)
+            listed, pending = self._list_exists(pending, max_pages)
+            checked.update(listed)
+        if len(pending) == 1:
+            checked[pending[0]] = self._head_exists(pending[0])
+        elif pending:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                checked.update(zip(pending, executor.map(self._head_exists, pending)))
+        checked_at = time.monotonic()
+        for obj_path, exists in checked.items():
+            if not (exists and negative_only):
+                cache.set(('obj', obj_path), (exists, checked_at), generation)
+        results.update(checked)
+        return results
+
+    def _get_cached_exists(self, cache, key):
+        """
+        Return the cached result of an existence check or None if there is none or it
+        is a negative result older than AWS_S3_EXISTS_NEGATIVE_TTL seconds.
         """
-        return self.path_exists(obj_path)
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        exists, checked_at = entry
+        if not exists and time.monotonic() - checked_at > self.exists_negative_ttl:
+            return None
+        return exists
 
+    def _head_exists(self, obj_path):
+        """
+        Return True/False if an object with exactly the passed key exists, with a
+        single HEAD request.
+        """
+        try:
+            self._call('head_object', Bucket=self.container_name, Key=obj_path)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def _list_exists(self, obj_paths, max_pages):
+        """
+        Check the existence of the passed sorted keys by walking the listing of their
+        common prefix from just before the smallest of them, for at most <max_pages>
+        pages.
+        Return a dictionary with the results and the list of the keys that weren't
+        reached.
+        """
+        # S3 lists keys in UTF-8 binary order, which is the order of Python strings
+        params = {'Bucket': self.container_name,
+                  'Prefix': os.path.commonprefix(obj_paths),
+                  'StartAfter': key_before(obj_paths[0])}
+        results = {}
+        i = 0
+        pages = 0
+        for page in self._paginate('list_objects_v2', **params):
+            pages += 1
+            for obj in page.get('Contents', ()):
+                while i < len(obj_paths) and obj_paths[i] < obj['Key']:
+                    results[obj_paths[i]] = False
+                    i += 1
+                if i == len(obj_paths):
+                    break
+                if obj_paths[i] == obj['Key']:
+                    results[obj_paths[i]] = True
+                    i += 1
+            if not page.get('IsTruncated'):
+                # the listing is over, so the keys after its last one don't exist
+                for obj_path in obj_paths[i:]:
+                    results[obj_path] = False
+                i = len(obj_paths)
+            if i == len(obj_paths) or pages >= max_pages:
+                break
+        return results, obj_paths[i:]
+
+    @instrumented('upload_obj')
     def upload_obj(self, swift_path, contents, **kwargs):
         """
         Upload an object (a file contents) into swift storage.
+
+        The contents can be bytes, a string, a file-like object or an iterator of bytes.
+        Contents of unknown size or of at least <multipart_threshold> bytes are sent
+        as a multipart upload (see upload_obj_multipart). In compression mode the
+        contents are gzip compressed first if their type qualifies (see
+        _should_compress), unless a <content_encoding> is passed.
         """
-        conn = self.get_connection()
-        for i in range(5):
+        threshold = kwargs.get('multipart_threshold', self.multipart_threshold)
+        if isinstance(contents, str):
+            contents = contents.encode('utf-8')
+        size = self._get_content_size(contents)
+        index = self.get_digest_index()
+        digest = None
+        if index is not None and size is not None and size >= self.dedup_min_size:
+            digest = self._get_content_digest(contents)
+            if self._copy_duplicate(swift_path, digest, size,
+                                    self._get_upload_params(kwargs)):
+                return
+        elif index is not None and size is None:
+            # the digest is computed while the contents are streamed to storage
+            contents = HashedIterator(contents, hashlib.sha256())
+        body = contents
+        body_size = size
+        if 'content_encoding' not in kwargs and \
+                self._should_compress(swift_path, size, kwargs.get('content_type')):
+            body, uncompressed_size, body_size = self._compress_contents(contents)
+            kwargs = dict(kwargs, content_encoding='gzip',
+                          content_type=kwargs.get('content_type') or
+                          self.guess_content_type(swift_path),
+                          metadata=self._get_compression_metadata(uncompressed_size,
+                                                                  body_size))
+        # the key must not be picked as a copy source while it holds other contents
+        self._discard_digests([swift_path])
+        try:
+            if body_size is None or body_size >= threshold:
+                self.upload_obj_multipart(swift_path, body, **kwargs)
+            else:
+                params = {'Bucket': self.container_name, 'Key': swift_path, 'Body': body}
+                params.update(self._get_upload_params(kwargs))
+                self._call('put_object', **params)
+                self._invalidate_listing(swift_path)
+        finally:
+            if body is not contents:
+                body.close()
+        if index is not None and size is None:
+            index.add(swift_path, contents.hash_obj.hexdigest(), contents.size)
+        elif digest is not None:
+            index.add(swift_path, digest, size)
+
+    @staticmethod
+    def _get_upload_params(kwargs):
+        """
+        Return the S3 parameters of an upload set by the content_type,
+        content_encoding and metadata upload options.
+        """
+        params = {}
+        for option, param in (('content_type', 'ContentType'),
+                              ('content_encoding', 'ContentEncoding'),
+                              ('metadata', 'Metadata')):
+            if option in kwargs:
+                params[param] = kwargs[option]
+        return params
+
+    def _should_compress(self, swift_path, size=None, content_type=None):
+        """
+        Return True if contents of <size> bytes (None if unknown) to be stored at
+        <swift_path> are stored gzip compressed: the compression mode is on, the size
+        is unknown or at least <compress_min_size> and the content type (guessed from
+        the path if not passed) or the file extension is one of the configured ones.
+        """
+        if not self.compress:
+            return False
+        if size is not None and size < self.compress_min_size:
+            return False
+        return self.has_compressible_type(swift_path, content_type)
+
+    def has_compressible_type(self, swift_path, content_type=None):
+        """
+        Return True if the content type (guessed from the path if not passed) or the
+        file extension of <swift_path> is one of the configured ones, that is, if the
+        object there may be stored gzip compressed, whatever the compression mode is
+        now.
+        """
+        content_type = content_type or self.guess_content_type(swift_path)
+        return (content_type.split(';')[0].strip() in self.compress_content_types or
+                os.path.splitext(swift_path)[1].lower() in self.compress_extensions)
+
+    def _compress_contents(self, contents):
+        """
+        Gzip compress bytes, a file-like object or an iterator of bytes into a
+        temporary file that is kept in memory up to <multipart_threshold> bytes.
+        Return a (file rewound to its start, size, compressed size) tuple. The gzip
+        header records neither a name nor a time, so the same contents always
+        compress to the same bytes (and the same ETag).
+        """
+        tmp = tempfile.SpooledTemporaryFile(max_size=self.multipart_threshold)
+        size = 0
+        with gzip.GzipFile(filename='', mode='wb', fileobj=tmp,
+                           compresslevel=self.compress_level, mtime=0) as gz:
+            for chunk in self._iter_parts(contents, 1024 * 1024):
+                gz.write(chunk)
+                size += len(chunk)
+        compressed_size = tmp.tell()
+        tmp.seek(0)
+        return tmp, size, compressed_size
+
+    @staticmethod
+    def _get_compression_metadata(size, compressed_size):
+        """
+        Return the user metadata stored with a compressed object: its uncompressed
+        size and its compression ratio (uncompressed size / compressed size).
+        """
+        return {'uncompressed-size': str(size),
+                'compression-ratio': '%.3f' % (size / compressed_size)}
+
+    def get_digest_index(self):
+        """
+        Return the digest-to-object index used by the dedup mode (see
+        uploadedfiles.dedup), or None if the dedup mode is off.
+        """
+        if not self.dedup:
+            return None
+        return import_string(self.dedup_index)()
+
+    def _copy_duplicate(self, swift_path, digest, size, params=None):
+        """
+        Store the contents with the provided <digest> and <size> at <swift_path> with
+        a server-side copy of an object that already holds them, if there is one in
+        the digest index. The copy gets the passed upload <params> (ContentType, ACL,
+        etc). Return True if the contents were stored, or False if they must be
+        uploaded.
+        """
+        index = self.get_digest_index()
+        source = index.lookup(digest, size)
+        if source is None:
+            return False
+        if source != swift_path:
+            bucket = self.container_name
             try:
-                conn.put_object(Bucket=self.container_name,
-                                Key=swift_path,
-                                Body=contents)
-            except ClientException as e:
-                logger.error(str(e))
-                if i == 4:
+                # the source may be stored compressed, so <size> isn't its stored size
+                head = self._call('head_object', Bucket=bucket, Key=source)
+                stored_size = head['ContentLength']
+                extra = dict(params) if params else {}
+                if extra and head.get('ContentEncoding'):
+                    # replacing the metadata must keep the source's compression
+                    extra['ContentEncoding'] = head['ContentEncoding']
+                    extra['Metadata'] = dict(extra.get('Metadata', {}),
+                                             **head.get('Metadata', {}))
+                if stored_size >= self.multipart_copy_threshold:
+                    self.copy_obj_multipart(source, swift_path, stored_size, params=extra)
+                else:
+                    if extra:
+                        extra['MetadataDirective'] = 'REPLACE'
+                    self._call('copy_object', Bucket=bucket, Key=swift_path,
+                               CopySource={'Bucket': bucket, 'Key': source}, **extra)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
                     raise
-                time.sleep(0.4)
-            else:
-                break
+                # the source was deleted behind the index's back
+                index.discard([source])
+                return False
+            self._invalidate_listing(swift_path)
+        index.add(swift_path, digest, size)
+        logger.info('Stored %s as a copy of %s with the same contents', swift_path, source)
+        return True
 
-    def download_obj(self, obj_path, **kwargs):
+    @staticmethod
+    def _get_content_digest(contents):
+        """
+        Return the SHA-256 hex digest of bytes or of the rest of a seekable file-like
+        object, which is rewound to where it was.
+        """
+        if isinstance(contents, (bytes, bytearray)):
+            return hashlib.sha256(contents).hexdigest()
+        sha256 = hashlib.sha256()
+        position = contents.tell()
+        for chunk in iter(lambda: contents.read(1024 * 1024), contents.read(0)):
+            sha256.update(chunk)
+        contents.seek(position)
+        return sha256.hexdigest()
+
+    @instrumented('upload_obj_multipart')
+    def upload_obj_multipart(self, swift_path, contents, **kwargs):
         """
-        Download an object from swift storage.
+        Upload an object into s3 storage as a multipart upload. The contents are read
+        in parts of <part_size> bytes that are sent in parallel by <max_workers>
+        threads, so no more than <max_workers> + 1 parts are held in memory.
+
+        An interrupted upload is resumed by passing its <upload_id>, or resume=True to
+        pick the latest one for <swift_path>, together with the same contents again.
+        Parts that are already stored with a matching checksum are not sent again.
+        A failed upload is aborted unless resumable=True or resume=True is passed (or
+        an upload was resumed), in which case it is left in place to be resumed.
+        Return the upload id.
         """
+        part_size = max(kwargs.get('part_size', self.multipart_chunksize),
+                        MULTIPART_MIN_PART_SIZE)
+        max_workers = kwargs.get('max_workers', self.multipart_max_workers)
+        upload_id = kwargs.get('upload_id')
+        if upload_id is None and kwargs.get('resume', False):
+            upload_id = self._find_multipart_upload(swift_path)
+        resumable = (kwargs.get('resumable', False) or kwargs.get('resume', False) or
+                     upload_id is not None)
+        if upload_id is None:
+            params = {'Bucket': self.container_name, 'Key': swift_path}
+            params.update(self._get_upload_params(kwargs))
+            upload_id = self._call('create_multipart_upload', **params)['UploadId']
+            stored_parts = {}
+        else:
+            stored_parts = self._list_uploaded_parts(swift_path, upload_id)
+
+        def upload_part(part_number, body):
+            response = self._call('upload_part', Bucket=self.container_name,
+                                  Key=swift_path, UploadId=upload_id,
+                                  PartNumber=part_number, Body=body)
+            return part_number, response['ETag']
+
+        parts = []
+        pending = set()
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for part_number, body in enumerate(self._iter_parts(contents, part_size), 1):
+                    etag = '"%s"' % hashlib.md5(body).hexdigest()
+                    if stored_parts.get(part_number) == etag:
+                        parts.append((part_number, etag))
+                        continue
+                    if len(pending) >= max_workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        parts.extend(future.result() for future in done)
+                    pending.add(executor.submit(upload_part, part_number, body))
+                parts.extend(future.result() for future in pending)
+            if not parts:
+                # S3 can't complete a multipart upload without parts
+                self._call('abort_multipart_upload', Bucket=self.container_name,
+                           Key=swift_path, UploadId=upload_id)
+                self._call('put_object', Bucket=self.container_name, Key=swift_path,
+                           Body=b'')
+                self._invalidate_listing(swift_path)
+                return upload_id
+            parts.sort()
+            self._call(
+                'complete_multipart_upload',
+                Bucket=self.container_name, Key=swift_path, UploadId=upload_id,
+                MultipartUpload={'Parts': [{'PartNumber': part_number, 'ETag': etag}
+                                           for part_number, etag in parts]})
+            self._invalidate_listing(swift_path)
+        except Exception as e:
+            logger.error('Multipart upload %s of %s failed: %s', upload_id, swift_path,
+                         str(e))
+            if not resumable:
+                self._call('abort_multipart_upload', Bucket=self.container_name,
+                           Key=swift_path, UploadId=upload_id)
+            raise
+        return upload_id
+
+    @instrumented('abort_multipart_uploads')
+    def abort_multipart_uploads(self, prefix='', older_than=None):
+        """
+        Abort the unfinished multipart uploads of objects with the provided prefix
+        that were initiated more than <older_than> (a timedelta) ago, or all of them
+        if <older_than> is None, and free the storage used by their parts. Return a
+        list of the (key, upload id) pairs that were aborted.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        aborted = []
+        for page in self._paginate('list_multipart_uploads', Bucket=self.container_name,
+                                   Prefix=prefix):
+            for upload in page.get('Uploads', ()):
+                if older_than is not None and now - upload['Initiated'] < older_than:
+                    continue
+                self._call('abort_multipart_upload', Bucket=self.container_name,
+                           Key=upload['Key'], UploadId=upload['UploadId'])
+                aborted.append((upload['Key'], upload['UploadId']))
+        return aborted
+
+    @instrumented('get_upload_url')
+    def get_upload_url(self, swift_path, **kwargs):
+        """
+        Return a presigned URL that a client can PUT the contents of <swift_path> to
+        directly, valid for <expires_in> seconds. If a <content_type> is passed the
+        client must send it as the Content-Type header.
+        """
+        # the client can replace the object as soon as it gets the URL
+        self._discard_digests([swift_path])
+        params = {'Bucket': self.container_name, 'Key': swift_path}
+        if kwargs.get('content_type'):
+            params['ContentType'] = kwargs['content_type']
+        return self.get_connection().generate_presigned_url(
+            'put_object', Params=params,
+            ExpiresIn=kwargs.get('expires_in', self.presigned_upload_expiry))
+
+    @instrumented('get_upload_post')
+    def get_upload_post(self, swift_path, **kwargs):
+        """
+        Return a presigned POST policy (a dictionary with the form 'url' and 'fields')
+        for a browser form upload of <swift_path>, valid for <expires_in> seconds and
+        limited to <max_size> bytes.
+        """
+        # the client can replace the object as soon as it gets the policy
+        self._discard_digests([swift_path])
         conn = self.get_connection()
-        for i in range(5):
+        fields = {}
+        conditions = [['content-length-range', 0,
+                       kwargs.get('max_size', self.presigned_upload_max_size)]]
+        if kwargs.get('content_type'):
+            fields['Content-Type'] = kwargs['content_type']
+            conditions.append({'Content-Type': kwargs['content_type']})
+        return conn.generate_presigned_post(
+            self.container_name, swift_path, Fields=fields, Conditions=conditions,
+            ExpiresIn=kwargs.get('expires_in', self.presigned_upload_expiry))
+
+    @instrumented('create_presigned_multipart_upload')
+    def create_presigned_multipart_upload(self, swift_path, size, **kwargs):
+        """
+        Start a multipart upload of <size> bytes and return a dictionary with its
+        'upload_id', the 'part_size' and the list of 'parts', each one a dictionary
+        with the 'part_number' and the presigned 'url' the client must PUT that part
+        to. The URLs are valid for <expires_in> seconds. Once all the parts are sent
+        the upload is finished with complete_presigned_multipart_upload.
+        """
+        part_size = max(kwargs.get('part_size', self.multipart_chunksize),
+                        MULTIPART_MIN_PART_SIZE, -(-size // MULTIPART_MAX_PARTS))
+        expires_in = kwargs.get('expires_in', self.presigned_upload_expiry)
+        params = {'Bucket': self.container_name, 'Key': swift_path}
+        if kwargs.get('content_type'):
+            params['ContentType'] = kwargs['content_type']
+        upload_id = self._call('create_multipart_upload', **params)['UploadId']
+        conn = self.get_connection()
+        parts = []
+        for part_number in range(1, max(1, -(-size // part_size)) + 1):
+            url = conn.generate_presigned_url(
+                'upload_part', ExpiresIn=expires_in,
+                Params={'Bucket': self.container_name, 'Key': swift_path,
+                        'UploadId': upload_id, 'PartNumber': part_number})
+            parts.append({'part_number': part_number, 'url': url})
+        return {'upload_id': upload_id, 'part_size': part_size, 'parts': parts}
+
+    @instrumented('complete_presigned_multipart_upload')
+    def complete_presigned_multipart_upload(self, swift_path, upload_id):
+        """
+        Complete a multipart upload whose parts were sent by a client. The part ETags
+        are taken from S3, so clients don't need to report them.
+        """
+        stored_parts = self._list_uploaded_parts(swift_path, upload_id)
+        if not stored_parts:
+            raise ValueError('No parts were uploaded for upload %s' % upload_id)
+        self._discard_digests([swift_path])
+        self._call(
+            'complete_multipart_upload',
+            Bucket=self.container_name, Key=swift_path, UploadId=upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': part_number, 'ETag': etag}
+                                       for part_number, etag in sorted(stored_parts.items())]})
+        self._invalidate_listing(swift_path)
+
+    def _find_multipart_upload(self, swift_path):
+        """
+        Return the id of the latest unfinished multipart upload of <swift_path> or
+        None if there is none.
+        """
+        latest = None
+        for page in self._paginate('list_multipart_uploads', Bucket=self.container_name,
+                                   Prefix=swift_path):
+            for upload in page.get('Uploads', ()):
+                if upload['Key'] != swift_path:
+                    continue
+                if latest is None or upload['Initiated'] > latest['Initiated']:
+                    latest = upload
+        return latest['UploadId'] if latest is not None else None
+
+    def _list_uploaded_parts(self, swift_path, upload_id):
+        """
+        Return a dictionary with the ETags of the parts already stored for an
+        unfinished multipart upload, keyed by part number.
+        """
+        stored_parts = {}
+        for page in self._paginate('list_parts', Bucket=self.container_name,
+                                   Key=swift_path, UploadId=upload_id):
+            for part in page.get('Parts', ()):
+                stored_parts[part['PartNumber']] = part['ETag']
+        return stored_parts
+
+    @staticmethod
+    def _get_content_size(contents):
+        """
+        Return the number of bytes left in bytes or a seekable file-like object, or
+        None if it can't be known without consuming the contents.
+        """
+        if isinstance(contents, (bytes, bytearray)):
+            return len(contents)
+        if hasattr(contents, 'seek') and hasattr(contents, 'tell'):
+            if hasattr(contents, 'seekable') and not contents.seekable():
+                return None
+            position = contents.tell()
+            size = contents.seek(0, os.SEEK_END) - position
+            contents.seek(position)
+            return size
+        return None
+
+    @staticmethod
+    def _iter_parts(contents, part_size):
+        """
+        Split bytes, a file-like object or an iterator of bytes into consecutive
+        blocks of <part_size> bytes (the last one can be shorter).
+        """
+        if isinstance(contents, (bytes, bytearray)):
+            for offset in range(0, len(contents), part_size):
+                yield bytes(contents[offset:offset + part_size])
+            return
+        if hasattr(contents, 'read'):
+            # read(0) gives the empty value (b'' or '') that signals end of file
+            chunks = iter(lambda: contents.read(part_size), contents.read(0))
+        else:
+            chunks = iter(contents)
+        buf = bytearray()
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            buf += chunk
+            while len(buf) >= part_size:
+                yield bytes(buf[:part_size])
+                del buf[:part_size]
+        if buf:
+            yield bytes(buf)
+
+    @instrumented('download_obj')
+    def download_obj(self, obj_path, **kwargs):
+        """
+        Download an object from swift storage. Gzip encoded objects are decompressed
+        unless decompress=False is passed. With the disk cache on (see open_obj) the
+        object is read through the cache.
+        """
+        decompress = kwargs.get('decompress', True)
+        if get_disk_cache() is not None:
+            f = self.open_obj(obj_path, decompress=decompress)
+            try:
+                return f.read()
+            finally:
+                f.close()
+
+        def download():
+            response_object = self._request('get_object', Bucket=self.container_name,
+                                            Key=obj_path)
+            contents = response_object['Body'].read()
+            if decompress and response_object.get('ContentEncoding') == 'gzip':
+                contents = gzip.decompress(contents)
+            return contents
+
+        # the body is read inside the retried call, so a connection dropped in the
+        # middle of it is retried as well
+        return get_retry_policy().call(download)
+
+    @instrumented('open_obj')
+    def open_obj(self, obj_path, **kwargs):
+        """
+        Open an object for reading and return a binary file-like object with its
+        contents, decompressed as they are read unless decompress=False is passed.
+
+        If the AWS_S3_DISK_CACHE setting enables the local disk cache, the object is
+        downloaded to the cache once and the returned file is the cached copy (which
+        can be memory-mapped when it isn't decompressed). Cached copies are served
+        without a request while they are fresh, and revalidated by ETag with a
+        conditional GET after that, which costs a 304 response if the object didn't
+        change. Concurrent readers of an object, in any process of the node, wait for
+        a single download. Without the cache, or for objects too large to be cached,
+        an S3ObjectStream is returned.
+        """
+        decompress = kwargs.get('decompress', True)
+        cache = get_disk_cache()
+        if cache is None:
+            return self.download_obj_stream(obj_path, decompress=decompress)
+        name = '%s/%s' % (self.container_name, obj_path)
+        with cache.lock(name):
+            entry = cache.get(name)
+            if entry is not None and cache.is_fresh(entry):
+                return cache.open(entry, decompress)
+
+            def fetch():
+                params = {'Bucket': self.container_name, 'Key': obj_path}
+                if entry is not None:
+                    params['IfNoneMatch'] = entry.etag
+                try:
+                    response_object = self._request('get_object', **params)
+                except ClientError as e:
+                    if entry is None or e.response['Error']['Code'] not in ('304',
+                                                                           'NotModified'):
+                        raise
+                    return cache.open(cache.mark_validated(entry), decompress, hit=False)
+                new_entry = cache.put(name, response_object, self.download_chunk_size)
+                if new_entry is None:
+                    return S3ObjectStream(response_object, self.download_chunk_size,
+                                          decompress)
+                return cache.open(new_entry, decompress, hit=False)
+
+            # the body is written to the cache inside the retried call, so a connection
+            # dropped in the middle of it is retried as well
+            return get_retry_policy().call(fetch)
+
+    @instrumented('download_obj_stream')
+    def download_obj_stream(self, obj_path, **kwargs):
+        """
+        Open an object in s3 storage for streaming and return an S3ObjectStream
+        that yields its contents in chunks of <chunk_size> bytes, so memory use does
+        not depend on the object size. A <byte_range> (first, last) tuple of
+        inclusive offsets restricts the download to part of the object; either end
+        may be None as in the HTTP Range header ('bytes=first-' or 'bytes=-last').
+
+        Gzip encoded objects are decompressed as they are streamed unless
+        decompress=False is passed. Byte ranges apply to the stored (encoded) bytes,
+        which can't be decompressed on their own, so if a range of a gzip encoded
+        object is requested with decompress=True the whole object is streamed
+        decompressed instead (and the stream's content_range is None).
+        """
+        chunk_size = kwargs.get('chunk_size', self.download_chunk_size)
+        params = {'Bucket': self.container_name, 'Key': obj_path}
+        byte_range = kwargs.get('byte_range')
+        if byte_range is not None:
+            first, last = byte_range
+            params['Range'] = 'bytes=%s-%s' % ('' if first is None else first,
+                                               '' if last is None else last)
+        response_object = self._call('get_object', **params)
+        decompress = kwargs.get('decompress', True)
+        if byte_range is not None and decompress and \
+                response_object.get('ContentEncoding') == 'gzip':
+            response_object['Body'].close()
+            del params['Range']
+            response_object = self._call('get_object', **params)
+        elif byte_range is not None:
+            decompress = False
+        return S3ObjectStream(response_object, chunk_size, decompress)
+
+    @instrumented('download_obj_range')
+    def download_obj_range(self, obj_path, first, last):
+        """
+        Download the bytes between the <first> and <last> inclusive offsets of an
+        object in s3 storage.
+        """
+        return b''.join(self.download_obj_stream(obj_path, byte_range=(first, last)))
+
+    def iter_obj_streams(self, prefix, **kwargs):
+        """
+        Return a generator over the (S3ObjectInfo, S3ObjectStream) pairs of the objects
+        with the provided prefix, in listing order. While an object is consumed the
+        GET requests of the next <read_ahead> objects are already issued by a thread
+        pool, so the data of small objects is on its way when they are reached.
+        Streams that were opened ahead but not yielded are closed if the generator is
+        closed early.
+        """
+        read_ahead = max(kwargs.get('read_ahead', self.archive_read_ahead), 1)
+        chunk_size = kwargs.get('chunk_size', self.download_chunk_size)
+        window = deque()
+        with ThreadPoolExecutor(max_workers=read_ahead) as executor:
+            try:
+                for obj in self.ls_iter(prefix):
+                    if obj.key.endswith('/'):
+                        continue
+                    window.append((obj, executor.submit(self.download_obj_stream, obj.key,
+                                                        chunk_size=chunk_size)))
+                    if len(window) > read_ahead:
+                        obj, future = window.popleft()
+                        yield obj, future.result()
+                while window:
+                    obj, future = window.popleft()
+                    yield obj, future.result()
+            finally:
+                for obj, future in window:
+                    if not future.cancel() and future.exception() is None:
+                        future.result().close()
+
+    @instrumented('download_files')
+    def download_files(self, prefix, local_dir, **kwargs):
+        """
+        Download all the objects with the provided prefix to the same relative
+        location under a local directory, the bulk counterpart of upload_files.
+
+        The listing is streamed and objects are downloaded concurrently by a pool of
+        <max_workers> threads, writing their chunks straight to a temporary file that
+        replaces the local file once complete. Objects of at least
+        <multipart_download_threshold> bytes are fetched as parallel range GETs of
+        <part_size> bytes. Local files are skipped if they are unchanged: if they have
+        the object's size and mtime (downloaded files get the object's mtime) or, with
+        compare='checksum', the object's ETag. Return a report dictionary with the
+        'downloaded' and 'skipped' local paths and the 'failed' (storage path, error
+        message) tuples.
+        """
+        max_workers = kwargs.get('max_workers', self.download_max_workers)
+        threshold = kwargs.get('multipart_download_threshold',
+                               self.multipart_download_threshold)
+        part_size = kwargs.get('part_size', self.multipart_download_chunksize)
+        compare = kwargs.get('compare', 'mtime')
+        local_root = os.path.realpath(local_dir)
+        report = {'downloaded': [], 'skipped': [], 'failed': []}
+
+        def download(obj, local_file_path):
+            tmp_path = '%s.%s.part' % (local_file_path, os.getpid())
             try:
-                response_object = conn.get_object(Bucket=self.container_name, Key=obj_path)
-                obj_contents = response_object['Body'].read()
-            except ClientException as e:
+                os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
+                if obj.size >= threshold:
+                    self._download_ranges(obj.key, tmp_path, obj.size, part_size,
+                                          part_executor)
+                else:
+                    get_retry_policy().call(self._download_range, obj.key, tmp_path)
+                os.utime(tmp_path, (obj.mtime.timestamp(), obj.mtime.timestamp()))
+                os.replace(tmp_path, local_file_path)
+            except (BotoCoreError, ClientError, OSError) as e:
                 logger.error(str(e))
-                if i == 4:
-                    raise
-                time.sleep(0.4)
-            else:
-                return obj_contents
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                return 'failed', (obj.key, str(e))
+            return 'downloaded', local_file_path
+
+        def collect(done):
+            for future in done:
+                status, entry = future.result()
+                report[status].append(entry)
 
+        pending = set()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+                ThreadPoolExecutor(max_workers=self.multipart_download_max_workers) \
+                as part_executor:
+            for obj in self.ls_iter(prefix):
+                if obj.key.endswith('/'):
+                    continue
+                local_file_path = os.path.realpath(
+                    os.path.join(local_root, obj.key[len(prefix):].lstrip('/')))
+                if os.path.commonpath([local_root, local_file_path]) != local_root:
+                    report['failed'].append((obj.key, 'Key maps outside the directory'))
+                    continue
+                if self._is_local_file_unchanged(local_file_path, obj, compare):
+                    report['skipped'].append(local_file_path)
+                    continue
+                if len(pending) >= 2 * max_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(executor.submit(download, obj, local_file_path))
+            collect(pending)
+        return report
+
+    def _download_ranges(self, obj_path, local_file_path, size, part_size, executor):
+        """
+        Download an object of <size> bytes to a local file with parallel range GETs of
+        <part_size> bytes run by <executor>. Each part is written at its offset in the
+        file and retried on its own. Gzip encoded objects can't be decompressed in
+        parts, so they are downloaded as a whole.
+        """
+        head = self._call('head_object', Bucket=self.container_name, Key=obj_path)
+        if head.get('ContentEncoding') == 'gzip':
+            get_retry_policy().call(self._download_range, obj_path, local_file_path)
+            return
+        with open(local_file_path, 'wb') as f:
+            f.truncate(size)
+        futures = [executor.submit(get_retry_policy().call, self._download_range, obj_path,
+                                   local_file_path, (first, min(first + part_size, size) - 1))
+                   for first in range(0, size, part_size)]
+        for future in futures:
+            future.result()
+
+    def _download_range(self, obj_path, local_file_path, byte_range=None):
+        """
+        Download an object, or the (first, last) <byte_range> of it, to a local file.
+        A range is written at its offset in the existing file while a whole gzip
+        encoded object is decompressed. The request is not retried here, the caller
+        retries the whole download of the range.
+        """
+        params = {'Bucket': self.container_name, 'Key': obj_path}
+        if byte_range is not None:
+            params['Range'] = 'bytes=%s-%s' % byte_range
+        response_object = self._request('get_object', **params)
+        stream = S3ObjectStream(response_object, self.download_chunk_size,
+                                decompress=byte_range is None)
+        mode = 'r+b' if byte_range is not None else 'wb'
+        with open(local_file_path, mode) as f:
+            if byte_range is not None:
+                f.seek(byte_range[0])
+            for chunk in stream:
+                f.write(chunk)
+
+    def _is_local_file_unchanged(self, local_file_path, obj, compare='mtime'):
+        """
+        Return True if a local file has the size and mtime or, with
+        compare='checksum', the size and ETag of the S3ObjectInfo <obj>. The size of
+        a file whose object is stored compressed isn't compared, and its checksum is
+        the ETag of its compressed form.
+        """
+        try:
+            stat = os.stat(local_file_path)
+            compressed = self._is_stored_compressed(obj.key, stat.st_size, obj.size)
+        except (BotoCoreError, ClientError, OSError):
+            return False
+        if stat.st_size != obj.size and not compressed:
+            return False
+        if compare == 'checksum':
+            return self._get_local_etag(local_file_path, stat.st_size, obj.etag,
+                                        compressed) == obj.etag
+        return int(stat.st_mtime) == int(obj.mtime.timestamp())
+
+    @instrumented('get_download_url')
+    def get_download_url(self, obj_path, **kwargs):
+        """
+        Return a presigned GET URL of an object in s3 storage, valid for <expires_in>
+        seconds. A <content_disposition> overrides the Content-Disposition header S3
+        sends with the object. Signed URLs are cached and reused until they have less
+        than <presigned_url_min_ttl> seconds left.
+        """
+        expires_in = kwargs.get('expires_in', self.presigned_url_expiry)
+        content_disposition = kwargs.get('content_disposition')
+        cache = get_presigned_url_cache()
+        key = ('url', obj_path, expires_in, content_disposition)
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None and cached[1] - time.time() >= self.presigned_url_min_ttl:
+                return cached[0]
+        params = {'Bucket': self.container_name, 'Key': obj_path}
+        if content_disposition:
+            params['ResponseContentDisposition'] = content_disposition
+        expires_at = time.time() + expires_in
+        url = self.get_connection().generate_presigned_url('get_object', Params=params,
+                                                           ExpiresIn=expires_in)
+        if cache is not None:
+            cache.set(key, (url, expires_at))
+        return url
+
+    @instrumented('copy_obj')
     def copy_obj(self, obj_path, dest_path, **kwargs):
         """
         Copy an object to a new destination in swift storage.
         """
-        conn = self.get_connection()
-        #dest = os.path.join('/' + self.container_name, dest_path.lstrip('/'))
         bucket = self.container_name
-        for i in range(5):
-            try:
-                #conn.copy_object(self.container_name, obj_path, dest, **kwargs)
-                conn.copy_object(Bucket=bucket, CopySource=f'{bucket}/{obj_path}', Key=dest_path, **kwargs)
+        self._call('copy_object', Bucket=bucket, CopySource=f'{bucket}/{obj_path}',
+                   Key=dest_path, **kwargs)
+        self._invalidate_listing(dest_path)
+        index = self.get_digest_index()
+        if index is not None:
+            index.add_copies([(obj_path, dest_path)])
+
+    @instrumented('copy_obj_multipart')
+    def copy_obj_multipart(self, obj_path, dest_path, size, **kwargs):
+        """
+        Copy an object of <size> bytes to a new destination in s3 storage with a
+        multipart upload whose parts are ranged server-side copies (UploadPartCopy)
+        of <part_size> bytes, <max_workers> of them at a time. This is required for
+        objects larger than 5GB and faster than a single copy for large objects.
 
-            except ClientException as e:
+        The copy gets the object parameters (AWS_S3_OBJECT_PARAMETERS, the default
+        ACL) and the content type, encoding, cache control and metadata of the source
+        unless they are overridden by the passed upload <params> (ContentType, ACL,
+        etc).
+        """
+        part_size = max(kwargs.get('part_size', self.multipart_copy_chunksize),
+                        MULTIPART_MIN_PART_SIZE)
+        max_workers = kwargs.get('max_workers', self.multipart_max_workers)
+        bucket = self.container_name
+        # unlike copy_object, a multipart upload doesn't carry the source's metadata over
+        head = self._call('head_object', Bucket=bucket, Key=obj_path)
+        params = self._get_object_parameters(dest_path)
+        params.update(Bucket=bucket, Key=dest_path, Metadata=head.get('Metadata', {}))
+        for param in ('ContentType', 'ContentEncoding', 'CacheControl',
+                      'ContentDisposition', 'ContentLanguage'):
+            if head.get(param):
+                params[param] = head[param]
+        params.update(kwargs.get('params', {}))
+        upload_id = self._call('create_multipart_upload', **params)['UploadId']
+
+        def copy_part(part_number, first, last):
+            response = self._call('upload_part_copy', Bucket=bucket, Key=dest_path,
+                                  UploadId=upload_id, PartNumber=part_number,
+                                  CopySource={'Bucket': bucket, 'Key': obj_path},
+                                  CopySourceRange='bytes=%s-%s' % (first, last))
+            return part_number, response['CopyPartResult']['ETag']
+
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(copy_part, part_number, first,
+                                           min(first + part_size, size) - 1)
+                           for part_number, first in enumerate(range(0, size, part_size), 1)]
+                parts = sorted(future.result() for future in futures)
+            self._call(
+                'complete_multipart_upload',
+                Bucket=bucket, Key=dest_path, UploadId=upload_id,
+                MultipartUpload={'Parts': [{'PartNumber': part_number, 'ETag': etag}
+                                           for part_number, etag in parts]})
+        except Exception as e:
+            logger.error('Multipart copy of %s to %s failed: %s', obj_path, dest_path,
+                         str(e))
+            self._call('abort_multipart_upload', Bucket=bucket, Key=dest_path,
+                       UploadId=upload_id)
+            raise
+        self._invalidate_listing(dest_path)
+
+    @instrumented('copy_prefix')
+    def copy_prefix(self, src_prefix, dest_prefix, **kwargs):
+        """
+        Copy all the objects with the provided source prefix to the same relative
+        location under the destination prefix with server-side copies, <max_workers>
+        of them at a time. Objects of at least <multipart_copy_threshold> bytes are
+        copied with copy_obj_multipart. Copies get the ACL of the object parameters
+        whatever their size. Return a report dictionary with the 'copied'
+        (source, destination) tuples and the 'failed' (source, error message) tuples.
+        """
+        if not src_prefix:
+            raise ValueError('A source prefix is required')
+        if dest_prefix.startswith(src_prefix):
+            # the listing would pick up the copies as they are created
+            raise ValueError('The destination prefix can not be under the source prefix')
+        max_workers = kwargs.get('max_workers', self.copy_max_workers)
+        threshold = kwargs.get('multipart_copy_threshold', self.multipart_copy_threshold)
+        part_size = kwargs.get('part_size', self.multipart_copy_chunksize)
+        bucket = self.container_name
+        report = {'copied': [], 'failed': []}
+
+        def copy(obj, dest_path):
+            try:
+                if obj.size >= threshold:
+                    # parts are copied sequentially here as the pool is already busy
+                    self.copy_obj_multipart(obj.key, dest_path, obj.size,
+                                            part_size=part_size, max_workers=1)
+                else:
+                    self._call('copy_object', Bucket=bucket, Key=dest_path,
+                               CopySource={'Bucket': bucket, 'Key': obj.key},
+                               **self._get_copy_parameters(dest_path))
+            except (BotoCoreError, ClientError) as e:
                 logger.error(str(e))
-                if i == 4:
-                    raise
-                time.sleep(0.4)
-            else:
-                break
+                return 'failed', (obj.key, str(e))
+            return 'copied', (obj.key, dest_path)
+
+        def collect(done):
+            for future in done:
+                status, entry = future.result()
+                report[status].append(entry)
 
+        pending = set()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for obj in self.ls_iter(src_prefix):
+                dest_path = dest_prefix + obj.key[len(src_prefix):]
+                if len(pending) >= 2 * max_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(executor.submit(copy, obj, dest_path))
+            collect(pending)
+        if report['copied']:
+            self._invalidate_listing(dest_prefix)
+            index = self.get_digest_index()
+            if index is not None:
+                index.add_copies(report['copied'])
+        return report
+
+    @instrumented('move_prefix')
+    def move_prefix(self, src_prefix, dest_prefix, **kwargs):
+        """
+        Move all the objects with the provided source prefix under the destination
+        prefix: objects are copied with copy_prefix and the copied sources are then
+        deleted in batches with delete_many. Return a report dictionary with the
+        'moved' (source, destination) tuples and the 'failed' (source, error message)
+        tuples. A source that was copied but could not be deleted is reported as
+        failed and exists in both locations.
+        """
+        copy_report = self.copy_prefix(src_prefix, dest_prefix, **kwargs)
+        destinations = dict(copy_report['copied'])
+        delete_report = self.delete_many(destinations.keys())
+        return {'moved': [(src, destinations[src]) for src in delete_report['deleted']],
+                'failed': copy_report['failed'] + delete_report['failed']}
+
+    @instrumented('delete_obj')
     def delete_obj(self, obj_path):
         """
         Delete an object from swift storage.
         """
-        conn = self.get_connection()
-        for i in range(5):
+        self._call('delete_object', Bucket=self.container_name, Key=obj_path)
+        self._invalidate_listing(obj_path)
+        self._discard_digests([obj_path])
+
+    @instrumented('delete_many')
+    def delete_many(self, obj_paths, **kwargs):
+        """
+        Delete objects from s3 storage with multi-object delete requests of up to 1000
+        keys each, <max_workers> of them in flight at the same time. <obj_paths> can
+        be any iterable of keys, including a generator. Return a report dictionary
+        with the 'deleted' keys and the 'failed' (key, error message) tuples.
+        """
+        max_workers = kwargs.get('max_workers', self.delete_max_workers)
+        report = {'deleted': [], 'failed': []}
+
+        def delete_batch(batch):
             try:
-                conn.delete_object(Bucket=self.container_name, Key=obj_path)
-            except ClientException as e:
+                response = self._call(
+                    'delete_objects', Bucket=self.container_name,
+                    Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+            except (BotoCoreError, ClientError) as e:
                 logger.error(str(e))
-                if i == 4:
-                    raise
-                time.sleep(0.4)
-            else:
-                break
+                return [], [(key, str(e)) for key in batch]
+            finally:
+                self._invalidate_listing(os.path.commonprefix(batch))
+            # in quiet mode only the keys that could not be deleted are returned
+            failed = [(error['Key'], '%s: %s' % (error['Code'], error['Message']))
+                      for error in response.get('Errors', ())]
+            failed_keys = set(key for key, msg in failed)
+            deleted = [key for key in batch if key not in failed_keys]
+            self._discard_digests(deleted)
+            return deleted, failed
+
+        def collect(done):
+            for future in done:
+                deleted, failed = future.result()
+                report['deleted'].extend(deleted)
+                report['failed'].extend(failed)
 
+        obj_paths = iter(obj_paths)
+        pending = set()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for batch in iter(lambda: list(itertools.islice(obj_paths, DELETE_BATCH_SIZE)),
+                              []):
+                if len(pending) >= max_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(executor.submit(delete_batch, batch))
+            collect(pending)
+        return report
+
+    @instrumented('delete_prefix')
+    def delete_prefix(self, prefix, **kwargs):
+        """
+        Delete all the objects in s3 storage with the provided prefix. The listing is
+        streamed into delete_many, so the keys are never all held in memory before
+        the deletes start. Return delete_many's report.
+        """
+        if not prefix:
+            raise ValueError('Refusing to delete the whole storage with an empty prefix')
+        return self.delete_many((obj.key for obj in self.ls_iter(prefix)), **kwargs)
+
+    @instrumented('upload_files')
     def upload_files(self, local_dir, swift_prefix='', **kwargs):
         """
         Upload all the files within a local directory recursively to swift storage.
@@ -211,20 +1573,436 @@ class PublicMediaStorage(S3Boto3Storage):
             '/storage/file1',
             '/storage/dir1/file_d1',
             '/storage/dir2/file_d2'
+
+        Files that already exist in storage are skipped. See upload_file_list for the
+        upload options and the returned report.
+        """
+        local_files = self._walk_local_files(local_dir, swift_prefix)
+        # every destination key starts with the storage path of <local_dir> itself
+        dest_prefix = swift_prefix if swift_prefix else local_dir
+        return self.upload_file_list(local_files, dest_prefix, **kwargs)
+
+    @instrumented('upload_file_list')
+    def upload_file_list(self, local_files, dest_prefix, **kwargs):
+        """
+        Upload a list of (storage path, local path) pairs sorted by storage path, where
+        every storage path starts with <dest_prefix>, to swift storage.
+
+        Files are uploaded concurrently by a pool of <max_workers> threads and at most
+        <max_bytes_in_flight> bytes are being sent at any given time. In compression
+        mode files whose type qualifies are stored gzip compressed. Files that already
+        exist in storage are skipped unless skip_existing=False is passed, in which case
+        the destination isn't listed at all. Return a report dictionary with the 'uploaded',
+        'skipped' and 'failed' storage paths, where each 'failed' entry is a
+        (path, error message) tuple.
+        """
+        max_workers = kwargs.get('max_workers', self.upload_max_workers)
+        max_bytes_in_flight = kwargs.get('max_bytes_in_flight',
+                                         self.upload_max_bytes_in_flight)
+        budget = ByteBudget(max_bytes_in_flight)
+        report = {'uploaded': [], 'skipped': [], 'failed': []}
+
+        def upload(local_file_path, swift_path, nbytes):
+            try:
+                content_type = self.guess_content_type(swift_path)
+                if self._should_compress(swift_path, nbytes, content_type):
+                    with open(local_file_path, 'rb') as f:
+                        compressed, size, compressed_size = self._compress_contents(f)
+                    with compressed:
+                        self._call('upload_fileobj', Fileobj=compressed, Key=swift_path,
+                                   Bucket=self.container_name,
+                                   ExtraArgs={'ContentType': content_type,
+                                              'ContentEncoding': 'gzip',
+                                              'Metadata': self._get_compression_metadata(
+                                                  size, compressed_size)})
+                else:
+                    self._call('upload_file', Filename=local_file_path, Key=swift_path,
+                               Bucket=self.container_name,
+                               ExtraArgs={'ContentType': content_type})
+            except (BotoCoreError, ClientError, S3UploadFailedError, OSError) as e:
+                logger.error(str(e))
+                return 'failed', (swift_path, str(e))
+            finally:
+                budget.release(nbytes)
+            return 'uploaded', swift_path
+
+        def collect(done):
+            for future in done:
+                status, entry = future.result()
+                report[status].append(entry)
+
+        if kwargs.get('skip_existing', True):
+            files = self._merge_with_listing(local_files, dest_prefix)
+        else:
+            # every file may replace an object, which must not be picked as a copy
+            # source while it holds other contents
+            self._discard_digests([swift_path for swift_path, _ in local_files])
+            files = ((swift_path, local_file_path, False)
+                     for swift_path, local_file_path in local_files)
+        pending = set()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for swift_path, local_file_path, exists in files:
+                if exists:
+                    report['skipped'].append(swift_path)
+                    continue
+                try:
+                    nbytes = os.path.getsize(local_file_path)
+                except OSError as e:
+                    report['failed'].append((swift_path, str(e)))
+                    continue
+                # keep the queue of submitted files short so that the walk
+                # doesn't run far ahead of the uploads
+                if len(pending) >= 2 * max_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                budget.acquire(nbytes)
+                pending.add(executor.submit(upload, local_file_path, swift_path, nbytes))
+            collect(pending)
+        if report['uploaded']:
+            self._invalidate_listing(dest_prefix)
+            self._discard_digests(report['uploaded'])
+        return report
+
+    @instrumented('sync_dir')
+    def sync_dir(self, local_dir, swift_prefix='', **kwargs):
+        """
+        Make the storage location of a local directory (mapped as in upload_files)
+        match the directory, uploading only the files that are new or have changed.
+
+        The local files are merged with a single streamed listing of the location.
+        With compare='mtime' (the default) a file has changed if its size differs
+        from the object's or it was modified after the object was stored. With
+        compare='checksum' it has changed if its size or the ETag it would get once
+        uploaded differ from the object's. Files whose object is stored compressed
+        (see _is_stored_compressed) are compared by mtime or checksum only. Checksums
+        are cached in the JSON <manifest> file if its path is passed, so repeated
+        syncs only hash (or look up the encoding of) the files whose size or mtime
+        changed. Objects without a local file are deleted in
+        batches if delete=True is passed.
+
+        Return a report dictionary with the 'uploaded', 'unchanged' and 'deleted'
+        storage paths and the 'failed' (path, error message) tuples.
+        """
+        compare = kwargs.get('compare', 'mtime')
+        if compare not in ('mtime', 'checksum'):
+            raise ValueError("Unknown compare mode '%s'" % compare)
+        local_dir = local_dir.rstrip(os.sep)
+        dest_prefix = (swift_prefix if swift_prefix else local_dir).rstrip('/') + '/'
+        manifest_path = kwargs.get('manifest')
+        manifest = self._read_sync_manifest(manifest_path) if manifest_path else {}
+        new_manifest = {}
+        changed = []
+        extras = []
+        report = {'uploaded': [], 'unchanged': [], 'deleted': [], 'failed': []}
+        local_files = self._walk_local_files(local_dir, swift_prefix)
+        for swift_path, local_file_path, obj in self._merge_with_objects(local_files,
+                                                                         dest_prefix):
+            if local_file_path is None:
+                extras.append(swift_path)
+                continue
+            if obj is None:
+                changed.append((swift_path, local_file_path))
+                continue
+            try:
+                stat = os.stat(local_file_path)
+                entry = [stat.st_size, stat.st_mtime_ns, obj.etag]
+                if compare == 'checksum' and manifest.get(swift_path) == entry:
+                    is_changed = False
+                else:
+                    compressed = self._is_stored_compressed(swift_path, stat.st_size,
+                                                            obj.size)
+                    if stat.st_size != obj.size and not compressed:
+                        is_changed = True
+                    elif compare == 'mtime':
+                        is_changed = stat.st_mtime > obj.mtime.timestamp()
+                    else:
+                        is_changed = self._get_local_etag(local_file_path, stat.st_size,
+                                                          obj.etag, compressed) != obj.etag
+                if compare == 'checksum' and not is_changed:
+                    new_manifest[swift_path] = entry
+            except (BotoCoreError, ClientError, OSError) as e:
+                report['failed'].append((swift_path, str(e)))
+                continue
+            if is_changed:
+                changed.append((swift_path, local_file_path))
+            else:
+                report['unchanged'].append(swift_path)
+        upload_options = {name: kwargs[name] for name in ('max_workers', 'max_bytes_in_flight')
+                          if name in kwargs}
+        upload_report = self.upload_file_list(changed, dest_prefix, skip_existing=False,
+                                              **upload_options)
+        report['uploaded'] = upload_report['uploaded']
+        report['failed'].extend(upload_report['failed'])
+        if kwargs.get('delete', False) and extras:
+            delete_report = self.delete_many(extras)
+            report['deleted'] = delete_report['deleted']
+            report['failed'].extend(delete_report['failed'])
+        if manifest_path:
+            self._write_sync_manifest(manifest_path, new_manifest)
+        return report
+
+    def _merge_with_objects(self, local_files, prefix):
+        """
+        Merge sorted (storage path, local path) pairs with the sorted listing of
+        <prefix> and yield (storage path, local path, S3ObjectInfo) triples, where the
+        object is None for files that aren't stored and the local path is None for
+        objects without a local file.
+        """
+        remote_objs = self.ls_iter(prefix)
+        obj = next(remote_objs, None)
+        for swift_path, local_file_path in local_files:
+            while obj is not None and obj.key < swift_path:
+                yield obj.key, None, obj
+                obj = next(remote_objs, None)
+            if obj is not None and obj.key == swift_path:
+                yield swift_path, local_file_path, obj
+                obj = next(remote_objs, None)
+            else:
+                yield swift_path, local_file_path, None
+        while obj is not None:
+            yield obj.key, None, obj
+            obj = next(remote_objs, None)
+
+    def _is_stored_compressed(self, swift_path, size, stored_size):
+        """
+        Return True if the object of <stored_size> bytes at <swift_path> is stored gzip
+        compressed with an uncompressed size of <size> bytes (or none recorded), as
+        told by a HEAD request. Only objects of a type that may be stored compressed
+        (whatever the compression mode is now) and whose size differs are looked up.
+        """
+        if stored_size == size or not self.has_compressible_type(swift_path):
+            return False
+        try:
+            head = self._call('head_object', Bucket=self.container_name, Key=swift_path)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        if head.get('ContentEncoding') != 'gzip':
+            return False
+        uncompressed_size = head.get('Metadata', {}).get('uncompressed-size')
+        return uncompressed_size is None or int(uncompressed_size) == size
+
+    def _get_local_etag(self, local_file_path, size, remote_etag, compressed=False):
+        """
+        Return the ETag a local file would get in S3 if it was uploaded the same way as
+        the object with <remote_etag>: the MD5 of the contents for single uploads, or
+        for multipart uploads ("<hex>-<number of parts>") the MD5 of the concatenated
+        part MD5s followed by the number of parts. The part size isn't recorded by S3,
+        so the part sizes used by this storage and by boto3 are tried. If <compressed>
+        is True the ETag is computed for the file compressed as this storage does.
+        """
+        with open(local_file_path, 'rb') as f:
+            if not compressed:
+                return self._get_file_etag(f, size, remote_etag)
+            compressed_file, _, compressed_size = self._compress_contents(f)
+        with compressed_file:
+            return self._get_file_etag(compressed_file, compressed_size, remote_etag)
+
+    def _get_file_etag(self, f, size, remote_etag):
+        """
+        Return the ETag of the <size> bytes of a seekable file object from its start
+        (see _get_local_etag).
+        """
+        if '-' not in remote_etag:
+            md5 = hashlib.md5()
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(chunk)
+            return md5.hexdigest()
+        nparts = int(remote_etag.rsplit('-', 1)[1])
+        etag = None
+        for part_size in (self.multipart_chunksize, 8 * 1024 * 1024,
+                          MULTIPART_MIN_PART_SIZE):
+            if -(-size // part_size) != nparts:
+                continue
+            digests = b''
+            f.seek(0)
+            for part in iter(lambda: f.read(part_size), b''):
+                digests += hashlib.md5(part).digest()
+            etag = '%s-%s' % (hashlib.md5(digests).hexdigest(), nparts)
+            if etag == remote_etag:
+                break
+        return etag
+
+    @staticmethod
+    def _read_sync_manifest(manifest_path):
+        """
+        Return the entries of a sync manifest file or an empty dictionary if it
+        doesn't exist or can't be read.
+        """
+        try:
+            with open(manifest_path) as f:
+                return json.load(f)['files']
+        except (OSError, ValueError, KeyError) as e:
+            logger.info('Ignoring sync manifest %s: %s', manifest_path, str(e))
+            return {}
+
+    @staticmethod
+    def _write_sync_manifest(manifest_path, entries):
+        """
+        Atomically replace a sync manifest file with the provided entries.
+        """
+        tmp_path = '%s.%s.tmp' % (manifest_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': 1, 'files': entries}, f)
+        os.replace(tmp_path, manifest_path)
+
+    @staticmethod
+    def guess_content_type(swift_path):
+        """
+        Return the content type of a file guessed from its name, the same way uploads
+        through Django's storage API get it when the client doesn't send one.
+        """
+        return mimetypes.guess_type(swift_path)[0] or PublicMediaStorage.default_content_type
+
+    @instrumented('save')
+    def _save(self, name, content):
+        """
+        Overriden to upload through the retry policy, to keep the listing cache in
+        sync with uploads through Django's storage API (eg. FileField saves), to
+        store duplicate contents with a server-side copy in dedup mode and to gzip
+        compress the contents in compression mode.
+        """
+        index = self.get_digest_index()
+        digest = None
+        size = content.size
+        key = self._normalize_name(self._clean_name(name))
+        if index is not None and size >= self.dedup_min_size:
+            content.seek(0)
+            digest = self._get_content_digest(content)
+            if self._copy_duplicate(key, digest, size,
+                                    self._get_write_parameters(key, content)):
+                return self._clean_name(name)
+        params = self._get_write_parameters(key, content)
+        if 'ContentEncoding' not in params and \
+                self._should_compress(key, size, params['ContentType']):
+            content.seek(0)
+            tmp, size, compressed_size = self._compress_contents(content)
+            content = File(tmp, name)
+            content.content_type = params['ContentType']
+            content.compression_metadata = self._get_compression_metadata(size,
+                                                                          compressed_size)
+        params = self._get_write_parameters(key, content)
+        if not hasattr(content, 'seekable') or content.seekable():
+            content.seek(0)
+        self._discard_digests([key])
+        try:
+            self._call('upload_fileobj', Fileobj=content, Bucket=self.container_name,
+                       Key=key, ExtraArgs=params, Config=self._transfer_config)
+        finally:
+            if hasattr(content, 'compression_metadata'):
+                content.close()
+        self._invalidate_listing(key)
+        if digest is not None:
+            index.add(key, digest, size)
+        return self._clean_name(name)
+
+    def _get_object_parameters(self, name):
+        """
+        Return the object parameters (AWS_S3_OBJECT_PARAMETERS) of an object written at
+        <name>, with the default ACL unless they set one.
         """
-        # upload all files down the <local_dir>
-        #conn = self.get_connection()
-        #s3 = conn.resource('s3')
-        s3 = self.get_connection()
+        params = self.get_object_parameters(name)
+        if 'ACL' not in params and self.default_acl:
+            params['ACL'] = self.default_acl
+        return params
 
+    def _get_copy_parameters(self, name):
+        """
+        Return the object parameters of a server-side copy to <name> that the copy
+        doesn't carry over from its source, such as the ACL.
+        """
+        return {param: value for param, value in self._get_object_parameters(name).items()
+                if param in COPY_OBJECT_PARAMETERS}
+
+    def _get_write_parameters(self, name, content=None):
+        """
+        Overriden to set the encoding and metadata of the contents compressed by
+        _save.
+        """
+        params = super(PublicMediaStorage, self)._get_write_parameters(name, content)
+        compression_metadata = getattr(content, 'compression_metadata', None)
+        if compression_metadata is not None:
+            params['ContentEncoding'] = 'gzip'
+            params['Metadata'] = dict(params.get('Metadata', {}), **compression_metadata)
+        return params
+
+    @instrumented('exists')
+    def exists(self, name):
+        """
+        Overriden to send the HEAD request through the retry policy.
+        """
+        key = self._normalize_name(self._clean_name(name))
+        try:
+            self._call('head_object', Bucket=self.container_name, Key=key)
+        except ClientError as e:
+            if e.response['ResponseMetadata']['HTTPStatusCode'] == 404:
+                return False
+            raise
+        return True
+
+    @instrumented('delete')
+    def delete(self, name):
+        """
+        Overriden to delete through the retry policy and to keep the listing cache and
+        the digest index in sync with deletes through Django's storage API.
+        """
+        key = self._normalize_name(self._clean_name(name))
+        self._call('delete_object', Bucket=self.container_name, Key=key)
+        self._invalidate_listing(key)
+        self._discard_digests([key])
+
+    def _discard_digests(self, obj_paths):
+        """
+        Drop the deleted or overwritten objects from the digest index in dedup mode, so
+        that they are never picked as the source of a copy of contents they no longer
+        hold.
+        """
+        index = self.get_digest_index()
+        if index is not None and obj_paths:
+            index.discard(obj_paths)
+
+    def _invalidate_listing(self, path):
+        """
+        Drop the cached listings and existence checks that writing or deleting the
+        objects under <path> can change.
+        """
+        cache = get_listing_cache()
+        if cache is None:
+            cache = get_negative_exists_cache()
+        cache.invalidate(path)
+
+    @staticmethod
+    def _walk_local_files(local_dir, swift_prefix=''):
+        """
+        Return the (storage path, local path) pairs for all the files within a local
+        directory, sorted by storage path.
+        """
+        local_files = []
         for root, dirs, files in os.walk(local_dir):
             swift_base = root.replace(local_dir, swift_prefix, 1) if swift_prefix else root
             for filename in files:
-                swift_path = os.path.join(swift_base, filename)
-                if not self.obj_exists(swift_path):
-                    local_file_path = os.path.join(root, filename)
-                    #s3.meta.client.upload_file(Filename=swift_path, Bucket=self.container_name)
-                    s3.upload_file(Filename=local_file_path, Key=swift_path, Bucket=self.container_name)
+                local_files.append((os.path.join(swift_base, filename),
+                                    os.path.join(root, filename)))
+        local_files.sort()
+        return local_files
+
+    def _merge_with_listing(self, local_files, prefix):
+        """
+        Merge sorted (storage path, local path) pairs with the sorted listing of
+        <prefix> and yield (storage path, local path, exists) triples. The listing is
+        consumed page by page and only as far as the local paths require, so each
+        existence check costs about 1/1000th of a listing request.
+        """
+        if not local_files:
+            return
+        remote_keys = (obj.key for obj in self.ls_iter(prefix))
+        remote_key = next(remote_keys, None)
+        for swift_path, local_file_path in local_files:
+            # S3 lists keys in UTF-8 binary order, which matches Python's str order
+            while remote_key is not None and remote_key < swift_path:
+                remote_key = next(remote_keys, None)
+            yield swift_path, local_file_path, remote_key == swift_path
 
 
 class StaticStorage(S3Boto3Storage):
@@ -1,30 +1,51 @@
+import os
+
 from rest_framework import serializers
+from rest_framework.reverse import reverse
+
+from django.conf import settings
+
+from .models import IngestJob, UploadedFile
 
-from .models import UploadedFile
+
+def validate_upload_path(user, upload_path):
+    """
+    Check whether the provided path is under <username>/<uploads>/ and return it
+    stripped of leading and trailing spaces.
+    """
+    upload_path = upload_path.strip(' ')
+    prefix = '{}/{}/'.format(user.username, 'uploads')
+    if not upload_path.startswith(prefix):
+        error_msg = "File path must start with '%s'." % prefix
+        raise serializers.ValidationError([error_msg])
+    return upload_path
 
 
 class UploadedFileSerializer(serializers.HyperlinkedModelSerializer):
     owner = serializers.HyperlinkedRelatedField(view_name='user-detail', read_only=True)
     fname = serializers.FileField(use_url=False)
-    fsize = serializers.ReadOnlyField(source='fname.size')
     upload_path = serializers.CharField(write_only=True)
+    file_resource = serializers.SerializerMethodField()
 
     class Meta:
         model = UploadedFile
-        fields = ('url', 'id', 'creation_date', 'upload_path', 'fname', 'fsize', 'owner')
+        fields = ('url', 'id', 'creation_date', 'upload_path', 'fname', 'fsize',
+                  'etag', 'content_type', 'stored_at', 'file_resource', 'owner')
+        read_only_fields = ('fsize', 'etag', 'content_type', 'stored_at')
+
+    def get_file_resource(self, obj):
+        """
+        Custom method to get the hyperlink to the actual file resource.
+        """
+        filename = os.path.basename(obj.fname.name)
+        return reverse('uploadedfile-resource', request=self.context.get('request'),
+                       kwargs={'pk': obj.id, 'filename': filename})
 
     def validate_upload_path(self, upload_path):
         """
         Overriden to check whether the provided path is under <username>/<uploads>/.
         """
-        # remove leading and trailing slashes
-        upload_path = upload_path.strip(' ')
-        user = self.context['request'].user
-        prefix = '{}/{}/'.format(user.username, 'uploads')
-        if not upload_path.startswith(prefix):
-            error_msg = "File path must start with '%s'." % prefix
-            raise serializers.ValidationError([error_msg])
-        return upload_path
+        return validate_upload_path(self.context['request'].user, upload_path)
 
     def validate(self, data):
         """
@@ -36,3 +57,80 @@ class UploadedFileSerializer(serializers.HyperlinkedModelSerializer):
         owner.upload_path = upload_path
         data['owner'] = owner
         return data
+
+
+class UploadPathSerializer(serializers.Serializer):
+    upload_path = serializers.CharField()
+
+    def validate_upload_path(self, upload_path):
+        """
+        Check the path with the same rules as uploads through UploadedFileSerializer
+        and that there isn't a file at that path already.
+        """
+        upload_path = validate_upload_path(self.context['request'].user, upload_path)
+        if UploadedFile.objects.filter(fname=upload_path).exists():
+            error_msg = "File '%s' already exists." % upload_path
+            raise serializers.ValidationError([error_msg])
+        return upload_path
+
+
+class UploadRequestSerializer(UploadPathSerializer):
+    method = serializers.ChoiceField(choices=['put', 'post', 'multipart'], default='put')
+    fsize = serializers.IntegerField(min_value=0, required=False)
+    content_type = serializers.CharField(required=False)
+
+    def validate(self, data):
+        """
+        Overriden to check that the file size is provided for multipart uploads and
+        that it doesn't exceed the size limit of single PUT/POST uploads.
+        """
+        storage = UploadedFile._meta.get_field('fname').storage
+        fsize = data.get('fsize')
+        if data['method'] == 'multipart' and fsize is None:
+            raise serializers.ValidationError(
+                {'fsize': ['This field is required for multipart uploads.']})
+        if data['method'] != 'multipart' and fsize is not None and \
+                fsize > storage.presigned_upload_max_size:
+            error_msg = 'Files larger than %s bytes require a multipart upload.' % \
+                        storage.presigned_upload_max_size
+            raise serializers.ValidationError({'fsize': [error_msg]})
+        return data
+
+
+class UploadCompleteSerializer(UploadPathSerializer):
+    upload_id = serializers.CharField(required=False)
+
+
+class IngestJobSerializer(serializers.HyperlinkedModelSerializer):
+    owner = serializers.HyperlinkedRelatedField(view_name='user-detail', read_only=True)
+
+    class Meta:
+        model = IngestJob
+        fields = ('url', 'id', 'creation_date', 'start_date', 'end_date', 'local_dir',
+                  'upload_path', 'status', 'total_files', 'total_bytes', 'total_batches',
+                  'done_files', 'done_bytes', 'done_batches', 'failed_files',
+                  'error_message', 'owner')
+        read_only_fields = ('start_date', 'end_date', 'status', 'total_files',
+                            'total_bytes', 'total_batches', 'done_files', 'done_bytes',
+                            'done_batches', 'failed_files', 'error_message')
+
+    def validate_local_dir(self, local_dir):
+        """
+        Custom method to check that the local directory is an existing directory
+        under the INGEST_ROOT_DIR setting. Return its absolute path.
+        """
+        root_dir = os.path.realpath(settings.INGEST_ROOT_DIR)
+        path = os.path.realpath(os.path.join(root_dir, local_dir))
+        if os.path.commonpath([root_dir, path]) != root_dir or not os.path.isdir(path):
+            error_msg = "Directory '%s' does not exist." % local_dir
+            raise serializers.ValidationError([error_msg])
+        return path
+
+    def validate_upload_path(self, upload_path):
+        """
+        Custom method to check the storage prefix with the same rules as the upload
+        paths of uploaded files.
+        """
+        user = self.context['request'].user
+        return validate_upload_path(user, upload_path).rstrip('/')
+
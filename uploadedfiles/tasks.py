@@ -0,0 +1,146 @@
+import logging
+import os
+
+from celery import shared_task
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import IngestBatch, IngestJob, UploadedFile
+
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def start_ingest_job(job_id):
+    """
+    Walk the local directory of an ingest job, record the job totals and its batches
+    of INGEST_BATCH_SIZE files and queue one ingest_batch task per batch, so that the
+    batches are spread over all the workers.
+
+    Every batch is recorded before any is queued and marked once it is queued, so a
+    task redelivered after an interrupted run queues the batches that run didn't get
+    to (a batch that is queued twice is only ingested once).
+    """
+    job = IngestJob.objects.get(pk=job_id)
+    if job.status not in ('created', 'running'):
+        return
+    if job.status == 'created' and not job.batches.exists():
+        storage = UploadedFile._meta.get_field('fname').storage
+        batch_size = getattr(settings, 'INGEST_BATCH_SIZE', 500)
+        batches = []
+        total_bytes = 0
+        try:
+            local_files = storage._walk_local_files(job.local_dir, job.upload_path)
+            for i in range(0, len(local_files), batch_size):
+                files = []
+                for swift_path, local_file_path in local_files[i:i + batch_size]:
+                    size = os.path.getsize(local_file_path)
+                    files.append([swift_path, local_file_path, size])
+                    total_bytes += size
+                batches.append(IngestBatch(job_id=job_id, number=len(batches),
+                                           files=files))
+        except OSError as e:
+            logger.error('Ingest job %s failed: %s', job_id, str(e))
+            IngestJob.objects.filter(pk=job_id, status='created').update(
+                status='failed', error_message=str(e), end_date=timezone.now())
+            return
+        with transaction.atomic():
+            job = IngestJob.objects.select_for_update().get(pk=job_id)
+            if job.status != 'created' or job.batches.exists():
+                return
+            IngestBatch.objects.bulk_create(batches)
+            job.total_files = len(local_files)
+            job.total_bytes = total_bytes
+            job.total_batches = len(batches)
+            job.save(update_fields=['total_files', 'total_bytes', 'total_batches'])
+    for batch_id in job.batches.filter(queued=False).values_list('id', flat=True):
+        ingest_batch.delay(batch_id)
+        IngestBatch.objects.filter(pk=batch_id).update(queued=True)
+    IngestJob.objects.filter(pk=job_id, status='created').update(
+        status='running', start_date=timezone.now())
+    # the batches may all be done already, or there may be none
+    update_ingest_progress(job_id)
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+def ingest_batch(batch_id):
+    """
+    Upload a batch of files of an ingest job, register the uploaded files with the
+    metadata of the stored objects and record the batch as done.
+
+    The task is only acknowledged once it has run, so a batch interrupted by a worker
+    restart is run again; files uploaded by the interrupted run are then skipped. A
+    batch that is already done is not run again, so it only counts once in the job
+    progress.
+    """
+    batch = IngestBatch.objects.select_related('job').get(pk=batch_id)
+    if batch.done:
+        return {'done': batch.done_files, 'failed': batch.failed_files}
+    storage = UploadedFile._meta.get_field('fname').storage
+    local_files = [(swift_path, local_file_path)
+                   for swift_path, local_file_path, size in batch.files]
+    sizes = {swift_path: size for swift_path, local_file_path, size in batch.files}
+    dest_prefix = os.path.commonprefix([swift_path for swift_path, _ in local_files])
+    report = storage.upload_file_list(local_files, dest_prefix)
+
+    done = sorted(report['uploaded'] + report['skipped'])
+    user_files = []
+    if done:
+        # a single listing of the range of keys of the batch gets the metadata of all
+        # its objects
+        objs = {}
+        for obj in storage.ls_iter(dest_prefix, start_at=done[0]):
+            if obj.key > done[-1]:
+                break
+            objs[obj.key] = obj
+        for swift_path in done:
+            user_file = UploadedFile(owner_id=batch.job.owner_id,
+                                     content_type=storage.guess_content_type(swift_path))
+            user_file.fname.name = swift_path
+            if swift_path in objs:
+                user_file.set_storage_metadata(objs[swift_path])
+            # the listed size of compressed objects is their stored size
+            user_file.fsize = sizes[swift_path]
+            user_files.append(user_file)
+    UploadedFile.objects.bulk_create(user_files, ignore_conflicts=True)
+
+    error_message = report['failed'][-1][1] if report['failed'] else ''
+    with transaction.atomic():
+        updated = IngestBatch.objects.filter(pk=batch_id, done=False).update(
+            done=True, end_date=timezone.now(), done_files=len(done),
+            done_bytes=sum(sizes[path] for path in done),
+            failed_files=len(report['failed']), error_message=error_message)
+        if updated:
+            update_ingest_progress(batch.job_id)
+    return {'done': len(done), 'failed': len(report['failed'])}
+
+
+def update_ingest_progress(job_id):
+    """
+    Set the progress counters of an ingest job from its done batches and mark a
+    running job finished once all of them are. The job row is locked while the
+    counters are computed, so that concurrent batches don't overwrite each other's
+    progress.
+    """
+    with transaction.atomic():
+        job = IngestJob.objects.select_for_update().get(pk=job_id)
+        done_batches = job.batches.filter(done=True)
+        progress = done_batches.aggregate(
+            done_batches=Count('id'), done_files=Coalesce(Sum('done_files'), 0),
+            done_bytes=Coalesce(Sum('done_bytes'), 0),
+            failed_files=Coalesce(Sum('failed_files'), 0))
+        for field, value in progress.items():
+            setattr(job, field, value)
+        last_failed = done_batches.exclude(error_message='').order_by('-end_date').first()
+        if last_failed is not None:
+            job.error_message = last_failed.error_message
+        update_fields = list(progress) + ['error_message']
+        if job.status == 'running' and job.done_batches == job.total_batches:
+            job.status = 'finished'
+            job.end_date = timezone.now()
+            update_fields += ['status', 'end_date']
+        job.save(update_fields=update_fields)
@@ -0,0 +1,90 @@
+import io
+import json
+import logging
+import os
+import tempfile
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from uploadedfiles.benchmarks import StorageBenchmark
+from uploadedfiles.s3_fake import FakeS3Client
+from uploadedfiles.s3_storage import MULTIPART_MIN_PART_SIZE
+
+
+# To run a test from the command line:
+#    python manage.py test uploadedfiles.tests.test_benchmarks.FakeS3ClientTests
+class FakeS3ClientTests(TestCase):
+    """
+    Test the storage operations against the in-process fake S3 client.
+    """
+
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        self.client = FakeS3Client()
+        self.s3_manager = StorageBenchmark.get_storage(self.client)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_multipart_upload_and_ranged_download(self):
+        contents = os.urandom(MULTIPART_MIN_PART_SIZE + 10)
+        self.s3_manager.upload_obj('chris/uploads/f', contents, multipart_threshold=1,
+                                   part_size=MULTIPART_MIN_PART_SIZE)
+        self.assertEqual(self.client.requests['upload_part'], 2)
+        self.assertEqual(self.s3_manager.download_obj('chris/uploads/f'), contents)
+        self.assertEqual(self.s3_manager.download_obj_range('chris/uploads/f', 5, 9),
+                         contents[5:10])
+        self.assertTrue(self.s3_manager.get_obj_metadata('chris/uploads/f').etag
+                        .endswith('-2'))
+
+    def test_paginated_listing_with_delimiter(self):
+        for key in ('chris/a/f1', 'chris/a/f2', 'chris/b/f1', 'chris/c', 'other/f'):
+            self.client.put(key, b'x')
+        objs = list(self.s3_manager.ls_iter('chris/', delimiter='/', page_size=2))
+        self.assertEqual([obj.key for obj in objs], ['chris/a/', 'chris/b/', 'chris/c'])
+        self.assertEqual(self.client.requests['list_objects_v2'], 2)
+        self.assertEqual(self.s3_manager.ls('chris/a'), ['chris/a/f1', 'chris/a/f2'])
+
+
+class StorageBenchmarkTests(TestCase):
+    """
+    Test the storage benchmark suite with small workloads.
+    """
+
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        self.sizes = {'ls_objects': 2500, 'small_files': 5, 'small_file_size': 100,
+                      'large_files': 1, 'large_file_size': 1000, 'download_size': 1000,
+                      'copies': 3, 'deletes': 1500, 'exists_checks': 4}
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_run_reports_timings_and_requests(self):
+        results = StorageBenchmark(latency=0, repeat=2, **self.sizes).run()
+        by_name = {result['name']: result for result in results['results']}
+        self.assertEqual(set(by_name), set(StorageBenchmark.benchmarks))
+        self.assertEqual(by_name['ls']['runs'], 2)
+        self.assertEqual(by_name['ls']['operations'], 2500)
+        self.assertEqual(by_name['ls']['requests'], {'list_objects_v2': 3})
+        self.assertEqual(by_name['delete_many']['requests'], {'delete_objects': 2})
+        self.assertEqual(by_name['upload_files_small']['bytes'], 500)
+        self.assertLessEqual(by_name['download_obj']['seconds']['min'],
+                             by_name['download_obj']['seconds']['median'])
+
+    def test_unknown_benchmark_is_rejected(self):
+        with self.assertRaises(ValueError):
+            StorageBenchmark(**self.sizes).run(['nope'])
+
+    def test_command_writes_json_results(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = os.path.join(tmp_dir, 'results.json')
+            options = {name: value for name, value in self.sizes.items()}
+            call_command('benchmark_storage', benchmark=['ls', 'copy_obj'], latency_ms=0,
+                         repeat=1, output=output, stdout=io.StringIO(), **options)
+            with open(output) as f:
+                results = json.load(f)
+        self.assertEqual([result['name'] for result in results['results']],
+                         ['ls', 'copy_obj'])
+        self.assertEqual(results['config']['sizes']['copies'], 3)
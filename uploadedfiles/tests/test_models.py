@@ -1,9 +1,14 @@
+import datetime
+import io
 import logging
 from unittest import mock
 import django
+from django.core.files.base import ContentFile
+from django.core.management import call_command
 from django.test import TestCase
 from django.contrib.auth.models import User
 from uploadedfiles.models import UploadedFile, uploaded_file_path
+from uploadedfiles.s3_storage import S3ObjectInfo, S3ObjectMetadata
 import os
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE',
@@ -31,3 +36,110 @@ class UploadedFileModelTests(TestCase):
         filename = 'file1.txt'
         file_path = uploaded_file_path(uploadedfile_instance, filename)
         self.assertEqual(file_path, 'foo/uploads/myuploads')
+
+    def test_save_records_storage_metadata_of_uploaded_file(self):
+        user = User.objects.create_user(username='foo', password='foopass')
+        user.upload_path = 'foo/uploads/file1.txt'
+        storage = UploadedFile._meta.get_field('fname').storage
+        mtime = datetime.datetime(2022, 9, 1, tzinfo=datetime.timezone.utc)
+        metadata = S3ObjectMetadata('foo/uploads/file1.txt', 8, 'abc', 'text/plain', mtime)
+        with mock.patch.object(storage, 'exists', return_value=False), \
+                mock.patch.object(storage, '_save', side_effect=lambda name, content: name), \
+                mock.patch.object(storage, 'get_obj_metadata',
+                                  return_value=metadata) as head_mock:
+            uploadedfile = UploadedFile(owner=user)
+            uploadedfile.fname = ContentFile(b'contents', name='file1.txt')
+            uploadedfile.save()
+            uploadedfile.save()
+        head_mock.assert_called_once_with('foo/uploads/file1.txt')
+        uploadedfile = UploadedFile.objects.get(pk=uploadedfile.pk)
+        self.assertEqual((uploadedfile.fsize, uploadedfile.etag, uploadedfile.content_type,
+                          uploadedfile.stored_at), (8, 'abc', 'text/plain', mtime))
+
+    def test_backfill_uploadedfile_metadata_command(self):
+        user = User.objects.create_user(username='foo', password='foopass')
+        for fname in ('foo/uploads/f1.txt', 'foo/uploads/f2'):
+            uploadedfile = UploadedFile(owner=user)
+            uploadedfile.fname.name = fname
+            uploadedfile.save()
+        storage = UploadedFile._meta.get_field('fname').storage
+        mtime = datetime.datetime(2022, 9, 1, tzinfo=datetime.timezone.utc)
+        listing = [S3ObjectInfo('foo/uploads/f1.txt', 3, 'e1', mtime),
+                   S3ObjectInfo('foo/uploads/f2', 5, 'e2', mtime),
+                   S3ObjectInfo('foo/uploads/orphan', 7, 'e3', mtime)]
+        # f1.txt may be stored compressed, so its uncompressed size comes from a HEAD
+        head = S3ObjectMetadata('foo/uploads/f1.txt', 30, 'e1', 'text/plain', mtime)
+        with mock.patch.object(storage, 'ls_iter', return_value=iter(listing)), \
+                mock.patch.object(storage, 'get_obj_metadata',
+                                  return_value=head) as head_mock:
+            call_command('backfill_uploadedfile_metadata', '--batch-size', '2',
+                         stdout=io.StringIO())
+        head_mock.assert_called_once_with('foo/uploads/f1.txt')
+        rows = UploadedFile.objects.order_by('fname')
+        self.assertEqual([(f.fsize, f.etag, f.content_type) for f in rows],
+                         [(30, 'e1', 'text/plain'), (5, 'e2', '')])
+
+
+class UploadedFileManagerTests(TestCase):
+
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        self.user = User.objects.create_user(username='foo', password='foopass')
+        for fname in ('foo/uploads/a/f1', 'foo/uploads/a/f2', 'foo/uploads/b/f3'):
+            uploadedfile = UploadedFile(owner=self.user)
+            uploadedfile.fname.name = fname
+            uploadedfile.save()
+        self.storage = UploadedFile._meta.get_field('fname').storage
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_delete_prefix_removes_rows_of_deleted_files(self):
+        report = {'deleted': ['foo/uploads/a/f1'],
+                  'failed': [('foo/uploads/a/f2', 'AccessDenied: Denied')]}
+        with mock.patch.object(self.storage, 'delete_prefix', return_value=report):
+            UploadedFile.objects.delete_prefix('foo/uploads/a/')
+        self.assertEqual(sorted(f.fname.name for f in UploadedFile.objects.all()),
+                         ['foo/uploads/a/f2', 'foo/uploads/b/f3'])
+
+    def test_delete_files(self):
+        report = {'deleted': ['foo/uploads/a/f1', 'foo/uploads/b/f3'], 'failed': []}
+        with mock.patch.object(self.storage, 'delete_many',
+                               return_value=report) as delete_mock:
+            UploadedFile.objects.delete_files(['foo/uploads/a/f1', 'foo/uploads/b/f3'])
+        delete_mock.assert_called_once_with(['foo/uploads/a/f1', 'foo/uploads/b/f3'])
+        self.assertEqual([f.fname.name for f in UploadedFile.objects.all()],
+                         ['foo/uploads/a/f2'])
+
+    def test_large_deletes_are_batched(self):
+        report = {'deleted': ['foo/uploads/a/f1', 'foo/uploads/a/f2', 'foo/uploads/b/f3'],
+                  'failed': []}
+        with mock.patch('uploadedfiles.models.DELETE_BATCH_SIZE', 2), \
+                mock.patch.object(self.storage, 'delete_many', return_value=report), \
+                self.assertNumQueries(2):
+            UploadedFile.objects.delete_files(report['deleted'])
+        self.assertFalse(UploadedFile.objects.exists())
+
+    def test_move_prefix_renames_rows_of_moved_files(self):
+        report = {'moved': [('foo/uploads/a/f1', 'foo/uploads/c/f1')],
+                  'failed': [('foo/uploads/a/f2', 'AccessDenied: Denied')]}
+        with mock.patch.object(self.storage, 'move_prefix', return_value=report):
+            UploadedFile.objects.move_prefix('foo/uploads/a/', 'foo/uploads/c/')
+        self.assertEqual(sorted(f.fname.name for f in UploadedFile.objects.all()),
+                         ['foo/uploads/a/f2', 'foo/uploads/b/f3', 'foo/uploads/c/f1'])
+
+    def test_move_prefix_keeps_rows_of_files_that_were_not_listed(self):
+        report = {'moved': [('foo/uploads/a/f1', 'foo/uploads/c/f1')], 'failed': []}
+        with mock.patch.object(self.storage, 'move_prefix', return_value=report):
+            UploadedFile.objects.move_prefix('foo/uploads/a/', 'foo/uploads/c/')
+        self.assertEqual(sorted(f.fname.name for f in UploadedFile.objects.all()),
+                         ['foo/uploads/a/f2', 'foo/uploads/b/f3', 'foo/uploads/c/f1'])
+
+    def test_move_prefix_checks_collisions_before_moving(self):
+        uploadedfile = UploadedFile(owner=self.user)
+        uploadedfile.fname.name = 'foo/uploads/c/f2'
+        uploadedfile.save()
+        with mock.patch.object(self.storage, 'move_prefix') as move_mock:
+            with self.assertRaises(ValueError):
+                UploadedFile.objects.move_prefix('foo/uploads/a/', 'foo/uploads/c/')
+        move_mock.assert_not_called()
@@ -1,17 +1,37 @@
+import datetime
+import gzip
 import logging
 import json
+import hashlib
 import io
+import os
+import shutil
+import tempfile
+import threading
 from unittest import mock
 
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import ClientError, EndpointConnectionError
+from botocore.response import StreamingBody
+
 from django.test import TestCase, tag
 from django.conf import settings
+from django.core.files.base import ContentFile
 from django.contrib.auth.models import User
 from django.urls import reverse
 
 from rest_framework import status
 
-from uploadedfiles.s3_storage import PublicMediaStorage
+from uploadedfiles.s3_storage import (PublicMediaStorage, S3ObjectInfo,
+                                      MULTIPART_MIN_PART_SIZE, ensure_bucket)
 from uploadedfiles.models import UploadedFile, uploaded_file_path
+from uploadedfiles.s3_cache import (LocMemListingCache, get_listing_cache,
+                                    get_presigned_url_cache)
+from uploadedfiles.s3_disk_cache import DiskObjectCache
+from uploadedfiles.s3_fake import FakeS3Client
+from uploadedfiles.s3_metrics import Histogram, StorageMetrics
+from uploadedfiles.s3_retry import RetryPolicy, classify_error
+from uploadedfiles import s3_metrics
 from uploadedfiles import views
 
 
@@ -44,6 +64,7 @@ class PublicMediaStorageTests(TestCase):
 
         # create a file in the DB "already uploaded" to the server)
         self.s3_manager = PublicMediaStorage()
+        ensure_bucket()
 
     def tearDown(self):
         # re-enable logging
@@ -102,3 +123,1124 @@ class PublicMediaStorageTests(TestCase):
                 self.assertTrue(self.s3_manager.obj_exists(swift_path), f'{swift_path} not found')
                 self.s3_manager.delete_obj(root_path)
                 self.s3_manager.delete_obj(swift_path)
+
+
+class StorageTestCase(TestCase):
+    """
+    Base class of the tests of PublicMediaStorage against a test double of the S3
+    client: self.s3_manager sends its requests to self.client, an instance of
+    <client_class>. Logging is disabled while the tests run.
+    """
+    client_class = mock.Mock
+
+    def setUp(self):
+        # avoid cluttered console output (for instance logging all the http requests)
+        logging.disable(logging.WARNING)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.s3_manager = PublicMediaStorage()
+        self.s3_manager.container_name = settings.AWS_STORAGE_BUCKET_NAME
+        self.client = self.client_class()
+        self.use_client(self.client)
+
+    def use_client(self, client):
+        """
+        Make self.s3_manager send its requests to <client>.
+        """
+        self.s3_manager.get_connection = mock.Mock(return_value=client)
+
+
+class PublicMediaStorageUploadFilesTests(StorageTestCase):
+    """
+    Test the concurrent upload_files engine against a mocked S3 client.
+    """
+
+    def setUp(self):
+        super(PublicMediaStorageUploadFilesTests, self).setUp()
+        self.local_dir = os.path.join(os.path.dirname(__file__), 'files_to_upload')
+
+    def test_upload_files_report(self):
+        existing = os.path.join('chris/', 'file1.txt')
+        listing = [S3ObjectInfo(key, 1, 'etag', None)
+                   for key in ('chris/a', existing, 'chris/z')]
+        with mock.patch.object(self.s3_manager, 'ls_iter', return_value=iter(listing)):
+            report = self.s3_manager.upload_files(self.local_dir, swift_prefix='chris/',
+                                                  max_workers=2)
+        self.assertEqual(report['skipped'], [existing])
+        self.assertEqual(sorted(report['uploaded']),
+                         ['chris//subdir/file3.txt', 'chris/file2.txt'])
+        self.assertEqual(report['failed'], [])
+        self.assertEqual(self.client.upload_file.call_count, 2)
+
+    def test_upload_files_reports_failures(self):
+        self.client.upload_file.side_effect = OSError('boom')
+        with mock.patch.object(self.s3_manager, 'ls_iter', return_value=iter([])):
+            report = self.s3_manager.upload_files(self.local_dir, max_workers=1,
+                                                  max_bytes_in_flight=1)
+        self.assertEqual(report['uploaded'], [])
+        self.assertEqual(len(report['failed']), 3)
+        self.assertEqual(report['failed'][0][1], 'boom')
+
+    def test_upload_files_lists_destination_once(self):
+        page = {'Contents': [{'Key': 'chris//subdir/file3.txt', 'Size': 1, 'ETag': '"e"',
+                              'LastModified': None}]}
+        self.client.list_objects_v2.return_value = page
+        report = self.s3_manager.upload_files(self.local_dir, swift_prefix='chris/')
+        self.assertEqual(report['skipped'], ['chris//subdir/file3.txt'])
+        self.client.list_objects_v2.assert_called_once_with(
+            Bucket=settings.AWS_STORAGE_BUCKET_NAME, Prefix='chris/')
+
+
+class PublicMediaStorageSyncDirTests(StorageTestCase):
+    """
+    Test the incremental sync_dir against a mocked S3 client.
+    """
+
+    def setUp(self):
+        super(PublicMediaStorageSyncDirTests, self).setUp()
+        self.local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.local_dir)
+        for name in ('f1', 'f2', 'f3'):
+            with open(os.path.join(self.local_dir, name), 'wb') as f:
+                f.write(b'contents %s' % name.encode())
+        self.md5 = hashlib.md5(b'contents f1').hexdigest()
+        self.future = datetime.datetime.now(datetime.timezone.utc) + \
+            datetime.timedelta(hours=1)
+        self.client.delete_objects.return_value = {}
+
+    def sync(self, listing, **kwargs):
+        with mock.patch.object(self.s3_manager, 'ls_iter', return_value=iter(listing)):
+            return self.s3_manager.sync_dir(self.local_dir, 'chris', **kwargs)
+
+    def test_sync_dir_uploads_new_and_changed_files_only(self):
+        listing = [S3ObjectInfo('chris/f1', 11, self.md5, self.future),
+                   S3ObjectInfo('chris/f2', 3, 'etag', self.future),
+                   S3ObjectInfo('chris/zz', 3, 'etag', self.future)]
+        report = self.sync(listing, delete=True)
+        self.assertEqual(report['unchanged'], ['chris/f1'])
+        self.assertEqual(sorted(report['uploaded']), ['chris/f2', 'chris/f3'])
+        self.assertEqual(report['deleted'], ['chris/zz'])
+        self.assertEqual(self.client.upload_file.call_count, 2)
+
+    def test_sync_dir_checksum_mode_caches_checksums_in_manifest(self):
+        past = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+        listing = [S3ObjectInfo('chris/f1', 11, self.md5, past),
+                   S3ObjectInfo('chris/f2', 11, 'etag', past),
+                   S3ObjectInfo('chris/f3', 11, 'etag', past)]
+        manifest = os.path.join(tempfile.mkdtemp(), 'manifest.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(manifest))
+        report = self.sync(listing, compare='checksum', manifest=manifest)
+        self.assertEqual(report['unchanged'], ['chris/f1'])
+        self.assertEqual(sorted(report['uploaded']), ['chris/f2', 'chris/f3'])
+        with mock.patch.object(self.s3_manager, '_get_local_etag') as etag_mock:
+            report = self.sync(listing[:1], compare='checksum', manifest=manifest)
+        etag_mock.assert_not_called()
+        self.assertEqual(report['unchanged'], ['chris/f1'])
+
+    def test_get_local_etag_of_multipart_object(self):
+        local_file_path = os.path.join(self.local_dir, 'big')
+        contents = b'a' * MULTIPART_MIN_PART_SIZE + b'b'
+        with open(local_file_path, 'wb') as f:
+            f.write(contents)
+        digests = hashlib.md5(contents[:MULTIPART_MIN_PART_SIZE]).digest() + \
+            hashlib.md5(b'b').digest()
+        etag = '%s-2' % hashlib.md5(digests).hexdigest()
+        self.assertEqual(self.s3_manager._get_local_etag(local_file_path, len(contents),
+                                                         etag), etag)
+
+
+class PublicMediaStorageDownloadFilesTests(StorageTestCase):
+    """
+    Test the concurrent download_files engine against a mocked S3 client.
+    """
+
+    def setUp(self):
+        super(PublicMediaStorageDownloadFilesTests, self).setUp()
+        self.local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.local_dir)
+        self.objects = {'chris/study/f1': b'contents f1',
+                        'chris/study/sub/f2': b'0123456789' * 3}
+        self.mtime = datetime.datetime(2022, 9, 1, tzinfo=datetime.timezone.utc)
+        self.listing = [S3ObjectInfo(key, len(contents), 'etag', self.mtime)
+                        for key, contents in sorted(self.objects.items())]
+        self.client.get_object.side_effect = self.get_object
+
+    def get_object(self, Bucket, Key, Range=None):
+        contents = self.objects[Key]
+        if Range:
+            first, last = Range[len('bytes='):].split('-')
+            contents = contents[int(first):int(last) + 1]
+        return {'Body': StreamingBody(io.BytesIO(contents), len(contents)),
+                'ContentLength': len(contents)}
+
+    def download(self, **kwargs):
+        with mock.patch.object(self.s3_manager, 'ls_iter',
+                               return_value=iter(self.listing)):
+            return self.s3_manager.download_files('chris/study/', self.local_dir,
+                                                  **kwargs)
+
+    def test_download_files_writes_objects_with_ranged_parts(self):
+        report = self.download(multipart_download_threshold=20, part_size=7)
+        self.assertEqual(len(report['downloaded']), 2)
+        for key, contents in self.objects.items():
+            with open(os.path.join(self.local_dir, key[len('chris/study/'):]), 'rb') as f:
+                self.assertEqual(f.read(), contents)
+        # f1 in one GET and f2 in ceil(30 / 7) ranged GETs
+        self.assertEqual(self.client.get_object.call_count, 6)
+
+    def test_download_files_skips_unchanged_files(self):
+        self.download()
+        self.client.get_object.reset_mock()
+        report = self.download()
+        self.assertEqual(len(report['skipped']), 2)
+        self.client.get_object.assert_not_called()
+
+    def test_iter_obj_streams_yields_objects_in_listing_order(self):
+        with mock.patch.object(self.s3_manager, 'ls_iter',
+                               return_value=iter(self.listing)):
+            streams = self.s3_manager.iter_obj_streams('chris/study/', read_ahead=2)
+            self.assertEqual([(obj.key, b''.join(stream)) for obj, stream in streams],
+                             sorted(self.objects.items()))
+
+    def test_download_files_failure_leaves_no_partial_file(self):
+        self.client.get_object.side_effect = ClientError(
+            {'Error': {'Code': 'AccessDenied'}}, 'GetObject')
+        report = self.download()
+        self.assertEqual(len(report['failed']), 2)
+        self.assertEqual(os.listdir(self.local_dir), ['sub'])
+
+
+class PublicMediaStorageListingTests(StorageTestCase):
+    """
+    Test the listing methods against a mocked S3 client.
+    """
+
+    def setUp(self):
+        super(PublicMediaStorageListingTests, self).setUp()
+        self.list_objects = self.client.list_objects_v2
+        cache = get_listing_cache()
+        if cache is not None:
+            cache.clear()
+
+    def test_ls_iter_yields_object_metadata(self):
+        self.list_objects.side_effect = [
+            {'Contents': [{'Key': 'chris/uploads/f1', 'Size': 3, 'ETag': '"abc"',
+                           'LastModified': 'mtime1'}],
+             'IsTruncated': True, 'NextContinuationToken': 'token1'},
+            {'KeyCount': 0, 'IsTruncated': True, 'NextContinuationToken': 'token2'},
+            {'Contents': [{'Key': 'chris/uploads/f2', 'Size': 5, 'ETag': '"def"',
+                           'LastModified': 'mtime2'}]}]
+        results = list(self.s3_manager.ls_iter('chris/uploads', page_size=1))
+        self.assertEqual(results, [S3ObjectInfo('chris/uploads/f1', 3, 'abc', 'mtime1'),
+                                   S3ObjectInfo('chris/uploads/f2', 5, 'def', 'mtime2')])
+        self.assertEqual(self.list_objects.call_count, 3)
+        self.list_objects.assert_called_with(Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+                                             Prefix='chris/uploads', MaxKeys=1,
+                                             ContinuationToken='token2')
+
+    def test_ls_iter_delimiter_yields_common_prefixes(self):
+        self.list_objects.return_value = {
+            'Contents': [{'Key': 'chris/uploads/f1', 'Size': 3, 'ETag': '"abc"',
+                          'LastModified': 'mtime1'}],
+            'CommonPrefixes': [{'Prefix': 'chris/uploads/dir1/'}]}
+        results = list(self.s3_manager.ls_iter('chris/uploads/', delimiter='/'))
+        self.assertEqual(results[1], S3ObjectInfo('chris/uploads/dir1/', None, None, None))
+        self.assertEqual(self.list_objects.call_args[1]['Delimiter'], '/')
+
+    def test_ls_returns_keys(self):
+        self.list_objects.return_value = {
+            'Contents': [{'Key': 'chris/uploads/f1', 'Size': 3, 'ETag': '"abc"',
+                          'LastModified': 'mtime1'}]}
+        self.assertEqual(self.s3_manager.ls('chris/uploads'), ['chris/uploads/f1'])
+        self.assertEqual(self.s3_manager.ls(''), [])
+
+
+class PublicMediaStorageMultipartTests(StorageTestCase):
+    """
+    Test multipart uploads in upload_obj against a mocked S3 client.
+    """
+
+    def setUp(self):
+        super(PublicMediaStorageMultipartTests, self).setUp()
+        self.client.create_multipart_upload.return_value = {'UploadId': 'upload1'}
+        self.client.upload_part.side_effect = lambda **kw: {
+            'ETag': '"%s"' % hashlib.md5(kw['Body']).hexdigest()}
+        self.part_size = MULTIPART_MIN_PART_SIZE
+        self.contents = b'a' * self.part_size + b'b' * self.part_size + b'c'
+
+    def test_upload_obj_small_contents_single_put(self):
+        self.s3_manager.upload_obj('chris/uploads/small', 'small contents')
+        self.client.put_object.assert_called_once_with(
+            Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key='chris/uploads/small',
+            Body=b'small contents')
+        self.client.create_multipart_upload.assert_not_called()
+
+    def test_upload_obj_multipart_from_file(self):
+        self.s3_manager.upload_obj('chris/uploads/big', io.BytesIO(self.contents),
+                                   multipart_threshold=1, part_size=self.part_size)
+        self.assertEqual(self.client.upload_part.call_count, 3)
+        parts = self.client.complete_multipart_upload.call_args[1]['MultipartUpload']
+        self.assertEqual([p['PartNumber'] for p in parts['Parts']], [1, 2, 3])
+        self.client.abort_multipart_upload.assert_not_called()
+
+    def test_upload_obj_multipart_from_iterator(self):
+        chunks = (self.contents[i:i + 1000] for i in range(0, len(self.contents), 1000))
+        self.s3_manager.upload_obj('chris/uploads/big', chunks, part_size=self.part_size)
+        sizes = sorted(len(c[1]['Body']) for c in self.client.upload_part.call_args_list)
+        self.assertEqual(sizes, [1, self.part_size, self.part_size])
+
+    def test_upload_obj_multipart_resume_skips_stored_parts(self):
+        stored = {'Parts': [{'PartNumber': 1, 'ETag': '"%s"' % hashlib.md5(
+            self.contents[:self.part_size]).hexdigest()}]}
+        self.client.list_parts.return_value = stored
+        upload_id = self.s3_manager.upload_obj_multipart('chris/uploads/big',
+                                                         self.contents,
+                                                         upload_id='upload0',
+                                                         part_size=self.part_size)
+        self.assertEqual(upload_id, 'upload0')
+        self.client.create_multipart_upload.assert_not_called()
+        part_numbers = sorted(c[1]['PartNumber']
+                              for c in self.client.upload_part.call_args_list)
+        self.assertEqual(part_numbers, [2, 3])
+
+    def test_upload_obj_multipart_failure_aborts(self):
+        self.client.upload_part.side_effect = OSError('connection reset')
+        with self.assertRaises(OSError):
+            self.s3_manager.upload_obj_multipart('chris/uploads/big', self.contents)
+        self.client.abort_multipart_upload.assert_called_once_with(
+            Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key='chris/uploads/big',
+            UploadId='upload1')
+
+    def test_upload_obj_multipart_resumable_failure_keeps_parts(self):
+        self.client.upload_part.side_effect = OSError('connection reset')
+        with self.assertRaises(OSError):
+            self.s3_manager.upload_obj_multipart('chris/uploads/big', self.contents,
+                                                 resumable=True)
+        self.client.abort_multipart_upload.assert_not_called()
+
+    def test_upload_obj_multipart_resume_after_failed_first_attempt(self):
+        client = FakeS3Client()
+        self.use_client(client)
+        upload_part = client.upload_part
+
+        def fail_part_2(**kwargs):
+            if kwargs['PartNumber'] == 2:
+                raise ClientError({'Error': {'Code': 'AccessDenied'}}, 'UploadPart')
+            return upload_part(**kwargs)
+
+        with mock.patch.object(client, 'upload_part', side_effect=fail_part_2):
+            with self.assertRaises(ClientError):
+                self.s3_manager.upload_obj_multipart('chris/uploads/big', self.contents,
+                                                     resume=True, max_workers=1,
+                                                     part_size=self.part_size)
+        self.assertNotIn('abort_multipart_upload', client.requests)
+        self.s3_manager.upload_obj_multipart('chris/uploads/big', self.contents,
+                                             resume=True, part_size=self.part_size)
+        self.assertEqual(client.requests['create_multipart_upload'], 1)
+        self.assertEqual(client.requests['upload_part'], 3)
+        self.assertEqual(self.s3_manager.download_obj('chris/uploads/big'), self.contents)
+
+    def test_create_presigned_multipart_upload(self):
+        self.client.generate_presigned_url.side_effect = \
+            lambda op, Params, ExpiresIn: 'http://s3/%s' % Params['PartNumber']
+        upload = self.s3_manager.create_presigned_multipart_upload(
+            'chris/uploads/big', len(self.contents), part_size=self.part_size)
+        self.assertEqual(upload['upload_id'], 'upload1')
+        self.assertEqual(upload['part_size'], self.part_size)
+        self.assertEqual([p['url'] for p in upload['parts']],
+                         ['http://s3/1', 'http://s3/2', 'http://s3/3'])
+
+    def test_complete_presigned_multipart_upload_uses_stored_parts(self):
+        self.client.list_parts.return_value = {'Parts': [
+            {'PartNumber': 2, 'ETag': '"e2"'}, {'PartNumber': 1, 'ETag': '"e1"'}]}
+        self.s3_manager.complete_presigned_multipart_upload('chris/uploads/big',
+                                                            'upload1')
+        parts = self.client.complete_multipart_upload.call_args[1]['MultipartUpload']
+        self.assertEqual(parts['Parts'], [{'PartNumber': 1, 'ETag': '"e1"'},
+                                          {'PartNumber': 2, 'ETag': '"e2"'}])
+
+
+class PresignedDownloadUrlTests(StorageTestCase):
+    """
+    Test the presigned download URLs and their cache.
+    """
+
+    def setUp(self):
+        super(PresignedDownloadUrlTests, self).setUp()
+        self.client.generate_presigned_url.side_effect = \
+            lambda op, Params, ExpiresIn: 'http://s3/%s' % len(
+                self.client.generate_presigned_url.call_args_list)
+        get_presigned_url_cache().clear()
+
+    def test_get_download_url_reuses_cached_url(self):
+        url = self.s3_manager.get_download_url('chris/uploads/f1')
+        self.assertEqual(self.s3_manager.get_download_url('chris/uploads/f1'), url)
+        self.assertEqual(self.client.generate_presigned_url.call_count, 1)
+        other = self.s3_manager.get_download_url('chris/uploads/f1',
+                                                 content_disposition='inline')
+        self.assertNotEqual(other, url)
+        params = self.client.generate_presigned_url.call_args[1]['Params']
+        self.assertEqual(params['ResponseContentDisposition'], 'inline')
+
+    def test_get_download_url_resigns_url_close_to_expiry(self):
+        self.s3_manager.get_download_url('chris/uploads/f1',
+                                         expires_in=self.s3_manager.presigned_url_min_ttl)
+        self.s3_manager.get_download_url('chris/uploads/f1',
+                                         expires_in=self.s3_manager.presigned_url_min_ttl)
+        self.assertEqual(self.client.generate_presigned_url.call_count, 2)
+
+
+class PublicMediaStorageDedupTests(StorageTestCase):
+    """
+    Test the dedup mode of the storage against a mocked S3 client.
+    """
+
+    def setUp(self):
+        super(PublicMediaStorageDedupTests, self).setUp()
+        self.s3_manager.dedup = True
+        self.s3_manager.dedup_min_size = 1
+        self.client.create_multipart_upload.return_value = {'UploadId': 'upload1'}
+        self.client.upload_part.return_value = {'ETag': '"etag"'}
+        self.client.head_object.return_value = {'ContentLength': 14}
+        self.index = self.s3_manager.get_digest_index()
+        self.digest = hashlib.sha256(b'dicom contents').hexdigest()
+
+    def test_upload_obj_repeated_contents_are_copied(self):
+        self.s3_manager.upload_obj('chris/uploads/s1/f', b'dicom contents')
+        self.s3_manager.upload_obj('chris/uploads/s2/f', io.BytesIO(b'dicom contents'))
+        self.client.put_object.assert_called_once()
+        self.client.copy_object.assert_called_once_with(
+            Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key='chris/uploads/s2/f',
+            CopySource={'Bucket': settings.AWS_STORAGE_BUCKET_NAME,
+                        'Key': 'chris/uploads/s1/f'})
+        self.assertEqual(self.index.ref_count(self.digest), 2)
+
+    def test_delete_drops_reference_of_deleted_object_only(self):
+        self.s3_manager.upload_obj('chris/uploads/s1/f', b'dicom contents')
+        self.s3_manager.upload_obj('chris/uploads/s2/f', b'dicom contents')
+        self.s3_manager.delete_obj('chris/uploads/s1/f')
+        self.assertEqual(self.index.ref_count(self.digest), 1)
+        self.assertEqual(self.index.lookup(self.digest, 14), 'chris/uploads/s2/f')
+
+    def test_upload_obj_falls_back_to_upload_if_source_is_gone(self):
+        self.index.add('chris/uploads/s1/f', self.digest, 14)
+        self.client.copy_object.side_effect = ClientError(
+            {'Error': {'Code': 'NoSuchKey'}}, 'CopyObject')
+        self.s3_manager.upload_obj('chris/uploads/s2/f', b'dicom contents')
+        self.client.put_object.assert_called_once()
+        self.assertEqual(self.index.lookup(self.digest, 14), 'chris/uploads/s2/f')
+
+    def test_compressed_duplicates_are_copied_at_their_stored_size(self):
+        client = FakeS3Client()
+        self.use_client(client)
+        self.s3_manager.compress = True
+        self.s3_manager.compress_min_size = 1
+        self.s3_manager.multipart_copy_threshold = 1
+        contents = b'subject,age\n' + b'sub-01,42\n' * 10000
+        self.s3_manager.upload_obj('chris/uploads/s1/stats.csv', contents)
+        self.s3_manager.compress = False
+        self.s3_manager.upload_obj('chris/uploads/s2/stats.csv', contents,
+                                   content_type='text/csv')
+        self.assertEqual(client.requests['upload_part_copy'], 1)
+        self.assertEqual(self.s3_manager.download_obj('chris/uploads/s2/stats.csv'),
+                         contents)
+        self.s3_manager.multipart_copy_threshold = 1024 * 1024
+        self.s3_manager.upload_obj('chris/uploads/s3/stats.csv', contents,
+                                   content_type='text/csv')
+        self.assertEqual(self.s3_manager.download_obj('chris/uploads/s3/stats.csv'),
+                         contents)
+
+    def test_multipart_copies_get_the_upload_params(self):
+        self.s3_manager.multipart_copy_threshold = 1
+        self.client.upload_part_copy.return_value = {'CopyPartResult': {'ETag': '"e"'}}
+        self.index.add('chris/uploads/s1/f', self.digest, 14)
+
+        def head_object(Bucket, Key):
+            if Key != 'chris/uploads/s1/f':
+                raise ClientError({'Error': {'Code': '404'},
+                                   'ResponseMetadata': {'HTTPStatusCode': 404}},
+                                  'HeadObject')
+            return {'ContentLength': 14}
+
+        self.client.head_object.side_effect = head_object
+        self.s3_manager.save('chris/uploads/s2/f.txt', ContentFile(b'dicom contents'))
+        self.client.upload_fileobj.assert_not_called()
+        params = self.client.create_multipart_upload.call_args[1]
+        self.assertEqual(params['ContentType'], 'text/plain')
+        for param, value in settings.AWS_S3_OBJECT_PARAMETERS.items():
+            self.assertEqual(params[param], value)
+
+    def test_upload_obj_streamed_contents_are_hashed_while_uploading(self):
+        chunks = iter([b'dicom ', b'contents'])
+        self.s3_manager.upload_obj('chris/uploads/s1/f', chunks)
+        self.client.upload_part.assert_called_once()
+        self.assertEqual(self.index.lookup(self.digest, 14), 'chris/uploads/s1/f')
+
+
+class PublicMediaStorageDedupOverwriteTests(StorageTestCase):
+    """
+    Test that the dedup index follows the objects replaced by every write path, against
+    the in-process fake S3 client.
+    """
+    client_class = FakeS3Client
+
+    def setUp(self):
+        super(PublicMediaStorageDedupOverwriteTests, self).setUp()
+        self.s3_manager.dedup = True
+        self.s3_manager.dedup_min_size = 50
+        self.index = self.s3_manager.get_digest_index()
+        self.contents = b'A' * 100
+
+    def assert_copy_is_not_stale(self):
+        self.s3_manager.upload_obj('u/b', self.contents)
+        self.assertEqual(self.s3_manager.download_obj('u/b'), self.contents)
+
+    def test_small_upload_replaces_indexed_object(self):
+        self.s3_manager.upload_obj('u/a', self.contents)
+        self.s3_manager.upload_obj('u/a', b'small')
+        self.assertIsNone(self.index.lookup(hashlib.sha256(self.contents).hexdigest(), 100))
+        self.assert_copy_is_not_stale()
+
+    def test_file_list_upload_replaces_indexed_object(self):
+        self.s3_manager.upload_obj('u/a', self.contents)
+        with tempfile.TemporaryDirectory() as local_dir:
+            local_file_path = os.path.join(local_dir, 'a')
+            with open(local_file_path, 'wb') as f:
+                f.write(b'other contents')
+            report = self.s3_manager.upload_file_list([('u/a', local_file_path)], 'u/',
+                                                      skip_existing=False)
+        self.assertEqual(report['uploaded'], ['u/a'])
+        self.assert_copy_is_not_stale()
+
+    def test_storage_api_save_replaces_indexed_object(self):
+        self.s3_manager.upload_obj('u/a', self.contents)
+        self.s3_manager.file_overwrite = True
+        self.s3_manager.save('u/a', ContentFile(b'small'))
+        self.assert_copy_is_not_stale()
+
+    def test_presigned_uploads_replace_indexed_object(self):
+        self.s3_manager.upload_obj('u/a', self.contents)
+        self.s3_manager.get_upload_url('u/a')
+        self.client.put('u/a', b'uploaded by a client')
+        self.assert_copy_is_not_stale()
+
+
+class PublicMediaStorageCompressionTests(StorageTestCase):
+    """
+    Test the compression mode of the storage against a mocked S3 client.
+    """
+
+    def setUp(self):
+        super(PublicMediaStorageCompressionTests, self).setUp()
+        self.s3_manager.compress = True
+        self.s3_manager.compress_min_size = 10
+        self.contents = b'subject,age,volume\n' + b'sub-01,42,1234.5\n' * 100
+        self.stored = {}
+        self.client.put_object.side_effect = self.put_object
+
+    def put_object(self, Bucket, Key, Body, **params):
+        self.stored[Key] = dict(params, Body=Body if isinstance(Body, bytes) else Body.read())
+
+    def get_object(self, Bucket, Key):
+        stored = self.stored[Key]
+        return {'Body': StreamingBody(io.BytesIO(stored['Body']), len(stored['Body'])),
+                'ContentLength': len(stored['Body']),
+                'ContentEncoding': stored.get('ContentEncoding'),
+                'Metadata': stored.get('Metadata', {})}
+
+    def test_upload_obj_compresses_listed_types(self):
+        self.s3_manager.upload_obj('chris/uploads/stats.csv', self.contents)
+        stored = self.stored['chris/uploads/stats.csv']
+        self.assertEqual(stored['ContentEncoding'], 'gzip')
+        self.assertEqual(stored['ContentType'], 'text/csv')
+        self.assertEqual(gzip.decompress(stored['Body']), self.contents)
+        self.assertEqual(stored['Metadata']['uncompressed-size'], str(len(self.contents)))
+        self.assertGreater(float(stored['Metadata']['compression-ratio']), 1)
+
+    def test_byte_range_of_compressed_object(self):
+        client = FakeS3Client()
+        self.use_client(client)
+        self.s3_manager.upload_obj('chris/uploads/stats.csv', self.contents)
+        stream = self.s3_manager.download_obj_stream('chris/uploads/stats.csv',
+                                                     byte_range=(0, 9))
+        self.assertIsNone(stream.content_range)
+        self.assertTrue(stream.decompressed)
+        self.assertEqual(b''.join(stream), self.contents)
+        stream = self.s3_manager.download_obj_stream('chris/uploads/stats.csv',
+                                                     byte_range=(0, 9), decompress=False)
+        self.assertEqual(stream.content_encoding, 'gzip')
+        self.assertEqual(len(b''.join(stream)), 10)
+
+    def test_upload_obj_skips_other_types_and_small_contents(self):
+        self.s3_manager.upload_obj('chris/uploads/scan.dcm', self.contents)
+        self.s3_manager.upload_obj('chris/uploads/small.csv', b'a,b\n')
+        self.assertNotIn('ContentEncoding', self.stored['chris/uploads/scan.dcm'])
+        self.assertNotIn('ContentEncoding', self.stored['chris/uploads/small.csv'])
+
+    def test_downloads_decompress_transparently(self):
+        self.s3_manager.upload_obj('chris/uploads/stats.csv', self.contents)
+        self.client.get_object.side_effect = self.get_object
+        self.assertEqual(self.s3_manager.download_obj('chris/uploads/stats.csv'),
+                         self.contents)
+        stream = self.s3_manager.download_obj_stream('chris/uploads/stats.csv',
+                                                     chunk_size=64)
+        self.assertEqual(stream.content_length, len(self.contents))
+        self.assertIsNone(stream.content_encoding)
+        self.assertEqual(b''.join(stream), self.contents)
+        stream = self.s3_manager.download_obj_stream('chris/uploads/stats.csv',
+                                                     decompress=False)
+        self.assertEqual(stream.content_encoding, 'gzip')
+        self.assertEqual(stream.read(), self.stored['chris/uploads/stats.csv']['Body'])
+
+    def head_object(self, Bucket, Key):
+        stored = self.stored[Key]
+        return {'ContentLength': len(stored['Body']),
+                'ContentEncoding': stored.get('ContentEncoding'),
+                'Metadata': stored.get('Metadata', {})}
+
+    def test_local_file_matches_compressed_object(self):
+        self.s3_manager.upload_obj('chris/uploads/stats.csv', self.contents)
+        self.client.head_object.side_effect = self.head_object
+        body = self.stored['chris/uploads/stats.csv']['Body']
+        local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, local_dir)
+        local_file_path = os.path.join(local_dir, 'stats.csv')
+        with open(local_file_path, 'wb') as f:
+            f.write(self.contents)
+        obj = S3ObjectInfo('chris/uploads/stats.csv', len(body),
+                           hashlib.md5(body).hexdigest(), datetime.datetime.now())
+        self.assertTrue(self.s3_manager._is_local_file_unchanged(local_file_path, obj,
+                                                                 'checksum'))
+        with open(local_file_path, 'ab') as f:
+            f.write(b'sub-02,37,1010.1\n')
+        self.assertFalse(self.s3_manager._is_local_file_unchanged(local_file_path, obj,
+                                                                  'checksum'))
+
+    def test_sync_dir_matches_compressed_objects_after_compression_is_off(self):
+        client = FakeS3Client()
+        self.use_client(client)
+        local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, local_dir)
+        with open(os.path.join(local_dir, 'stats.csv'), 'wb') as f:
+            f.write(self.contents)
+        report = self.s3_manager.sync_dir(local_dir, 'chris/sync')
+        self.assertEqual(report['uploaded'], ['chris/sync/stats.csv'])
+        self.s3_manager.compress = False
+        for compare in ('mtime', 'checksum'):
+            report = self.s3_manager.sync_dir(local_dir, 'chris/sync', compare=compare)
+            self.assertEqual(report['unchanged'], ['chris/sync/stats.csv'])
+        self.assertEqual(client.requests['upload_fileobj'], 1)
+
+    def test_get_obj_metadata_reports_uncompressed_size(self):
+        self.client.head_object.return_value = {
+            'ContentLength': 120, 'ETag': '"abc"', 'ContentType': 'text/csv',
+            'ContentEncoding': 'gzip', 'LastModified': datetime.datetime.now(),
+            'Metadata': {'uncompressed-size': '1700', 'compression-ratio': '14.167'}}
+        metadata = self.s3_manager.get_obj_metadata('chris/uploads/stats.csv')
+        self.assertEqual(metadata.size, 1700)
+
+
+class DiskObjectCacheTests(StorageTestCase):
+    """
+    Test the local disk read-through cache against the in-process fake S3 client.
+    """
+    client_class = FakeS3Client
+
+    def setUp(self):
+        super(DiskObjectCacheTests, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.cache = self.make_cache()
+
+    def make_cache(self, **options):
+        cache = DiskObjectCache(DIRECTORY=self.cache_dir, **options)
+        patcher = mock.patch('uploadedfiles.s3_storage.get_disk_cache', return_value=cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return cache
+
+    def test_repeat_reads_are_revalidated_with_conditional_get(self):
+        self.client.put('chris/atlas.nii', b'atlas v1')
+        self.assertEqual(self.s3_manager.download_obj('chris/atlas.nii'), b'atlas v1')
+        self.assertEqual(self.s3_manager.download_obj('chris/atlas.nii'), b'atlas v1')
+        self.assertEqual(self.client.requests['get_object'], 2)
+        self.assertEqual(self.cache.stats(), {'hits': 0, 'revalidations': 1, 'misses': 1,
+                                              'evictions': 0})
+        self.client.put('chris/atlas.nii', b'atlas v2')
+        self.assertEqual(self.s3_manager.download_obj('chris/atlas.nii'), b'atlas v2')
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_fresh_entries_are_served_without_requests(self):
+        self.cache = self.make_cache(REVALIDATE_AFTER=60)
+        self.client.put('chris/atlas.nii', b'atlas')
+        self.s3_manager.download_obj('chris/atlas.nii')
+        with self.s3_manager.open_obj('chris/atlas.nii') as f:
+            self.assertEqual(f.read(), b'atlas')
+        self.assertEqual(self.client.requests['get_object'], 1)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_concurrent_readers_wait_for_a_single_download(self):
+        self.cache = self.make_cache(REVALIDATE_AFTER=60)
+        self.client.put('chris/atlas.nii', b'atlas')
+        self.client.latency = 0.05
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            self.s3_manager.download_obj('chris/atlas.nii'))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [b'atlas'] * 4)
+        self.assertEqual(self.client.requests['get_object'], 1)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        self.cache = self.make_cache(MAX_BYTES=250, MAX_OBJECT_SIZE=100,
+                                     REVALIDATE_AFTER=60)
+        for i, name in enumerate(('f1', 'f2', 'f3')):
+            self.client.put('chris/' + name, bytes([i]) * 100)
+            self.s3_manager.download_obj('chris/' + name)
+            if name == 'f1':
+                os.utime(self.cache.get('%s/chris/f1' % settings.AWS_STORAGE_BUCKET_NAME)
+                         .path, (1, 1))
+        bucket = settings.AWS_STORAGE_BUCKET_NAME
+        self.assertIsNone(self.cache.get('%s/chris/f1' % bucket))
+        self.assertIsNotNone(self.cache.get('%s/chris/f3' % bucket))
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_large_and_compressed_objects(self):
+        self.cache = self.make_cache(MAX_OBJECT_SIZE=50)
+        self.client.put('chris/big', b'x' * 100)
+        self.assertEqual(self.s3_manager.download_obj('chris/big'), b'x' * 100)
+        self.assertIsNone(self.cache.get('%s/chris/big' % settings.AWS_STORAGE_BUCKET_NAME))
+        contents = b'a,b\n' * 1000
+        self.client.put('chris/stats.csv', gzip.compress(contents), ContentEncoding='gzip')
+        self.assertEqual(self.s3_manager.download_obj('chris/stats.csv'), contents)
+        self.assertEqual(self.s3_manager.download_obj('chris/stats.csv'), contents)
+        self.assertEqual(self.cache.revalidations, 1)
+
+
+class ListingCacheTests(StorageTestCase):
+    """
+    Test the listing cache and its invalidation by the storage write methods.
+    """
+
+    def setUp(self):
+        super(ListingCacheTests, self).setUp()
+        self.cache = LocMemListingCache(MAX_ENTRIES=2, TTL=30)
+        patcher = mock.patch('uploadedfiles.s3_storage.get_listing_cache',
+                             return_value=self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client.list_objects_v2.return_value = {'Contents': [{'Key': 'chris/uploads/f1'}]}
+
+    def test_path_exists_is_cached(self):
+        self.assertTrue(self.s3_manager.path_exists('chris/uploads'))
+        self.assertTrue(self.s3_manager.path_exists('chris/uploads'))
+        self.assertEqual(self.client.list_objects_v2.call_count, 1)
+        self.assertEqual(self.client.list_objects_v2.call_args[1]['MaxKeys'], 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_writes_invalidate_overlapping_entries(self):
+        self.s3_manager.path_exists('chris/uploads')
+        self.s3_manager.path_exists('other/uploads')
+        self.s3_manager.upload_obj('chris/uploads/f2', b'contents')
+        self.s3_manager.path_exists('chris/uploads')
+        self.s3_manager.path_exists('other/uploads')
+        self.assertEqual(self.client.list_objects_v2.call_count, 3)
+        self.s3_manager.delete_obj('chris/uploads/f1')
+        self.s3_manager.copy_obj('other/uploads/f1', 'chris/uploads/f3')
+        self.assertEqual(self.cache.stats()['invalidations'], 3)
+
+    def test_lru_and_ttl_eviction(self):
+        self.cache.set(('ls', 'a'), ('a/1',))
+        self.cache.set(('ls', 'b'), ('b/1',))
+        self.cache.get(('ls', 'a'))
+        self.cache.set(('ls', 'c'), ('c/1',))
+        self.assertIsNone(self.cache.get(('ls', 'b')))
+        self.assertEqual(self.cache.get(('ls', 'a')), ('a/1',))
+        self.cache.ttl = -1
+        self.cache.set(('ls', 'c'), ('c/1',))
+        self.assertIsNone(self.cache.get(('ls', 'c')))
+
+    def test_stale_listing_is_not_cached(self):
+        generation = self.cache.generation
+        self.cache.invalidate('chris/uploads/f1')
+        self.cache.set(('ls', 'chris/uploads'), ('chris/uploads/f1',), generation)
+        self.assertIsNone(self.cache.get(('ls', 'chris/uploads')))
+
+
+class PublicMediaStorageExistsTests(StorageTestCase):
+    """
+    Test the exact and batched existence checks against the in-process fake S3 client.
+    """
+    client_class = FakeS3Client
+
+    def setUp(self):
+        super(PublicMediaStorageExistsTests, self).setUp()
+        self.cache = LocMemListingCache(MAX_ENTRIES=10000, TTL=30)
+        patcher = mock.patch('uploadedfiles.s3_storage.get_listing_cache',
+                             return_value=self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_obj_exists_is_exact(self):
+        self.client.put('chris/uploads/file2', b'x')
+        self.assertFalse(self.s3_manager.obj_exists('chris/uploads/file'))
+        self.assertTrue(self.s3_manager.obj_exists('chris/uploads/file2'))
+        self.assertTrue(self.s3_manager.path_exists('chris/uploads/file'))
+        self.assertEqual(self.client.requests['head_object'], 2)
+
+    def test_few_keys_are_checked_with_head_requests(self):
+        self.client.put('chris/a', b'x')
+        self.client.put('other/b', b'x')
+        results = self.s3_manager.exists_many(['chris/a', 'other/b', 'other/c'])
+        self.assertEqual(results, {'chris/a': True, 'other/b': True, 'other/c': False})
+        self.assertEqual(self.client.requests['head_object'], 3)
+        self.assertNotIn('list_objects_v2', self.client.requests)
+
+    def test_many_keys_are_checked_with_a_listing(self):
+        for i in range(0, 2500, 2):
+            self.client.put('chris/feed/file%04d' % i, b'x')
+        self.client.put('chris/other', b'x')
+        keys = ['chris/feed/file%04d' % i for i in range(100)]
+        results = self.s3_manager.exists_many(keys)
+        self.assertEqual(results, {key: int(key[-4:]) % 2 == 0 for key in keys})
+        self.assertEqual(self.client.requests['list_objects_v2'], 1)
+        self.assertNotIn('head_object', self.client.requests)
+
+    def test_keys_beyond_the_page_budget_fall_back_to_head_requests(self):
+        for i in range(2500):
+            self.client.put('chris/feed/file%04d' % i, b'x')
+        keys = ['chris/feed/file0000', 'chris/feed/file2499', 'chris/feed/file9999']
+        results = self.s3_manager.exists_many(keys, list_min_keys=2, max_workers=2)
+        self.assertEqual(list(results.values()), [True, True, False])
+        self.assertEqual(self.client.requests['list_objects_v2'], 1)
+        self.assertEqual(self.client.requests['head_object'], 2)
+
+    def test_listing_starts_just_before_the_smallest_key(self):
+        # keys that sort between the smallest key less its last character and the
+        # smallest key itself don't use up the page budget
+        for i in range(2500):
+            self.client.put('chris/feed/file000-%04d' % i, b'x')
+        keys = ['chris/feed/file%04d' % i for i in range(4)]
+        for key in keys[:2]:
+            self.client.put(key, b'x')
+        results = self.s3_manager.exists_many(keys, list_min_keys=2, max_workers=2)
+        self.assertEqual(list(results.values()), [True, True, False, False])
+        self.assertEqual(self.client.requests['list_objects_v2'], 1)
+        self.assertNotIn('head_object', self.client.requests)
+
+    def test_negative_results_expire_sooner(self):
+        self.assertFalse(self.s3_manager.obj_exists('chris/new'))
+        self.client.put('chris/new', b'x')
+        self.assertFalse(self.s3_manager.obj_exists('chris/new'))
+        self.s3_manager.exists_negative_ttl = -1
+        self.assertTrue(self.s3_manager.obj_exists('chris/new'))
+        self.client.delete_object(Bucket=self.s3_manager.container_name, Key='chris/new')
+        self.assertTrue(self.s3_manager.obj_exists('chris/new'))
+        self.assertEqual(self.client.requests['head_object'], 2)
+        self.s3_manager.upload_obj('chris/new', b'y')
+        self.s3_manager.delete_obj('chris/new')
+        self.assertFalse(self.s3_manager.obj_exists('chris/new'))
+
+    def test_only_missing_keys_are_cached_without_the_listing_cache(self):
+        negative_cache = LocMemListingCache(MAX_ENTRIES=10, TTL=5)
+        with mock.patch('uploadedfiles.s3_storage.get_listing_cache', return_value=None), \
+                mock.patch('uploadedfiles.s3_storage.get_negative_exists_cache',
+                           return_value=negative_cache):
+            self.assertFalse(self.s3_manager.obj_exists('chris/new'))
+            self.assertFalse(self.s3_manager.obj_exists('chris/new'))
+            self.assertEqual(self.client.requests['head_object'], 1)
+            self.s3_manager.upload_obj('chris/new', b'x')
+            self.assertTrue(self.s3_manager.obj_exists('chris/new'))
+            self.assertTrue(self.s3_manager.obj_exists('chris/new'))
+            self.assertEqual(self.client.requests['head_object'], 3)
+
+
+class PublicMediaStorageDeleteTests(StorageTestCase):
+    """
+    Test batched deletes against a mocked S3 client.
+    """
+
+    def setUp(self):
+        super(PublicMediaStorageDeleteTests, self).setUp()
+        self.client.delete_objects.return_value = {}
+
+    def test_delete_many_batches_keys(self):
+        keys = ['chris/uploads/f%s' % i for i in range(2500)]
+        report = self.s3_manager.delete_many(iter(keys), max_workers=2)
+        self.assertEqual(self.client.delete_objects.call_count, 3)
+        batch_sizes = sorted(len(c[1]['Delete']['Objects'])
+                             for c in self.client.delete_objects.call_args_list)
+        self.assertEqual(batch_sizes, [500, 1000, 1000])
+        self.assertEqual(sorted(report['deleted']), sorted(keys))
+        self.assertEqual(report['failed'], [])
+
+    def test_delete_many_reports_per_key_errors(self):
+        self.client.delete_objects.return_value = {'Errors': [
+            {'Key': 'chris/uploads/f1', 'Code': 'AccessDenied', 'Message': 'Denied'}]}
+        report = self.s3_manager.delete_many(['chris/uploads/f0', 'chris/uploads/f1'])
+        self.assertEqual(report['deleted'], ['chris/uploads/f0'])
+        self.assertEqual(report['failed'], [('chris/uploads/f1', 'AccessDenied: Denied')])
+
+    def test_delete_prefix_streams_listing(self):
+        listing = [S3ObjectInfo('chris/uploads/f%s' % i, 1, 'e', None) for i in range(3)]
+        with mock.patch.object(self.s3_manager, 'ls_iter',
+                               return_value=iter(listing)) as ls_mock:
+            report = self.s3_manager.delete_prefix('chris/uploads/')
+        ls_mock.assert_called_once_with('chris/uploads/')
+        self.assertEqual(len(report['deleted']), 3)
+        with self.assertRaises(ValueError):
+            self.s3_manager.delete_prefix('')
+
+
+class PublicMediaStorageCopyTests(StorageTestCase):
+    """
+    Test server-side prefix copies and moves against a mocked S3 client.
+    """
+
+    def setUp(self):
+        super(PublicMediaStorageCopyTests, self).setUp()
+        self.client.head_object.return_value = {'ContentType': 'text/plain'}
+        self.client.create_multipart_upload.return_value = {'UploadId': 'upload1'}
+        self.client.upload_part_copy.side_effect = lambda **kw: {
+            'CopyPartResult': {'ETag': '"%s"' % kw['PartNumber']}}
+        self.client.delete_objects.return_value = {}
+        self.listing = [S3ObjectInfo('chris/uploads/a/f1', 10, 'e1', None),
+                        S3ObjectInfo('chris/uploads/a/sub/f2', 12 * 1024 * 1024, 'e2',
+                                     None)]
+
+    def test_copy_prefix(self):
+        with mock.patch.object(self.s3_manager, 'ls_iter', return_value=iter(self.listing)):
+            report = self.s3_manager.copy_prefix('chris/uploads/a/', 'chris/uploads/b/',
+                                                 multipart_copy_threshold=1024 * 1024,
+                                                 part_size=MULTIPART_MIN_PART_SIZE)
+        self.assertEqual(sorted(report['copied']),
+                         [('chris/uploads/a/f1', 'chris/uploads/b/f1'),
+                          ('chris/uploads/a/sub/f2', 'chris/uploads/b/sub/f2')])
+        acl = settings.AWS_S3_OBJECT_PARAMETERS['ACL']
+        self.client.copy_object.assert_called_once_with(
+            Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key='chris/uploads/b/f1',
+            CopySource={'Bucket': settings.AWS_STORAGE_BUCKET_NAME,
+                        'Key': 'chris/uploads/a/f1'}, ACL=acl)
+        # the large object keeps the ACL too and is copied in 5MB ranges
+        params = self.client.create_multipart_upload.call_args[1]
+        self.assertEqual(params['ACL'], acl)
+        self.assertEqual(params['CacheControl'],
+                         settings.AWS_S3_OBJECT_PARAMETERS['CacheControl'])
+        ranges = sorted(c[1]['CopySourceRange']
+                        for c in self.client.upload_part_copy.call_args_list)
+        self.assertEqual(ranges, ['bytes=0-5242879', 'bytes=10485760-12582911',
+                                  'bytes=5242880-10485759'])
+        parts = self.client.complete_multipart_upload.call_args[1]['MultipartUpload']
+        self.assertEqual([p['PartNumber'] for p in parts['Parts']], [1, 2, 3])
+
+    def test_copy_prefix_rejects_nested_destination(self):
+        with self.assertRaises(ValueError):
+            self.s3_manager.copy_prefix('chris/uploads/', 'chris/uploads/b/')
+
+    def test_move_prefix_deletes_copied_sources(self):
+        self.client.copy_object.side_effect = ClientError(
+            {'Error': {'Code': 'AccessDenied', 'Message': 'Denied'}}, 'CopyObject')
+        with mock.patch.object(self.s3_manager, 'ls_iter', return_value=iter(self.listing)):
+            report = self.s3_manager.move_prefix('chris/uploads/a/', 'chris/uploads/b/',
+                                                 multipart_copy_threshold=1024 * 1024)
+        self.assertEqual(report['moved'],
+                         [('chris/uploads/a/sub/f2', 'chris/uploads/b/sub/f2')])
+        self.assertEqual(report['failed'][0][0], 'chris/uploads/a/f1')
+        deleted = self.client.delete_objects.call_args[1]['Delete']['Objects']
+        self.assertEqual(deleted, [{'Key': 'chris/uploads/a/sub/f2'}])
+
+
+class S3ClientTests(TestCase):
+    """
+    Test the process-wide S3 client and bucket verification.
+    """
+
+    def setUp(self):
+        patcher = mock.patch.multiple('uploadedfiles.s3_storage', _s3_client=None,
+                                      _s3_resource=None, _bucket_ready=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_storage_instances_share_one_client(self):
+        with mock.patch('boto3.session.Session') as session_mock:
+            conn1 = PublicMediaStorage().get_connection()
+            conn2 = PublicMediaStorage().get_connection()
+        self.assertIs(conn1, conn2)
+        self.assertEqual(session_mock.call_count, 1)
+        config = session_mock.return_value.client.call_args[1]['config']
+        self.assertEqual(config.max_pool_connections, settings.AWS_S3_MAX_POOL_CONNECTIONS)
+
+    def test_storage_api_resource_uses_the_shared_client(self):
+        storage1 = PublicMediaStorage()
+        storage2 = PublicMediaStorage()
+        self.assertIs(storage1.connection, storage2.connection)
+        self.assertIs(storage1.bucket.meta.client, storage2.get_connection())
+
+    def test_ensure_bucket_creates_missing_bucket_once(self):
+        client = mock.Mock()
+        client.head_bucket.side_effect = ClientError({'Error': {'Code': '404'}},
+                                                     'HeadBucket')
+        with mock.patch('uploadedfiles.s3_storage.get_s3_client', return_value=client):
+            ensure_bucket()
+            ensure_bucket()
+        client.create_bucket.assert_called_once_with(
+            Bucket=settings.AWS_STORAGE_BUCKET_NAME)
+
+
+class RetryPolicyTests(TestCase):
+    """
+    Test the retry policy shared by the storage operations.
+    """
+
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        patcher = mock.patch('uploadedfiles.s3_retry.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.policy = RetryPolicy(max_attempts=3, base_delay=0.1, max_delay=1,
+                                  deadline=60, quota=20)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def make_error(self, code, http_status=400):
+        return ClientError({'Error': {'Code': code, 'Message': code},
+                            'ResponseMetadata': {'HTTPStatusCode': http_status}},
+                           'PutObject')
+
+    def test_classify_error(self):
+        self.assertEqual(classify_error(self.make_error('SlowDown', 503)), 'throttle')
+        self.assertEqual(classify_error(self.make_error('503', 503)), 'throttle')
+        self.assertEqual(classify_error(self.make_error('InternalError', 500)), 'transient')
+        self.assertIsNone(classify_error(self.make_error('AccessDenied', 403)))
+        self.assertEqual(classify_error(EndpointConnectionError(endpoint_url='url')),
+                         'transient')
+        try:
+            try:
+                raise self.make_error('SlowDown', 503)
+            except ClientError:
+                raise S3UploadFailedError('Failed to upload')
+        except S3UploadFailedError as e:
+            self.assertEqual(classify_error(e), 'throttle')
+
+    def test_throttling_is_retried_with_backoff(self):
+        func = mock.Mock(side_effect=[self.make_error('SlowDown', 503), 'result'])
+        self.assertEqual(self.policy.call(func, Key='key'), 'result')
+        func.assert_called_with(Key='key')
+        self.assertEqual(self.sleep.call_count, 1)
+        self.assertLessEqual(self.sleep.call_args[0][0], 0.1)
+        stats = self.policy.stats()
+        self.assertEqual((stats['retries'], stats['throttles']), (1, 1))
+
+    def test_non_retryable_error_is_raised_at_once(self):
+        func = mock.Mock(side_effect=self.make_error('AccessDenied', 403))
+        with self.assertRaises(ClientError):
+            self.policy.call(func)
+        self.assertEqual(func.call_count, 1)
+        self.assertEqual(self.policy.stats()['failures'], 1)
+
+    def test_attempts_are_bounded(self):
+        func = mock.Mock(side_effect=self.make_error('InternalError', 500))
+        with self.assertRaises(ClientError):
+            self.policy.call(func)
+        self.assertEqual(func.call_count, 3)
+
+    def test_exhausted_quota_stops_retries(self):
+        func = mock.Mock(side_effect=self.make_error('SlowDown', 503))
+        with self.assertRaises(ClientError):
+            self.policy.call(func)
+        with self.assertRaises(ClientError):
+            self.policy.call(func)
+        # the first call spent the 20 tokens on two throttled retries
+        self.assertEqual(func.call_count, 4)
+        self.assertEqual(self.policy.stats()['quota_exhausted'], 1)
+
+    def test_storage_api_writes_are_retried(self):
+        s3_manager = PublicMediaStorage()
+        client = mock.Mock()
+        client.upload_fileobj.side_effect = [self.make_error('SlowDown', 503), None]
+        client.delete_object.side_effect = [self.make_error('InternalError', 500), {}]
+        client.head_object.side_effect = [self.make_error('InternalError', 500),
+                                          self.make_error('404', 404)]
+        s3_manager.get_connection = mock.Mock(return_value=client)
+        with mock.patch('uploadedfiles.s3_storage.get_retry_policy',
+                        return_value=self.policy):
+            name = s3_manager.save('chris/uploads/f.txt', ContentFile(b'contents'))
+            s3_manager.delete(name)
+        self.assertEqual(client.upload_fileobj.call_count, 2)
+        self.assertEqual(client.upload_fileobj.call_args[1]['Bucket'],
+                         settings.AWS_STORAGE_BUCKET_NAME)
+        self.assertEqual(client.delete_object.call_count, 2)
+        self.assertEqual(client.head_object.call_count, 2)
+
+    def test_deadline_stops_retries(self):
+        self.policy.deadline = 0
+        func = mock.Mock(side_effect=self.make_error('InternalError', 500))
+        with self.assertRaises(ClientError):
+            self.policy.call(func)
+        self.assertEqual(func.call_count, 1)
+
+
+class StorageMetricsTests(StorageTestCase):
+    """
+    Test the instrumentation of the storage operations and its Prometheus exposition.
+    """
+
+    def setUp(self):
+        super(StorageMetricsTests, self).setUp()
+        self.metrics = StorageMetrics()
+        patcher = mock.patch.object(s3_metrics, '_storage_metrics', self.metrics)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_operations_and_requests_are_recorded(self):
+        self.client.get_object.return_value = {
+            'Body': StreamingBody(io.BytesIO(b'contents'), 8), 'ContentLength': 8}
+        self.s3_manager.upload_obj('chris/uploads/f', b'0123456789')
+        self.s3_manager.download_obj('chris/uploads/f')
+        self.assertEqual(self.metrics.operation_duration.get_count('upload_obj'), 1)
+        self.assertEqual(self.metrics.operation_duration.get_count('download_obj'), 1)
+        self.assertEqual(self.metrics.request_duration.get_count('put_object'), 1)
+        self.assertEqual(self.metrics.request_duration.get_count('get_object'), 1)
+        self.assertEqual(self.metrics.transferred_bytes.get('sent'), 10)
+        self.assertEqual(self.metrics.transferred_bytes.get('received'), 8)
+
+    def test_storage_api_operations_are_recorded_under_their_own_names(self):
+        self.client.head_object.return_value = {}
+        self.assertTrue(self.s3_manager.exists('chris/uploads/f'))
+        self.s3_manager.delete('chris/uploads/f')
+        self.assertEqual(self.metrics.operation_duration.get_count('exists'), 1)
+        self.assertEqual(self.metrics.operation_duration.get_count('delete'), 1)
+        self.assertEqual(self.metrics.request_duration.get_count('head_object'), 1)
+        self.assertEqual(self.metrics.request_duration.get_count('delete_object'), 1)
+
+    def test_errors_are_recorded_by_code(self):
+        self.client.delete_object.side_effect = ClientError(
+            {'Error': {'Code': 'AccessDenied'}}, 'DeleteObject')
+        with self.assertRaises(ClientError):
+            self.s3_manager.delete_obj('chris/uploads/f')
+        self.assertEqual(self.metrics.request_errors.get('delete_object', 'AccessDenied'), 1)
+        self.assertEqual(self.metrics.operation_errors.get('delete_obj'), 1)
+
+    def test_histogram_renders_cumulative_buckets(self):
+        histogram = Histogram('op_seconds', 'Duration.', ('operation',), buckets=(0.1, 1))
+        histogram.observe(0.05, 'ls')
+        histogram.observe(0.5, 'ls')
+        histogram.observe(3, 'ls')
+        self.assertEqual(histogram.render().splitlines(), [
+            '# HELP op_seconds Duration.',
+            '# TYPE op_seconds histogram',
+            'op_seconds_bucket{operation="ls",le="0.1"} 1',
+            'op_seconds_bucket{operation="ls",le="1"} 2',
+            'op_seconds_bucket{operation="ls",le="+Inf"} 3',
+            'op_seconds_sum{operation="ls"} 3.55',
+            'op_seconds_count{operation="ls"} 3'])
+
+    def test_render_includes_retry_counters(self):
+        text = self.metrics.render()
+        self.assertIn('# TYPE chris_storage_operation_duration_seconds histogram', text)
+        self.assertIn('chris_storage_retry_events_total{event="retries"}', text)
+        self.assertIn('chris_storage_retry_quota_tokens ', text)
+
@@ -0,0 +1,156 @@
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from django.urls import reverse
+
+from rest_framework import status
+
+from uploadedfiles import tasks
+from uploadedfiles.models import IngestBatch, IngestJob, UploadedFile
+from uploadedfiles.s3_storage import S3ObjectInfo
+
+
+# To run a test from the command line:
+#    python manage.py test uploadedfiles.tests.test_tasks.IngestJobTaskTests
+class IngestJobTaskTests(TestCase):
+    """
+    Test the directory ingest tasks.
+    """
+
+    def setUp(self):
+        # avoid cluttered console output (for instance logging all the http requests)
+        logging.disable(logging.WARNING)
+
+        self.user = User.objects.create_user(username='test', password='testpass')
+        self.local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.local_dir)
+        os.mkdir(os.path.join(self.local_dir, 'dir1'))
+        for name in ('f1.txt', 'f2', 'dir1/f3'):
+            with open(os.path.join(self.local_dir, name), 'w') as f:
+                f.write('contents %s' % name)
+        self.job = IngestJob.objects.create(owner=self.user, local_dir=self.local_dir,
+                                            upload_path='test/uploads/study')
+        self.storage = UploadedFile._meta.get_field('fname').storage
+        self.mtime = datetime.datetime(2022, 9, 1, tzinfo=datetime.timezone.utc)
+        self.listing = [S3ObjectInfo('test/uploads/study/dir1/f3', 14, 'e3', self.mtime),
+                        S3ObjectInfo('test/uploads/study/f1.txt', 30, 'e1', self.mtime),
+                        S3ObjectInfo('test/uploads/study/f2', 11, 'e2', self.mtime)]
+
+    def tearDown(self):
+        # re-enable logging
+        logging.disable(logging.NOTSET)
+
+    def run_job(self, upload_file_list, delay=None):
+        with override_settings(INGEST_BATCH_SIZE=2), \
+                mock.patch.object(self.storage, 'upload_file_list',
+                                  side_effect=upload_file_list), \
+                mock.patch.object(self.storage, 'ls_iter',
+                                  side_effect=lambda prefix, **kwargs: iter(
+                                      obj for obj in self.listing
+                                      if obj.key >= kwargs['start_at'])), \
+                mock.patch.object(tasks.ingest_batch, 'delay',
+                                  side_effect=delay or tasks.ingest_batch):
+            tasks.start_ingest_job(self.job.id)
+        self.job.refresh_from_db()
+
+    @staticmethod
+    def upload_all(files, prefix):
+        return {'uploaded': [f[0] for f in files], 'skipped': [], 'failed': []}
+
+    def test_ingest_job_uploads_and_registers_files_in_batches(self):
+        self.run_job(lambda files, prefix: {'uploaded': [f[0] for f in files],
+                                            'skipped': [], 'failed': []})
+        self.assertEqual(self.job.status, 'finished')
+        self.assertEqual((self.job.total_files, self.job.total_batches), (3, 2))
+        self.assertEqual((self.job.done_files, self.job.done_batches), (3, 2))
+        self.assertEqual(self.job.done_bytes, self.job.total_bytes)
+        self.assertEqual(sorted(f.fname.name for f in UploadedFile.objects.all()),
+                         ['test/uploads/study/dir1/f3', 'test/uploads/study/f1.txt',
+                          'test/uploads/study/f2'])
+        user_file = UploadedFile.objects.get(fname='test/uploads/study/f1.txt')
+        self.assertEqual((user_file.content_type, user_file.etag, user_file.stored_at),
+                         ('text/plain', 'e1', self.mtime))
+        # the size of the local file rather than the (possibly compressed) stored size
+        self.assertEqual(user_file.fsize, len('contents f1.txt'))
+
+    def test_ingest_job_records_failures(self):
+        self.run_job(lambda files, prefix: {'uploaded': [], 'skipped': [files[0][0]],
+                                            'failed': [(f[0], 'boom') for f in files[1:]]})
+        self.assertEqual(self.job.status, 'finished')
+        self.assertEqual((self.job.done_files, self.job.failed_files), (2, 1))
+        self.assertEqual(self.job.error_message, 'boom')
+
+    def test_start_ingest_job_is_not_run_twice(self):
+        self.run_job(lambda files, prefix: {'uploaded': [f[0] for f in files],
+                                            'skipped': [], 'failed': []})
+        with mock.patch.object(tasks.ingest_batch, 'delay') as delay_mock:
+            tasks.start_ingest_job(self.job.id)
+        delay_mock.assert_not_called()
+
+    def test_redelivered_start_queues_the_remaining_batches(self):
+        def lost_worker(batch_id):
+            if IngestBatch.objects.get(pk=batch_id).number == 1:
+                raise SystemExit('worker lost')
+            tasks.ingest_batch(batch_id)
+        with self.assertRaises(SystemExit):
+            self.run_job(self.upload_all, delay=lost_worker)
+        self.assertEqual(list(self.job.batches.values_list('queued', flat=True)),
+                         [True, False])
+        self.run_job(self.upload_all)
+        self.assertEqual(self.job.status, 'finished')
+        self.assertEqual((self.job.done_files, self.job.done_batches), (3, 2))
+
+    def test_redelivered_batch_is_counted_once(self):
+        self.run_job(self.upload_all)
+        with mock.patch.object(self.storage, 'upload_file_list') as upload_mock:
+            for batch in self.job.batches.all():
+                tasks.ingest_batch(batch.id)
+        upload_mock.assert_not_called()
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.done_files, self.job.done_batches), (3, 2))
+
+
+class IngestJobViewTests(TestCase):
+    """
+    Test the ingestjob-list and ingestjob-detail views.
+    """
+
+    def setUp(self):
+        # avoid cluttered console output (for instance logging all the http requests)
+        logging.disable(logging.WARNING)
+
+        User.objects.create_user(username='test', password='testpass')
+        self.client.login(username='test', password='testpass')
+        self.root_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root_dir)
+        os.mkdir(os.path.join(self.root_dir, 'study'))
+        self.list_url = reverse('ingestjob-list')
+
+    def tearDown(self):
+        # re-enable logging
+        logging.disable(logging.NOTSET)
+
+    def test_ingestjob_create_success(self):
+        with override_settings(INGEST_ROOT_DIR=self.root_dir), \
+                mock.patch.object(tasks.start_ingest_job, 'delay') as delay_mock, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.list_url, {'local_dir': 'study',
+                                                         'upload_path': 'test/uploads/study'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['status'], 'created')
+        delay_mock.assert_called_once_with(response.data['id'])
+        response = self.client.get(reverse('ingestjob-detail',
+                                           kwargs={'pk': response.data['id']}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_ingestjob_create_failure_directory_outside_root(self):
+        with override_settings(INGEST_ROOT_DIR=self.root_dir):
+            response = self.client.post(self.list_url, {'local_dir': '../',
+                                                         'upload_path': 'test/uploads/study'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,353 @@
+import datetime
+import gzip
+import logging
+import io
+import tarfile
+import zipfile
+from unittest import mock
+
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+from django.test import TestCase
+from django.contrib.auth.models import User
+from django.urls import reverse
+
+from rest_framework import status
+
+from uploadedfiles.models import UploadedFile
+from uploadedfiles.s3_storage import (PublicMediaStorage, S3ObjectInfo, S3ObjectMetadata,
+                                      S3ObjectStream)
+
+
+# To run a test from the command line:
+#    python manage.py test uploadedfiles.tests.test_views.UploadedFileResourceViewTests
+class UploadedFileResourceViewTests(TestCase):
+    """
+    Test the uploadedfile-resource view.
+    """
+
+    def setUp(self):
+        # avoid cluttered console output (for instance logging all the http requests)
+        logging.disable(logging.WARNING)
+
+        self.username = 'test'
+        self.password = 'testpass'
+        user = User.objects.create_user(username=self.username, password=self.password)
+        self.upload_path = 'test/uploads/file1.txt'
+        self.contents = b'test file1 contents'
+        uploadedfile = UploadedFile(owner=user)
+        uploadedfile.fname.name = self.upload_path
+        uploadedfile.save()
+        self.read_url = reverse('uploadedfile-resource',
+                                kwargs={'pk': uploadedfile.id, 'filename': 'file1.txt'})
+        self.detail_url = reverse('uploadedfile-detail', kwargs={'pk': uploadedfile.id})
+
+    def tearDown(self):
+        # re-enable logging
+        logging.disable(logging.NOTSET)
+
+    def make_stream(self, contents, content_range=None):
+        response_object = {'Body': StreamingBody(io.BytesIO(contents), len(contents)),
+                           'ContentLength': len(contents),
+                           'ContentType': 'text/plain',
+                           'ContentRange': content_range}
+        return S3ObjectStream(response_object, 4)
+
+    def test_uploadedfile_resource_success(self):
+        with mock.patch.object(PublicMediaStorage, 'download_obj_stream',
+                               return_value=self.make_stream(self.contents)) as dl_mock:
+            response = self.client.get(self.read_url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(b''.join(response.streaming_content), self.contents)
+            self.assertEqual(response['Content-Length'], str(len(self.contents)))
+            self.assertEqual(response['Content-Type'], 'text/plain')
+            dl_mock.assert_called_with(self.upload_path, byte_range=None,
+                                       decompress=True)
+
+    def test_uploadedfile_resource_byte_range(self):
+        stream = self.make_stream(self.contents[5:9], 'bytes 5-8/19')
+        with mock.patch.object(PublicMediaStorage, 'download_obj_stream',
+                               return_value=stream) as dl_mock:
+            response = self.client.get(self.read_url, HTTP_RANGE='bytes=5-8')
+            self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+            self.assertEqual(b''.join(response.streaming_content), b'file')
+            self.assertEqual(response['Content-Range'], 'bytes 5-8/19')
+            dl_mock.assert_called_with(self.upload_path, byte_range=(5, 8),
+                                       decompress=True)
+
+    def test_uploadedfile_resource_compressed(self):
+        compressed = gzip.compress(self.contents)
+
+        def make_stream(obj_path, byte_range=None, decompress=True):
+            response_object = {
+                'Body': StreamingBody(io.BytesIO(compressed), len(compressed)),
+                'ContentLength': len(compressed), 'ContentType': 'text/plain',
+                'ContentEncoding': 'gzip',
+                'Metadata': {'uncompressed-size': str(len(self.contents))}}
+            return S3ObjectStream(response_object, 4, decompress)
+
+        with mock.patch.object(PublicMediaStorage, 'download_obj_stream',
+                               side_effect=make_stream):
+            response = self.client.get(self.read_url, HTTP_ACCEPT_ENCODING='gzip, br')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(response['Content-Length'], str(len(compressed)))
+            self.assertEqual(b''.join(response.streaming_content), compressed)
+            self.assertIn('Accept-Encoding', response['Vary'])
+
+            response = self.client.get(self.read_url)
+            self.assertFalse(response.has_header('Content-Encoding'))
+            self.assertEqual(response['Content-Length'], str(len(self.contents)))
+            self.assertEqual(b''.join(response.streaming_content), self.contents)
+
+    def test_uploadedfile_resource_compressed_byte_range(self):
+        compressed = gzip.compress(self.contents)
+
+        def make_stream(obj_path, byte_range=None, decompress=True):
+            # like the storage, serve the whole object if it must be decompressed
+            body = compressed if decompress else compressed[5:9]
+            response_object = {
+                'Body': StreamingBody(io.BytesIO(body), len(body)),
+                'ContentLength': len(body), 'ContentType': 'text/plain',
+                'ContentEncoding': 'gzip',
+                'ContentRange': None if decompress else 'bytes 5-8/%s' % len(compressed),
+                'Metadata': {'uncompressed-size': str(len(self.contents))}}
+            return S3ObjectStream(response_object, 4, decompress)
+
+        with mock.patch.object(PublicMediaStorage, 'download_obj_stream',
+                               side_effect=make_stream):
+            response = self.client.get(self.read_url, HTTP_RANGE='bytes=5-8')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertFalse(response.has_header('Accept-Ranges'))
+            self.assertFalse(response.has_header('Content-Encoding'))
+            self.assertEqual(b''.join(response.streaming_content), self.contents)
+
+            response = self.client.get(self.read_url, HTTP_RANGE='bytes=5-8',
+                                       HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(response['Accept-Ranges'], 'bytes')
+            self.assertEqual(b''.join(response.streaming_content), compressed[5:9])
+
+    def test_uploadedfile_resource_presigned_redirect(self):
+        with mock.patch.object(PublicMediaStorage, 'get_download_url',
+                               return_value='http://s3/signed') as url_mock, \
+                mock.patch.object(PublicMediaStorage, 'download_obj_stream') as dl_mock:
+            response = self.client.get(self.read_url, {'download': 'redirect',
+                                                       'disposition': 'inline'})
+            self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+            self.assertEqual(response['Location'], 'http://s3/signed')
+            url_mock.assert_called_with(self.upload_path,
+                                        content_disposition='inline; filename="file1.txt"')
+            dl_mock.assert_not_called()
+
+    def test_uploadedfile_detail_presigned_url(self):
+        with mock.patch.object(PublicMediaStorage, 'get_download_url',
+                               return_value='http://s3/signed'):
+            response = self.client.get(self.detail_url, {'download': 'url'})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['url'], 'http://s3/signed')
+
+
+class UploadedFileListViewTests(TestCase):
+    """
+    Test the uploadedfile-list view.
+    """
+
+    def setUp(self):
+        # avoid cluttered console output (for instance logging all the http requests)
+        logging.disable(logging.WARNING)
+
+        user = User.objects.create_user(username='test', password='testpass')
+        for i in range(5):
+            uploadedfile = UploadedFile(owner=user, fsize=i)
+            uploadedfile.fname.name = 'test/uploads/file%s.txt' % i
+            uploadedfile.save()
+        self.list_url = reverse('uploadedfile-list')
+
+    def tearDown(self):
+        # re-enable logging
+        logging.disable(logging.NOTSET)
+
+    def test_uploadedfile_list_cursor_pagination(self):
+        fnames = []
+        url = self.list_url + '?limit=2'
+        with mock.patch.object(PublicMediaStorage, 'size') as size_mock:
+            while url:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertLessEqual(len(response.data['results']), 2)
+                fnames.extend(f['fname'] for f in response.data['results'])
+                url = response.data['next']
+            size_mock.assert_not_called()
+        self.assertEqual(fnames, ['test/uploads/file%s.txt' % i for i in range(4, -1, -1)])
+
+    def test_uploadedfile_list_filters(self):
+        other = User.objects.create_user(username='other', password='otherpass')
+        uploadedfile = UploadedFile(owner=other, fsize=10)
+        uploadedfile.fname.name = 'other/uploads/study1/file.txt'
+        uploadedfile.save()
+        response = self.client.get(self.list_url, {'fname': 'test/uploads/',
+                                                   'min_fsize': 1, 'max_fsize': 3})
+        self.assertEqual([f['fname'] for f in response.data['results']],
+                         ['test/uploads/file%s.txt' % i for i in (3, 2, 1)])
+        response = self.client.get(self.list_url, {'owner_username': 'other'})
+        self.assertEqual([f['fname'] for f in response.data['results']],
+                         ['other/uploads/study1/file.txt'])
+
+
+class UploadedFileUploadViewTests(TestCase):
+    """
+    Test the uploadedfile-upload and uploadedfile-upload-complete views.
+    """
+
+    def setUp(self):
+        # avoid cluttered console output (for instance logging all the http requests)
+        logging.disable(logging.WARNING)
+
+        User.objects.create_user(username='test', password='testpass')
+        self.client.login(username='test', password='testpass')
+        self.upload_url = reverse('uploadedfile-upload')
+        self.complete_url = reverse('uploadedfile-upload-complete')
+        self.upload_path = 'test/uploads/file1.txt'
+
+    def tearDown(self):
+        # re-enable logging
+        logging.disable(logging.NOTSET)
+
+    def test_uploadedfile_upload_request_put(self):
+        with mock.patch.object(PublicMediaStorage, 'get_upload_url',
+                               return_value='http://s3/signed') as url_mock:
+            response = self.client.post(self.upload_url, {'upload_path': self.upload_path})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['url'], 'http://s3/signed')
+        url_mock.assert_called_once_with(self.upload_path, content_type=None)
+
+    def test_uploadedfile_upload_request_failure_invalid_path(self):
+        response = self.client.post(self.upload_url, {'upload_path': 'other/uploads/f'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_uploadedfile_upload_request_failure_multipart_without_size(self):
+        response = self.client.post(self.upload_url, {'upload_path': self.upload_path,
+                                                      'method': 'multipart'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_uploadedfile_upload_request_failure_unauthenticated(self):
+        self.client.logout()
+        response = self.client.post(self.upload_url, {'upload_path': self.upload_path})
+        self.assertIn(response.status_code, (status.HTTP_401_UNAUTHORIZED,
+                                             status.HTTP_403_FORBIDDEN))
+
+    def test_uploadedfile_upload_complete_success(self):
+        mtime = datetime.datetime(2022, 9, 1, tzinfo=datetime.timezone.utc)
+        metadata = S3ObjectMetadata(self.upload_path, 19, 'abc', 'text/plain', mtime)
+        with mock.patch.object(PublicMediaStorage, 'get_obj_metadata',
+                               return_value=metadata):
+            response = self.client.post(self.complete_url,
+                                        {'upload_path': self.upload_path})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['fsize'], 19)
+        user_file = UploadedFile.objects.get(fname=self.upload_path)
+        self.assertEqual(user_file.owner.username, 'test')
+        self.assertEqual(user_file.etag, 'abc')
+
+    def test_uploadedfile_upload_complete_failure_object_not_uploaded(self):
+        error = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        with mock.patch.object(PublicMediaStorage, 'get_obj_metadata',
+                               side_effect=error):
+            response = self.client.post(self.complete_url,
+                                        {'upload_path': self.upload_path})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(UploadedFile.objects.exists())
+
+
+class UploadedFileArchiveViewTests(TestCase):
+    """
+    Test the uploadedfile-archive view.
+    """
+
+    def setUp(self):
+        # avoid cluttered console output (for instance logging all the http requests)
+        logging.disable(logging.WARNING)
+
+        User.objects.create_user(username='test', password='testpass')
+        self.client.login(username='test', password='testpass')
+        self.archive_url = reverse('uploadedfile-archive')
+        self.objects = [('test/uploads/study/f1', b'file1 contents'),
+                        ('test/uploads/study/sub/f2', b'x' * 1000)]
+        # keys of the objects stored gzip compressed without their uncompressed size
+        self.gzip_keys = set()
+
+    def tearDown(self):
+        # re-enable logging
+        logging.disable(logging.NOTSET)
+
+    def iter_obj_streams(self, prefix):
+        mtime = datetime.datetime(2022, 9, 1, tzinfo=datetime.timezone.utc)
+        for key, contents in self.objects:
+            response_object = {'LastModified': mtime}
+            if key in self.gzip_keys:
+                contents = gzip.compress(contents)
+                response_object['ContentEncoding'] = 'gzip'
+            obj = S3ObjectInfo(key, len(contents), 'etag', mtime)
+            response_object['Body'] = StreamingBody(io.BytesIO(contents), len(contents))
+            response_object['ContentLength'] = len(contents)
+            yield obj, S3ObjectStream(response_object, 100, decompress=True)
+
+    def get_archive(self, archive_format):
+        with mock.patch.object(PublicMediaStorage, 'iter_obj_streams',
+                               side_effect=self.iter_obj_streams) as iter_mock:
+            response = self.client.get(self.archive_url,
+                                       {'path': 'test/uploads/study/',
+                                        'archive_format': archive_format})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            content = b''.join(response.streaming_content)
+            iter_mock.assert_called_once_with('test/uploads/study/')
+        return response, io.BytesIO(content)
+
+    def test_uploadedfile_archive_zip(self):
+        response, content = self.get_archive('zip')
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        with zipfile.ZipFile(content) as zf:
+            self.assertEqual(zf.namelist(), ['study/f1', 'study/sub/f2'])
+            self.assertEqual(zf.read('study/sub/f2'), b'x' * 1000)
+
+    def test_uploadedfile_archive_tar(self):
+        response, content = self.get_archive('tar')
+        with tarfile.open(fileobj=content) as tf:
+            self.assertEqual(tf.getnames(), ['study/f1', 'study/sub/f2'])
+            self.assertEqual(tf.extractfile('study/f1').read(), b'file1 contents')
+
+    def test_uploadedfile_archive_of_compressed_files_of_unknown_size(self):
+        self.gzip_keys = {key for key, contents in self.objects}
+        response, content = self.get_archive('zip')
+        with zipfile.ZipFile(content) as zf:
+            self.assertEqual(zf.read('study/f1'), b'file1 contents')
+            self.assertEqual(zf.read('study/sub/f2'), b'x' * 1000)
+        response, content = self.get_archive('tar')
+        with tarfile.open(fileobj=content) as tf:
+            self.assertEqual(tf.getmember('study/sub/f2').size, 1000)
+            self.assertEqual(tf.extractfile('study/f1').read(), b'file1 contents')
+            self.assertEqual(tf.extractfile('study/sub/f2').read(), b'x' * 1000)
+
+    def test_uploadedfile_archive_failure_other_user_folder(self):
+        response = self.client.get(self.archive_url, {'path': 'other/uploads/study'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class StorageMetricsViewTests(TestCase):
+    """
+    Test the metrics view.
+    """
+
+    def test_metrics_are_exposed_in_prometheus_format(self):
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn(b'# TYPE chris_storage_s3_request_duration_seconds histogram',
+                      response.content)
+
+    def test_metrics_view_is_not_found_if_disabled(self):
+        with self.settings(AWS_S3_METRICS=False):
+            response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
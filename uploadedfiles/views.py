@@ -2,14 +2,40 @@ from django.shortcuts import render
 
 # Create your views here.
 import logging
+import os
+import re
+from urllib.parse import quote
 
+from botocore.exceptions import ClientError
 from django.conf import settings
-from django.http import FileResponse
-from rest_framework import generics, permissions
+from django.db import transaction
+from django.http import (FileResponse, Http404, HttpResponse, HttpResponseRedirect,
+                         StreamingHttpResponse)
+from django.utils.cache import patch_vary_headers
+from django_filters.rest_framework import DjangoFilterBackend
+from rest_framework import generics, permissions, status
+from rest_framework.response import Response
 from rest_framework.reverse import reverse
 
-from .models import UploadedFile
-from .serializers import UploadedFileSerializer
+from .archives import ARCHIVE_CONTENT_TYPES, iter_archive
+from .models import IngestJob, UploadedFile, UploadedFileFilter
+from .pagination import UploadedFileCursorPagination
+from .s3_metrics import get_storage_metrics
+from .serializers import (IngestJobSerializer, UploadedFileSerializer,
+                          UploadRequestSerializer, UploadCompleteSerializer)
+from .tasks import start_ingest_job
+
+
+def get_content_disposition(disposition, filename):
+    """
+    Return a Content-Disposition header value for a file name.
+    """
+    try:
+        filename.encode('ascii')
+        return '%s; filename="%s"' % (disposition,
+                                      filename.replace('\\', '\\\\').replace('"', r'\"'))
+    except UnicodeEncodeError:
+        return "%s; filename*=utf-8''%s" % (disposition, quote(filename))
 
 
 class UploadedFileList(generics.ListCreateAPIView):
@@ -19,12 +45,289 @@ class UploadedFileList(generics.ListCreateAPIView):
     http_method_names = ['get','post']
     queryset = UploadedFile.objects.all()
     serializer_class = UploadedFileSerializer
+    pagination_class = UploadedFileCursorPagination
+    filter_backends = (DjangoFilterBackend,)
+    filterset_class = UploadedFileFilter
+
+
+class PresignedDownloadMixin(object):
+    """
+    Mixin for the views of an uploaded file that can let clients fetch the file
+    contents straight from storage through a short-lived presigned URL, so that the
+    Django workers never touch the payload.
+    """
+    download_modes = ('url', 'redirect')
+    dispositions = ('attachment', 'inline')
+
+    def get_download_response(self, request, user_file):
+        """
+        Custom method to answer with a presigned URL of the file (?download=url) or a
+        302 redirect to it (?download=redirect). The Content-Disposition S3 sends can
+        be chosen with ?disposition=attachment|inline. Return None if no presigned
+        download was requested.
+        """
+        mode = request.query_params.get('download')
+        if mode not in self.download_modes:
+            return None
+        disposition = request.query_params.get('disposition', 'attachment')
+        if disposition not in self.dispositions:
+            error_msg = "Disposition must be one of %s." % ', '.join(self.dispositions)
+            return Response({'disposition': [error_msg]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        filename = os.path.basename(user_file.fname.name)
+        url = user_file.fname.storage.get_download_url(
+            user_file.fname.name,
+            content_disposition=get_content_disposition(disposition, filename))
+        if mode == 'redirect':
+            return HttpResponseRedirect(url)
+        return Response({'url': url})
 
 
-class UploadedFileDetail(generics.RetrieveUpdateDestroyAPIView):
+class UploadedFileDetail(PresignedDownloadMixin, generics.RetrieveUpdateDestroyAPIView):
     """
     An uploaded file view.
     """
     http_method_names = ['get', 'put', 'delete']
     queryset = UploadedFile.objects.all()
     serializer_class = UploadedFileSerializer
+
+    def retrieve(self, request, *args, **kwargs):
+        """
+        Overriden to answer with a presigned download URL of the file when requested.
+        """
+        response = self.get_download_response(request, self.get_object())
+        if response is not None:
+            return response
+        return super(UploadedFileDetail, self).retrieve(request, *args, **kwargs)
+
+
+class UploadedFileUploadRequest(generics.GenericAPIView):
+    """
+    A view to request a direct upload of a file to storage. The response holds a
+    presigned PUT URL, a presigned POST policy or the presigned part URLs of a
+    multipart upload, so the file contents never go through the Django workers.
+    """
+    http_method_names = ['post']
+    serializer_class = UploadRequestSerializer
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        """
+        Custom method to validate the upload path and sign the upload.
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        upload_path = data['upload_path']
+        storage = UploadedFile._meta.get_field('fname').storage
+        options = {'content_type': data.get('content_type')}
+        response_data = {'upload_path': upload_path, 'method': data['method'],
+                         'expires_in': storage.presigned_upload_expiry,
+                         'complete_url': reverse('uploadedfile-upload-complete',
+                                                 request=request)}
+        if data['method'] == 'put':
+            response_data['url'] = storage.get_upload_url(upload_path, **options)
+        elif data['method'] == 'post':
+            response_data.update(storage.get_upload_post(upload_path, **options))
+        else:
+            response_data.update(storage.create_presigned_multipart_upload(
+                upload_path, data['fsize'], **options))
+        return Response(response_data, status=status.HTTP_201_CREATED)
+
+
+class UploadedFileUploadComplete(generics.GenericAPIView):
+    """
+    A view to register a file uploaded directly to storage. The stored object is
+    verified with a HEAD request before its uploaded file is created.
+    """
+    http_method_names = ['post']
+    serializer_class = UploadCompleteSerializer
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        """
+        Custom method to complete a multipart upload if an upload id is provided and
+        create the uploaded file from the stored object's metadata.
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        upload_path = serializer.validated_data['upload_path']
+        upload_id = serializer.validated_data.get('upload_id')
+        storage = UploadedFile._meta.get_field('fname').storage
+        try:
+            if upload_id:
+                storage.complete_presigned_multipart_upload(upload_path, upload_id)
+            metadata = storage.get_obj_metadata(upload_path)
+        except (ClientError, ValueError) as e:
+            if isinstance(e, ClientError) and e.response['Error']['Code'] not in (
+                    'NoSuchKey', 'NoSuchUpload', 'InvalidPart', '404'):
+                raise
+            error_msg = "File '%s' was not uploaded: %s" % (upload_path, str(e))
+            return Response({'upload_path': [error_msg]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        user_file = UploadedFile(owner=request.user)
+        user_file.fname.name = upload_path
+        user_file.set_storage_metadata(metadata)
+        user_file.save()
+        file_serializer = UploadedFileSerializer(user_file,
+                                                 context=self.get_serializer_context())
+        return Response(file_serializer.data, status=status.HTTP_201_CREATED)
+
+
+class UploadedFileResource(PresignedDownloadMixin, generics.GenericAPIView):
+    """
+    An uploaded file resource view. The file contents are streamed from storage
+    in chunks, so worker memory does not depend on the file size, unless a presigned
+    download is requested. Files stored compressed are sent as they are to clients
+    that accept gzip and decompressed on the fly for the others.
+    """
+    http_method_names = ['get']
+    queryset = UploadedFile.objects.all()
+    range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+    accepts_gzip_re = re.compile(r'\bgzip\b')
+
+    def get(self, request, *args, **kwargs):
+        """
+        Overriden to be able to make a GET request to an actual file resource. A single
+        byte range can be requested through the HTTP Range header, except for files
+        stored compressed that are decompressed for the client, which are always sent
+        whole.
+        """
+        user_file = self.get_object()
+        response = self.get_download_response(request, user_file)
+        if response is not None:
+            return response
+        storage = user_file.fname.storage
+        byte_range = self.get_byte_range(request)
+        accepts_gzip = self.accepts_gzip_re.search(request.META.get('HTTP_ACCEPT_ENCODING',
+                                                                    ''))
+        try:
+            stream = storage.download_obj_stream(user_file.fname.name,
+                                                 byte_range=byte_range,
+                                                 decompress=not accepts_gzip)
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code == 'InvalidRange':
+                return Response(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            if code in ('NoSuchKey', '404'):
+                raise Http404
+            raise
+        filename = os.path.basename(user_file.fname.name)
+        response = FileResponse(stream, filename=filename,
+                                content_type=stream.content_type)
+        response.block_size = stream.chunk_size
+        if stream.content_length is not None:
+            response['Content-Length'] = stream.content_length
+        if stream.content_encoding:
+            response['Content-Encoding'] = stream.content_encoding
+        # ranges are served of the stored bytes only, not of decompressed contents
+        if not stream.decompressed:
+            response['Accept-Ranges'] = 'bytes'
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if stream.content_range is not None:
+            response.status_code = status.HTTP_206_PARTIAL_CONTENT
+            response['Content-Range'] = stream.content_range
+        return response
+
+    def get_byte_range(self, request):
+        """
+        Custom method to parse a single byte range out of the HTTP Range header.
+        Anything else is ignored and the whole file is served.
+        """
+        match = self.range_re.match(request.META.get('HTTP_RANGE', '').strip())
+        if not match or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        return int(first) if first else None, int(last) if last else None
+
+
+class UploadedFileArchive(generics.GenericAPIView):
+    """
+    A view to download all the files under a folder of the user's uploads as a zip
+    or tar archive that is built on the fly while the files are streamed from
+    storage.
+    """
+    http_method_names = ['get']
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        """
+        Custom method to stream the archive of the ?path=<username>/uploads/... folder
+        in the ?archive_format=zip|tar format (zip by default).
+        """
+        path = request.query_params.get('path', '').strip().rstrip('/')
+        archive_format = request.query_params.get('archive_format', 'zip')
+        prefix = '{}/{}/'.format(request.user.username, 'uploads')
+        if not (path + '/').startswith(prefix):
+            error_msg = "Folder path must start with '%s'." % prefix
+            return Response({'path': [error_msg]}, status=status.HTTP_400_BAD_REQUEST)
+        if archive_format not in ARCHIVE_CONTENT_TYPES:
+            error_msg = 'Archive format must be one of %s.' % ', '.join(ARCHIVE_CONTENT_TYPES)
+            return Response({'archive_format': [error_msg]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        storage = UploadedFile._meta.get_field('fname').storage
+        # entries are named relative to the folder's parent, so they unpack into it
+        root = os.path.dirname(path) + '/'
+        entries = ((obj.key[len(root):], stream)
+                   for obj, stream in storage.iter_obj_streams(path + '/'))
+        response = StreamingHttpResponse(iter_archive(archive_format, entries),
+                                         content_type=ARCHIVE_CONTENT_TYPES[archive_format])
+        filename = '%s.%s' % (os.path.basename(path), archive_format)
+        response['Content-Disposition'] = get_content_disposition('attachment', filename)
+        return response
+
+
+class IngestJobList(generics.ListCreateAPIView):
+    """
+    A view for the collection of directory ingest jobs of the user.
+    """
+    http_method_names = ['get', 'post']
+    serializer_class = IngestJobSerializer
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get_queryset(self):
+        """
+        Overriden to only list the jobs of the user.
+        """
+        return IngestJob.objects.filter(owner=self.request.user)
+
+    def perform_create(self, serializer):
+        """
+        Overriden to set the owner and start the job once it has been committed.
+        """
+        job = serializer.save(owner=self.request.user)
+        transaction.on_commit(lambda: start_ingest_job.delay(job.id))
+
+
+class IngestJobDetail(generics.RetrieveAPIView):
+    """
+    A directory ingest job view. Its progress counters are updated by the workers
+    running the job's batches.
+    """
+    http_method_names = ['get']
+    serializer_class = IngestJobSerializer
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get_queryset(self):
+        """
+        Overriden to only give access to the jobs of the user.
+        """
+        return IngestJob.objects.filter(owner=self.request.user)
+
+
+class StorageMetricsView(generics.GenericAPIView):
+    """
+    A view to scrape the storage metrics of this process in the Prometheus text
+    format.
+    """
+    http_method_names = ['get']
+
+    def get(self, request, *args, **kwargs):
+        """
+        Custom method to render the storage metrics, or 404 if they are disabled.
+        """
+        metrics = get_storage_metrics()
+        if metrics is None:
+            raise Http404
+        return HttpResponse(metrics.render(),
+                            content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -5,6 +5,8 @@ from django.contrib.auth.models import User
 from rest_framework import generics, permissions
 from rest_framework.response import Response
 
+from uploadedfiles.pagination import ListCursorPagination
+
 from .serializers import UserSerializer
 
 
@@ -12,6 +14,7 @@ class UserCreate(generics.ListCreateAPIView):
     http_method_names = ['get', 'post']
     queryset = User.objects.all()
     serializer_class = UserSerializer
+    pagination_class = ListCursorPagination
 
 
 class UserDetail(generics.RetrieveUpdateAPIView):